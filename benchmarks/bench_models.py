@@ -0,0 +1,97 @@
+import torch
+import torch.nn.functional as F
+
+from ohara.models.llama import LLAMA, Config
+
+from common import case
+
+
+VOCAB_SIZE = 1024
+
+
+def _llama(size: dict, device, dtype, fused_proj: bool = False) -> LLAMA:
+    config = Config(
+        vocab_size=VOCAB_SIZE,
+        seq_len=size["seq_len"],
+        d_model=size["d_model"],
+        hidden_dim=4 * size["d_model"],
+        num_heads=size["num_heads"],
+        num_layers=size["num_layers"],
+        dropout=0.0,
+        fused_proj=fused_proj,
+    )
+    return LLAMA(config).to(device, dtype)
+
+
+def _tokens(size: dict, device) -> torch.Tensor:
+    return torch.randint(0, VOCAB_SIZE, (size["batch_size"], size["seq_len"]), device=device)
+
+
+@case("llama_forward")
+def bench_llama_forward(size, device, dtype):
+    model = _llama(size, device, dtype).eval()
+    x = _tokens(size, device)
+
+    @torch.inference_mode()
+    def fn():
+        return model(x)
+
+    return fn
+
+
+@case("llama_forward_backward")
+def bench_llama_forward_backward(size, device, dtype):
+    model = _llama(size, device, dtype).train()
+    x = _tokens(size, device)
+    y = _tokens(size, device)
+
+    def fn():
+        logits = model(x)
+        loss = F.cross_entropy(logits.view(-1, logits.size(-1)), y.view(-1))
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    return fn
+
+
+def _bench_llama_decode_step(fused_proj: bool):
+    def builder(size, device, dtype):
+        # single token step with a half full kv cache
+        model = _llama(size, device, dtype, fused_proj=fused_proj).eval()
+        kv_cache = model.build_kv_cache()
+        start_pos = size["seq_len"] // 2
+        tokens = torch.randint(0, VOCAB_SIZE, (1, start_pos + 1), device=device)
+
+        with torch.inference_mode():
+            model(tokens[:, :start_pos], kv_cache, 0)
+
+        @torch.inference_mode()
+        def fn():
+            return model(tokens, kv_cache, start_pos)
+
+        return fn
+
+    return builder
+
+
+case("llama_decode_step")(_bench_llama_decode_step(fused_proj=False))
+case("llama_decode_step_fused")(_bench_llama_decode_step(fused_proj=True))
+
+
+@case("llama_static_decode_step")
+def bench_llama_static_decode_step(size, device, dtype):
+    # same step on the static cache, eager. StaticDecoder adds compile / cuda graphs on top
+    model = _llama(size, device, dtype).eval()
+    kv_cache = model.setup_static_cache(1, size["seq_len"])
+    start_pos = size["seq_len"] // 2
+    tokens = torch.randint(0, VOCAB_SIZE, (1, start_pos + 1), device=device)
+
+    with torch.inference_mode():
+        model(tokens[:, :start_pos], kv_cache, torch.arange(start_pos, device=device))
+    input_pos = torch.tensor([start_pos], device=device)
+
+    @torch.inference_mode()
+    def fn():
+        return model(tokens[:, -1:], kv_cache, input_pos)
+
+    return fn
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import torch
+
+from ohara.embedings_pos.rotatry import apply_rope, apply_rope_, precompute_freqs_cis, rope_cache
+from ohara.modules.norm import RMSNorm, AddRMSNorm
+from ohara.modules.mlp import MLP_MAP, SwiGLU
+from ohara.modules.attention import Attention, CasualAttention
+from ohara.modules.moe import MoE
+from ohara.modules.pscan import pscan
+from ohara.modules.linear_rnn import RG_LRU
+from ohara.modules.kv_cache import KVCache
+from ohara.sampling import Sampler, SamplingParams
+
+from common import case
+
+
+def _head_dim(size: dict) -> int:
+    return size["d_model"] // size["num_heads"]
+
+
+def _x(size: dict, device, dtype) -> torch.Tensor:
+    shape = (size["batch_size"], size["seq_len"], size["d_model"])
+    return torch.randn(shape, device=device, dtype=dtype)
+
+
+def _forward(module: torch.nn.Module, *args, **kwargs):
+    @torch.inference_mode()
+    def fn():
+        return module(*args, **kwargs)
+
+    return fn
+
+
+def _bench_rope(rope_fn):
+    def builder(size, device, dtype):
+        B, T, H, D = size["batch_size"], size["seq_len"], size["num_heads"], _head_dim(size)
+        q = torch.randn(B, T, H, D, device=device, dtype=dtype)
+        k = torch.randn(B, T, H, D, device=device, dtype=dtype)
+        cis = rope_cache(D).get(T, dtype=dtype, device=device)
+
+        @torch.inference_mode()
+        def fn():
+            return rope_fn(q, k, cis)
+
+        return fn
+
+    return builder
+
+
+case("apply_rope")(_bench_rope(apply_rope))
+case("apply_rope_inplace")(_bench_rope(apply_rope_))
+
+
+@case("rope_cache_decode")
+def bench_rope_cache_decode(size, device, dtype):
+    # table lookup for one decode position, what used to be a full recompute
+    cache = rope_cache(_head_dim(size))
+    pos = size["seq_len"] // 2
+
+    def fn():
+        return cache.get(pos + 1, pos, dtype=dtype, device=device)
+
+    return fn
+
+
+@case("rmsnorm")
+def bench_rmsnorm(size, device, dtype):
+    norm = RMSNorm(size["d_model"]).to(device, dtype)
+    return _forward(norm, _x(size, device, dtype))
+
+
+def _bench_add_rmsnorm(fused: bool):
+    def builder(size, device, dtype):
+        # forward + backward of `x = x + out; h = norm(x)`, the residual step of every block
+        norm = AddRMSNorm(size["d_model"]).to(device, dtype)
+        out = _x(size, device, dtype).requires_grad_()
+        x = _x(size, device, dtype).requires_grad_()
+
+        def unfused():
+            r = x + out
+            rf = r.float()
+            h = (rf * torch.rsqrt(rf.pow(2).mean(-1, keepdim=True) + norm.eps)).type_as(r) * norm.weight
+            (h.sum() + r.sum()).backward()
+
+        def fused_fn():
+            h, r = norm(out, residual=x)
+            (h.sum() + r.sum()).backward()
+
+        return fused_fn if fused else unfused
+
+    return builder
+
+
+case("add_rmsnorm_unfused")(_bench_add_rmsnorm(fused=False))
+case("add_rmsnorm_fused")(_bench_add_rmsnorm(fused=True))
+
+
+def _bench_mlp(name: str):
+    def builder(size, device, dtype):
+        mlp = MLP_MAP[name](size["d_model"]).to(device, dtype)
+        return _forward(mlp, _x(size, device, dtype))
+
+    return builder
+
+
+for _name in MLP_MAP:
+    case(f"mlp_{_name}")(_bench_mlp(_name))
+
+
+def _bench_swiglu_decode(fused: bool):
+    def builder(size, device, dtype):
+        # decode shaped input, one token per sequence: small gemms where launch count matters
+        mlp = SwiGLU(size["d_model"], fused=fused).to(device, dtype)
+        x = torch.randn(size["batch_size"], 1, size["d_model"], device=device, dtype=dtype)
+        return _forward(mlp, x)
+
+    return builder
+
+
+case("swiglu_decode")(_bench_swiglu_decode(fused=False))
+case("swiglu_decode_fused")(_bench_swiglu_decode(fused=True))
+
+
+def _bench_attention(attention_cls):
+    def builder(size, device, dtype):
+        attn = attention_cls(size["d_model"], size["num_heads"]).to(device, dtype).eval()
+        cos, sin = precompute_freqs_cis(_head_dim(size), size["seq_len"])
+        cis = cos.to(device), sin.to(device)
+        return _forward(attn, _x(size, device, dtype), mask=None, freqs_cis=cis)
+
+    return builder
+
+
+case("attention")(_bench_attention(Attention))
+case("casual_attention")(_bench_attention(CasualAttention))
+
+
+def _bench_moe(stacked: bool):
+    def builder(size, device, dtype):
+        moe = MoE(size["d_model"], 2 * size["d_model"], num_experts=4, num_experts_per_tok=2, stacked=stacked)
+        return _forward(moe.to(device, dtype), _x(size, device, dtype))
+
+    return builder
+
+
+case("moe")(_bench_moe(stacked=False))
+case("moe_stacked")(_bench_moe(stacked=True))
+
+
+@case("pscan")
+def bench_pscan(size, device, dtype):
+    # mamba layout (B, L, D, N)
+    shape = (size["batch_size"], size["seq_len"], size["d_model"], 16)
+    A = torch.rand(shape, device=device, dtype=dtype)
+    X = torch.randn(shape, device=device, dtype=dtype)
+
+    @torch.inference_mode()
+    def fn():
+        return pscan(A, X)
+
+    return fn
+
+
+@case("rg_lru")
+def bench_rg_lru(size, device, dtype):
+    rnn = RG_LRU(size["d_model"]).to(device, dtype)
+    return _forward(rnn, _x(size, device, dtype))
+
+
+def _bench_kv_cache(int8: bool):
+    def builder(size, device, dtype):
+        # one decode step: write a token at the middle of the cache and read the prefix back
+        B, T, H, D = size["batch_size"], size["seq_len"], size["num_heads"], _head_dim(size)
+        cache = KVCache((B, T, H, D), T, device=device, dtype=dtype, int8=int8)
+        k = torch.randn(B, 1, H, D, device=device, dtype=dtype)
+        v = torch.randn(B, 1, H, D, device=device, dtype=dtype)
+        start_pos = T // 2
+
+        @torch.inference_mode()
+        def fn():
+            return cache.forward(k, v, start_pos)
+
+        return fn
+
+    return builder
+
+
+case("kv_cache_fp")(_bench_kv_cache(int8=False))
+case("kv_cache_int8")(_bench_kv_cache(int8=True))
+
+
+def _bench_sampler(max_top_k: int | None):
+    def builder(size, device, dtype):
+        # one decode step over a batch mixing greedy and sampled rows, 32k vocab
+        vocab_size = 32000
+        logits = torch.randn(size["batch_size"], vocab_size, device=device, dtype=dtype)
+        sampler = Sampler(size["batch_size"], vocab_size, max_top_k=max_top_k, device=device)
+        for row in range(size["batch_size"]):
+            params = SamplingParams(temperature=0.7 * (row % 2), top_k=50, top_p=0.9, min_p=0.05, repetition_penalty=1.1)
+            sampler.set_row(row, params)
+
+        @torch.inference_mode()
+        def fn():
+            return sampler(logits)
+
+        return fn
+
+    return builder
+
+
+case("sampler_topk")(_bench_sampler(max_top_k=256))
+case("sampler_full_sort")(_bench_sampler(max_top_k=None))
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import json
+import platform
+from datetime import datetime
+from collections.abc import Callable
+from dataclasses import dataclass, asdict, field
+
+import torch
+from torch.utils.benchmark import Timer
+
+
+# shared shapes for every case, pick with --sizes
+SIZES = {
+    "small": {"batch_size": 2, "seq_len": 128, "d_model": 128, "num_heads": 4, "num_layers": 2},
+    "medium": {"batch_size": 4, "seq_len": 512, "d_model": 512, "num_heads": 8, "num_layers": 4},
+    "large": {"batch_size": 8, "seq_len": 1024, "d_model": 1024, "num_heads": 16, "num_layers": 8},
+}
+
+# name -> builder(size, device, dtype) -> zero arg callable that runs one iteration
+CASES: dict[str, Callable[[dict, torch.device, torch.dtype], Callable[[], object]]] = {}
+
+
+def case(name: str):
+    def register(builder):
+        CASES[name] = builder
+        return builder
+
+    return register
+
+
+@dataclass
+class BenchResult:
+    name: str
+    size: str
+    median_ms: float
+    iqr_ms: float
+    runs: int
+    params: dict = field(default_factory=dict)
+
+
+def measure(fn: Callable[[], object], min_run_time: float = 0.5, warmup: int = 3) -> tuple[float, float, int]:
+    "median/iqr in ms, torch.utils.benchmark handles cuda sync and thread settings"
+    for _ in range(warmup):
+        fn()
+    m = Timer(stmt="fn()", globals={"fn": fn}, num_threads=torch.get_num_threads()).blocked_autorange(
+        min_run_time=min_run_time
+    )
+    return m.median * 1e3, m.iqr * 1e3, len(m.times)
+
+
+def run_cases(
+    names: list[str],
+    sizes: list[str],
+    device: torch.device,
+    dtype: torch.dtype = torch.float32,
+    min_run_time: float = 0.5,
+) -> list[BenchResult]:
+    results = []
+    for size in sizes:
+        for name in names:
+            torch.manual_seed(0)
+            fn = CASES[name](SIZES[size], device, dtype)
+            median, iqr, runs = measure(fn, min_run_time=min_run_time)
+            results.append(BenchResult(name, size, median, iqr, runs, SIZES[size]))
+            print(f"{name:<28}{size:<8}{median:>10.3f} ms  ± {iqr:.3f}  ({runs} runs)")
+    return results
+
+
+def save_results(path: str, results: list[BenchResult], device: torch.device, dtype: torch.dtype):
+    payload = {
+        "meta": {
+            "torch": torch.__version__,
+            "device": str(device),
+            "dtype": str(dtype),
+            "threads": torch.get_num_threads(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "time": datetime.now().isoformat(timespec="seconds"),
+        },
+        "results": [asdict(r) for r in results],
+    }
+    with open(path, "w") as f:
+        json.dump(payload, f, indent=2)
+
+
+def load_results(path: str) -> dict[tuple[str, str], dict]:
+    with open(path) as f:
+        payload = json.load(f)
+    return {(r["name"], r["size"]): r for r in payload["results"]}
@@ -0,0 +1,44 @@
+"""
+compare two benchmark json files
+
+python benchmarks/compare.py base.json new.json --threshold 0.1
+exits with 1 if any case got slower than threshold
+"""
+
+import sys
+import argparse
+
+from common import load_results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown, 0.1 = 10%%")
+    args = parser.parse_args()
+
+    base = load_results(args.base)
+    new = load_results(args.new)
+
+    regressions = 0
+    print(f"{'case':<28}{'size':<8}{'base ms':>12}{'new ms':>12}{'ratio':>8}")
+    for key in sorted(base.keys() & new.keys()):
+        b, n = base[key]["median_ms"], new[key]["median_ms"]
+        ratio = n / b
+        flag = ""
+        if ratio > 1 + args.threshold:
+            flag = "  <-- slower"
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            flag = "  faster"
+        print(f"{key[0]:<28}{key[1]:<8}{b:>12.3f}{n:>12.3f}{ratio:>8.2f}{flag}")
+
+    for key in sorted(base.keys() ^ new.keys()):
+        print(f"{key[0]:<28}{key[1]:<8} only in {'base' if key in base else 'new'}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
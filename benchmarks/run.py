@@ -0,0 +1,52 @@
+"""
+micro benchmarks for ohara hot paths
+
+python benchmarks/run.py                                  # every case, small size, cpu
+python benchmarks/run.py --sizes small medium --cases mlp rope --out new.json
+python benchmarks/compare.py base.json new.json           # regression check
+"""
+
+import argparse
+
+import torch
+
+from common import CASES, SIZES, run_cases, save_results
+
+# register cases
+import bench_modules  # noqa
+import bench_models  # noqa
+
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", default=["small"], choices=list(SIZES))
+    parser.add_argument("--cases", nargs="+", default=None, help="substring filter on case names")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="float32", choices=list(DTYPES))
+    parser.add_argument("--min-run-time", type=float, default=0.5, help="seconds per case")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--out", default="results.json")
+    parser.add_argument("--list", action="store_true", help="print case names and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(CASES))
+        return
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    names = [n for n in CASES if args.cases is None or any(c in n for c in args.cases)]
+    device = torch.device(args.device)
+    dtype = DTYPES[args.dtype]
+
+    results = run_cases(names, args.sizes, device, dtype, min_run_time=args.min_run_time)
+    save_results(args.out, results, device, dtype)
+    print(f"saved {len(results)} results to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
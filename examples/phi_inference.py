@@ -12,7 +12,7 @@ from typing import Optional, Union
 # import pretty_errors
 
 from transformers import AutoTokenizer
-from ohara.models.phi import Phi, Block
+from ohara.models.phi import Phi, PhiConfig, Block
 from ohara.utils import auto_accelerator
 from ohara.inference import Inference
 
@@ -23,7 +23,8 @@ model_name = "microsoft/phi-2"
 
 tokenizer = AutoTokenizer.from_pretrained(model_name)
 
-model: Phi = Phi.from_pretrained(model_name).to(device).eval()
+# fused qkv: one matmul per attention block, hf weights are fused on load
+model: Phi = Phi.from_pretrained(model_name, PhiConfig(fused_qkv=True)).to(device).eval()
 
 print(kv)
 kv_cache = model.build_kv_cache() if kv == True else None
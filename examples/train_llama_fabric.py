@@ -13,12 +13,15 @@ import torch.nn.functional as F
 import torch.optim as optim
 
 
-from ohara.models.llama import LLAMA, Config
+from ohara.models.llama import LLAMA, Block, Config
+from ohara.fsdp import fsdp_strategy
 from ohara.lr_scheduler import CosineScheduler
 from ohara.dataset import PreTokenizedDataset
 from ohara.utils import BetterCycle
 
 from ohara.utils import auto_accelerator, random_name, model_summary
+from ohara.utils.throughput import StepMonitor, flops_per_token
+from ohara.utils.profiler import Profiler
 
 
 from torch.utils.data import DataLoader
@@ -75,12 +78,18 @@ device = auto_accelerator()  # auto chose device (cuda, mps)
 
 
 # fabric
-strategy: str = "auto"
+strategy: str = "auto"  # "auto", "ddp", "fsdp" (shards params/grads/optimizer state per Block)
 precision: str = "bf16-mixed"  # "32-true", "16-mixed", "16-true", "bf16-mixed", "bf16-true"
 
 # for restarting training from last checkout
 resume_traning = False
 
+# torch.profiler window: skip `wait` steps, `warmup` steps, record `active` steps
+profile: bool = False
+profile_wait: int = 5
+profile_warmup: int = 2
+profile_active: int = 3
+
 
 @torch.no_grad()
 def validate(
@@ -123,9 +132,11 @@ def train(
     save_ckpt_iters: int,
     get_lr,
     ignore_index=-1,
+    monitor: StepMonitor | None = None,
+    profiler: Profiler | None = None,
 ):
-    fabric.launch()
     ignore_index = ignore_index if ignore_index else -1
+    monitor = monitor or StepMonitor(fabric)
     # sanity test
     validate(fabric, model, val_dataloader, 5, device=device)
     # cyclining loder so you can runit indefinitely
@@ -135,6 +146,9 @@ def train(
     print(f"{data.shape=}")
     tokerns_per_iter = int(math.prod(data.shape) * micro_batch)
 
+    if profiler is not None:
+        profiler.start()
+
     micro_batch_loss: float = 0
     idx: int = 0
     while True:
@@ -147,27 +161,37 @@ def train(
         lr = get_lr(idx)
         for param_group in optimizer.param_groups:
             param_group["lr"] = lr
-        # ...
+        monitor.start_step()
         for _ in range(micro_batch):
-            (data, target) = next(train_dataloader)
+            with monitor.time("data"):
+                (data, target) = next(train_dataloader)
             with fabric.no_backward_sync(model, enabled=micro_batch == 1):
-                logits: torch.Tensor = model(data)
-                loss = F.cross_entropy(
-                    logits.view(-1, logits.size(-1)),
-                    target.view(-1),
-                    ignore_index=ignore_index,
-                )
-                loss = loss / micro_batch
+                with monitor.time("forward"):
+                    logits: torch.Tensor = model(data)
+                    loss = F.cross_entropy(
+                        logits.view(-1, logits.size(-1)),
+                        target.view(-1),
+                        ignore_index=ignore_index,
+                    )
+                    loss = loss / micro_batch
+                with monitor.time("backward"):
+                    fabric.backward(loss)
                 micro_batch_loss += loss.item()
-                fabric.backward(loss)
 
-        optimizer.step()
-        optimizer.zero_grad()
+        with monitor.time("optimizer"):
+            optimizer.step()
+            optimizer.zero_grad()
+
+        step_metrics = monitor.end_step(tokerns_per_iter)
+        monitor.log(step_metrics, step=idx)
+        if profiler is not None:
+            profiler.step()
 
         curr_time: float = time.perf_counter()
         elapsed_time: float = curr_time - start_time
         print(
             f"iter: {idx} | loss: {micro_batch_loss:.4f} | lr: {lr:e} | time: {elapsed_time:.4f}s"
+            f" | tok/s: {step_metrics['tokens_per_sec']:.0f} | mfu: {step_metrics.get('mfu', 0):.2%}"
         )
 
         if idx % eval_iters == 0:
@@ -191,6 +215,9 @@ def train(
             state = {"model": model, "optimizer": optimizer, "idx": idx, "lr": lr}
             fabric.save("./ckpt/model.pt", state)
 
+    if profiler is not None:
+        profiler.stop()
+
 
 def main():
     hyper_params = {
@@ -218,7 +245,9 @@ def main():
     tensorboard_logger = TensorBoardLogger(root_dir="logs", name=wandb_run_name)
     loggers.append(tensorboard_logger)
 
-    fabric: L.Fabric = L.Fabric(strategy=strategy, precision=precision, loggers=loggers)
+    fabric_strategy = fsdp_strategy({Block}, precision=precision) if strategy == "fsdp" else strategy
+    fabric: L.Fabric = L.Fabric(strategy=fabric_strategy, precision=precision, loggers=loggers)
+    fabric.launch()
 
     tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
 
@@ -280,6 +309,12 @@ def main():
         save_ckpt_iters=save_ckpt_iters,
         get_lr=get_lr,
         ignore_index=tokenizer.pad_token_id,
+        monitor=StepMonitor(fabric, flops_per_token(config)),
+        profiler=(
+            Profiler(model, f"./profile/{wandb_run_name}", profile_wait, profile_warmup, profile_active)
+            if profile
+            else None
+        ),
     )
 
     # TODO: Replace this inference
@@ -165,6 +165,7 @@ def main():
 
     # fabric init
     fabric = L.Fabric(loggers=loggers, precision="bf16-mixed")
+    fabric.launch()
     fabric.logger.log_hyperparams(hyper_params)
 
     
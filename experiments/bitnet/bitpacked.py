@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from torch import Tensor
+
+from bitnet import BitLinear, RMSNorm, weight_quant
+
+### packed ternary inference
+# BitLinear keeps fp weights and re-quantizes them every forward. After training the
+# weights are fixed, so export them once: ternary {-1, 0, 1} stored as 2 bit codes
+# (t + 1), 4 per byte along in_features, plus the per tensor scale.
+# 8x smaller than fp16, and the matmul only ever adds or subtracts activations.
+
+SHIFTS = torch.tensor([0, 2, 4, 6], dtype=torch.uint8)
+
+
+def pack_ternary(ternary: Tensor) -> Tensor:
+    "(out, in) int {-1, 0, 1} -> (out, ceil(in / 4)) uint8"
+    out_features, in_features = ternary.shape
+    codes = (ternary + 1).to(torch.uint8)
+    codes = F.pad(codes, (0, -in_features % 4), value=1)  # pad with code of 0
+    codes = codes.view(out_features, -1, 4) << SHIFTS.to(codes.device)
+    return codes.sum(dim=-1, dtype=torch.uint8)
+
+
+def unpack_ternary(packed: Tensor, in_features: int, dtype: torch.dtype = torch.int8) -> Tensor:
+    "inverse of pack_ternary"
+    codes = (packed.unsqueeze(-1) >> SHIFTS.to(packed.device)) & 3
+    return codes.view(packed.size(0), -1)[:, :in_features].to(dtype) - 1
+
+
+def _byte_table(device: torch.device) -> Tensor:
+    "(4, 256) int16: ternary digit j of every byte value"
+    values = torch.arange(256, device=device, dtype=torch.uint8)
+    return unpack_ternary(values.view(-1, 1), 4, torch.int16).T.contiguous()
+
+
+def quantize_activations(x: Tensor) -> tuple[Tensor, Tensor]:
+    "same grid as bitnet.activation_quant -> (int8 values, per row scale)"
+    scale = 127.0 / x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-5)
+    return (x * scale).round().clamp(-128, 127).to(torch.int8), scale
+
+
+def lut_matmul(x_int: Tensor, packed: Tensor, chunk_size: int = 1024) -> Tensor:
+    """
+    (N, in) int8 @ packed ternary (out, in / 4) -> (N, out) int32, no multiplies
+    against the weight: https://arxiv.org/abs/2407.00088 (T-MAC)
+
+    Every packed byte covers 4 input columns, so for each group of 4 activations
+    a 256 entry table holds the signed sum for every byte value. The matmul is
+    then a gather of one table entry per weight byte and a sum over groups.
+    """
+    num_tokens = x_int.size(0)
+    groups = packed.size(1)
+    x_int = F.pad(x_int, (0, groups * 4 - x_int.size(1))).view(num_tokens, groups, 4)
+    # tiny matmul, exact in fp32 (no integer matmul on cpu). |entry| <= 4 * 128 fits
+    # int16, which halves the gather traffic; the sum over groups is done in int32
+    table = (x_int.float() @ _byte_table(x_int.device).float()).to(torch.int16)
+    out = []
+    for start in range(0, packed.size(0), chunk_size):
+        index = packed[start : start + chunk_size].T.long()  # (groups, chunk)
+        gathered = table.gather(2, index.unsqueeze(0).expand(num_tokens, -1, -1))
+        out.append(gathered.sum(dim=1, dtype=torch.int32))
+    return torch.cat(out, dim=-1)
+
+
+class PackedBitLinear(nn.Module):
+    def __init__(self, in_features: int, out_features: int, mode: str = "auto", lut_max_tokens: int = 16):
+        """
+        inference only BitLinear on 2 bit packed ternary weights, build with `from_bitlinear`
+
+        mode:
+            "lut"    int8 activations x ternary weights through lookup tables (lut_matmul)
+            "unpack" unpack to the activation dtype and run a dense matmul (gpu, prefill)
+            "auto"   lut on cpu for up to `lut_max_tokens` tokens, unpack otherwise
+        """
+        super().__init__()
+        assert mode in ("auto", "lut", "unpack"), f"unknown mode {mode}"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.mode = mode
+        self.lut_max_tokens = lut_max_tokens
+        self.rms_norm = RMSNorm(in_features)
+        self.register_buffer("packed", torch.zeros(out_features, (in_features + 3) // 4, dtype=torch.uint8))
+        self.register_buffer("scale", torch.ones(()))
+
+    @classmethod
+    @torch.no_grad()
+    def from_bitlinear(cls, linear: BitLinear, **kwargs) -> PackedBitLinear:
+        packed = cls(linear.in_features, linear.out_features, **kwargs).to(linear.weight.device)
+        w_quant, scale = weight_quant(linear.weight.float())
+        packed.packed.copy_(pack_ternary(w_quant.round()))
+        packed.scale.copy_(scale)
+        packed.rms_norm.load_state_dict(linear.rms_norm.state_dict())
+        # BitLinear.forward never adds its bias, neither does this
+        return packed
+
+    def forward(self, x: Tensor) -> Tensor:
+        x_norm = self.rms_norm(x)
+        x_int, x_scale = quantize_activations(x_norm)
+        num_tokens = x_int.numel() // self.in_features
+        use_lut = self.mode == "lut" or (
+            self.mode == "auto" and not x.is_cuda and num_tokens <= self.lut_max_tokens
+        )
+        if use_lut:
+            acc = lut_matmul(x_int.view(-1, self.in_features), self.packed).view(*x.shape[:-1], -1)
+            return (acc * (self.scale / x_scale)).to(x.dtype)
+        # dequantize before the matmul, integer sums of +-127 activations overflow fp16
+        # and lose precision in bf16
+        weight = unpack_ternary(self.packed, self.in_features, x.dtype)
+        out = F.linear((x_int / x_scale).to(x.dtype), weight)
+        return out * self.scale.to(x.dtype)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, mode={self.mode}"
+
+
+def export_packed(model: nn.Module, **kwargs) -> nn.Module:
+    "swap every BitLinear for a PackedBitLinear, in place"
+    if isinstance(model, BitLinear):
+        return PackedBitLinear.from_bitlinear(model, **kwargs)
+    for name, child in model.named_children():
+        setattr(model, name, export_packed(child, **kwargs))
+    return model
+
+
+if __name__ == "__main__":
+    from torch.utils.benchmark import Timer
+
+    torch.manual_seed(0)
+
+    ternary = torch.randint(-1, 2, (7, 13))
+    assert torch.equal(unpack_ternary(pack_ternary(ternary), 13).long(), ternary)
+
+    # packed layer matches the training forward in every mode
+    bitlinear = BitLinear(256, 512, bias=False).eval()
+    x = torch.randn(4, 256)
+    with torch.no_grad():
+        ref = bitlinear(x)
+        for mode in ("lut", "unpack"):
+            out = PackedBitLinear.from_bitlinear(bitlinear, mode=mode)(x)
+            assert torch.allclose(out, ref, atol=1e-4, rtol=1e-4), (mode, (out - ref).abs().max())
+
+    # decode shaped matmul on cpu against the fp16 / fp32 nn.Linear baseline
+    dim = 4096
+    print(f"{'layer':32s} {'tokens':>6s} {'ms':>8s} {'weight MB':>10s}")
+    for num_tokens in (1, 16):
+        x = torch.randn(num_tokens, dim)
+        layers = {
+            "nn.Linear fp32": (nn.Linear(dim, dim, bias=False), x),
+            "nn.Linear fp16": (nn.Linear(dim, dim, bias=False).half(), x.half()),
+            "PackedBitLinear lut": (PackedBitLinear.from_bitlinear(BitLinear(dim, dim, bias=False), mode="lut"), x),
+            "PackedBitLinear unpack": (
+                PackedBitLinear.from_bitlinear(BitLinear(dim, dim, bias=False), mode="unpack"),
+                x,
+            ),
+        }
+        for name, (layer, inp) in layers.items():
+            size = sum(t.numel() * t.element_size() for t in layer.state_dict().values()) / 2**20
+            with torch.inference_mode():
+                timer = Timer("layer(inp)", globals={"layer": layer, "inp": inp})
+                ms = timer.blocked_autorange(min_run_time=0.5).median * 1e3
+            print(f"{name:32s} {num_tokens:6d} {ms:8.3f} {size:10.2f}")
@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 
-from ohara.modules.mlp import MLP_MAP, MLP
+from ohara.modules.mlp import MLP_MAP, STACKED_MLP_MAP, MLP, StackedExperts
 from torch import Tensor
 import torch.nn.functional as F
 
@@ -44,6 +44,7 @@ class Config(OrderedDict):
 
     activation: str = "silu"  # "relu", "gelu", "silu" etc
     mlp: str = "GLU"  # MLP or GLU
+    stacked_experts: bool = False  # experts as (E, in, out) tensors, one bmm per projection
     
     ffn_type: str = FFNType.DSMoE
     
@@ -86,6 +87,7 @@ class DSMoE(nn.Module):
         dropout: float = 0.2,
         bias: bool = False,
         mlp: str = "swiglu",
+        stacked: bool = False,
     ):
         super().__init__()
         self.dim = dim
@@ -104,9 +106,12 @@ class DSMoE(nn.Module):
 
         mlp_block = MLP_MAP[mlp.lower()]  # SwiGLU is default
 
-        self.experts = nn.ModuleList(
-            [mlp_block(dim, hidden_dim) for _ in range(num_experts)]
-        )
+        if stacked:
+            self.experts = STACKED_MLP_MAP[mlp.lower()](num_experts, dim, hidden_dim)
+        else:
+            self.experts = nn.ModuleList(
+                [mlp_block(dim, hidden_dim) for _ in range(num_experts)]
+            )
         self.gate = nn.Linear(dim, num_experts, bias=False)
         if self.num_shared_experts > 0:
             self.shared_experts = nn.ModuleList(
@@ -146,31 +151,10 @@ class DSMoE(nn.Module):
         # Repeat tokens to match the number of experts per token
         x = x.repeat_interleave(self.num_experts_per_tok, dim=0)
 
-        # --- Optimized Expert Dispatch ---
-        # Instead of a Python loop over experts filtering tokens one by one,
-        # we sort tokens by expert id so that each expert’s tokens are contiguous.
-        sorted_indices, sort_order = torch.sort(flat_expert_indices)
-        x_sorted = x[sort_order]
-
-        output_sorted = torch.empty_like(x_sorted)
-
-        # For each expert, process its contiguous block in a batched manner.
-        # Use torch.searchsorted on the sorted indices to get boundaries.
-        for expert_id in range(self.num_experts):
-            # Find the boundaries where sorted_indices == expert_id.
-            left = torch.searchsorted(sorted_indices, expert_id, right=False)
-            right = torch.searchsorted(sorted_indices, expert_id, right=True)
-            if right > left:
-                block = x_sorted[left:right]
-                # Process all tokens for this expert at once
-                out_block = self.experts[expert_id](block).to(x.dtype)
-                output_sorted[left:right] = out_block
-
-        # Unsort the output to match the original order.
-        inv_sort_order = torch.empty_like(sort_order)
-        inv_sort_order[sort_order] = torch.arange(sort_order.size(0), device=sort_order.device)
-        output = output_sorted[inv_sort_order]
-        # --- End Optimized Expert Dispatch ---
+        if isinstance(self.experts, StackedExperts):
+            output = self.experts.dispatch(x, flat_expert_indices)
+        else:
+            output = self._dispatch_module_list(x, flat_expert_indices)
 
         # Process router probabilities for auxiliary gradient routing.
         router_probs, _ = torch.topk(scores, self.num_experts_per_tok, dim=-1)
@@ -204,6 +188,31 @@ class DSMoE(nn.Module):
 
         return output, 0, maximal_violation(expert_indices, self.num_experts)
 
+    def _dispatch_module_list(self, x: Tensor, flat_expert_indices: Tensor) -> Tensor:
+        # Instead of a Python loop over experts filtering tokens one by one,
+        # we sort tokens by expert id so that each expert’s tokens are contiguous.
+        sorted_indices, sort_order = torch.sort(flat_expert_indices)
+        x_sorted = x[sort_order]
+
+        output_sorted = torch.empty_like(x_sorted)
+
+        # For each expert, process its contiguous block in a batched manner.
+        # Use torch.searchsorted on the sorted indices to get boundaries.
+        for expert_id in range(self.num_experts):
+            # Find the boundaries where sorted_indices == expert_id.
+            left = torch.searchsorted(sorted_indices, expert_id, right=False)
+            right = torch.searchsorted(sorted_indices, expert_id, right=True)
+            if right > left:
+                block = x_sorted[left:right]
+                # Process all tokens for this expert at once
+                out_block = self.experts[expert_id](block).to(x.dtype)
+                output_sorted[left:right] = out_block
+
+        # Unsort the output to match the original order.
+        inv_sort_order = torch.empty_like(sort_order)
+        inv_sort_order[sort_order] = torch.arange(sort_order.size(0), device=sort_order.device)
+        return output_sorted[inv_sort_order]
+
     def update_experts_biases(self, expert_indices: torch.Tensor):
         expert_indices = expert_indices.clone().detach().reshape(-1)
         expert_frequencies = torch.bincount(
@@ -229,6 +238,9 @@ class DSMoE(nn.Module):
             a=-3 * gate_std,
             b=3 * gate_std,
         )
+        if isinstance(self.experts, StackedExperts):
+            self.experts.reset_parameters(init_std=init_std, factor=factor)
+            return
         for expert in self.experts:
             if hasattr(expert, "reset_parameters"):
                 expert.reset_parameters(init_std=init_std, factor=factor)
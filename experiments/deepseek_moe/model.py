@@ -147,6 +147,7 @@ class Block(nn.Module):
                 mlp=config.mlp,
                 dropout=config.dropout,
                 bias=config.bias,
+                stacked=config.stacked_experts,
             )
         elif config.ffn_type == FFNType.SparseMoE:
             self.ff = SparseMoE(
@@ -7,10 +7,67 @@ from torch.optim import Optimizer
 from torch import Tensor
 
 from typing import Tuple, Callable, Iterable
+from collections import defaultdict
 
 # minimum entropy reimplementation https://github.com/jiaweizzhao/GaLore/tree/master
 
 
+def orthogonal_basis(
+    matrix: Tensor,
+    rank: int,
+    side: str,
+    svd: str = "subspace",
+    prev: Tensor | None = None,
+    niter: int = 2,
+    oversample: int = 8,
+) -> Tensor:
+    """
+    rank-r basis of the dominant subspace of (*, m, n) matrices
+    side "right" -> (*, rank, n) rows of Vt, "left" -> (*, m, rank) columns of U
+
+    svd:
+        "full"        torch.linalg.svd, what the paper does, O(mn min(m, n))
+        "randomized"  torch.svd_lowrank (Halko et al.), O(mn (rank + oversample))
+        "subspace"    `niter` power iterations warm started from the previous basis,
+                      the gradient subspace moves slowly between refreshes so this is
+                      the cheapest. Falls back to randomized without a previous basis.
+    """
+    matrix = matrix.float()
+    if svd == "subspace" and prev is not None:
+        basis = prev.float() if side == "left" else prev.float().mT
+        for _ in range(niter):
+            if side == "left":
+                basis = matrix @ (matrix.mT @ basis)
+            else:
+                basis = matrix.mT @ (matrix @ basis)
+            basis = torch.linalg.qr(basis).Q
+        return basis if side == "left" else basis.mT
+    if svd == "full":
+        U, _, Vt = torch.linalg.svd(matrix, full_matrices=False)
+        return U[..., :rank] if side == "left" else Vt[..., :rank, :]
+    U, _, V = torch.svd_lowrank(matrix, q=min(rank + oversample, *matrix.shape[-2:]), niter=niter)
+    return U[..., :rank] if side == "left" else V[..., :rank].mT
+
+
+def projection_side(shape: torch.Size, proj_type: str) -> str:
+    "std projects the larger dim away: right when rows >= cols, like the reference"
+    out_features, in_features = shape[-2:]
+    if proj_type == "std":
+        return "right" if out_features >= in_features else "left"
+    if proj_type == "reverse_std":
+        return "left" if out_features >= in_features else "right"
+    assert proj_type in ("left", "right"), f"unknown proj_type {proj_type}"
+    return proj_type
+
+
+def project(grad: Tensor, basis: Tensor, side: str) -> Tensor:
+    return grad @ basis.mT if side == "right" else basis.mT @ grad
+
+
+def project_back(low_rank: Tensor, basis: Tensor, side: str) -> Tensor:
+    return low_rank @ basis if side == "right" else basis @ low_rank
+
+
 class GaLoreProjector:
     def __init__(
         self,
@@ -18,6 +75,8 @@ class GaLoreProjector:
         verbose: bool = False,
         update_proj_gap: int = 200,
         scale: float = 1.0,
+        proj_type: str = "std",
+        svd: str = "subspace",
     ) -> None:
         assert rank > 0, "rank must be a positive integer"
         assert update_proj_gap > 0, "good value is above 100"
@@ -27,84 +86,46 @@ class GaLoreProjector:
         self.verbose = verbose
         self.update_proj_gap = update_proj_gap
         self.scale = scale
+        self.proj_type = proj_type
+        self.svd = svd
         self.ortho_matrix: Tensor | None = None
+        self.side: str | None = None
 
     def project(self, full_rank_grad: Tensor, iter: int) -> Tensor:
-        out_features, in_features = full_rank_grad.shape
-        if out_features >= in_features:
-            if self.ortho_matrix is None or iter % self.update_proj_gap == 0:
-                self.ortho_matrix = self.get_orthogonal_matrix(
-                    full_rank_grad, self.rank, type="right"
-                )
-
-            low_rank_grad = full_rank_grad @ self.ortho_matrix.t()
-        else:
-            if self.ortho_matrix is None or iter % self.update_proj_gap == 0:
-                self.ortho_matrix = self.get_orthogonal_matrix(
-                    full_rank_grad, self.rank, type="left"
-                )
+        self.side = projection_side(full_rank_grad.shape, self.proj_type)
+        if self.ortho_matrix is None or iter % self.update_proj_gap == 0:
+            self.ortho_matrix = self.get_orthogonal_matrix(full_rank_grad, self.rank, type=self.side)
+        return project(full_rank_grad, self.ortho_matrix, self.side)
 
-            low_rank_grad = self.ortho_matrix.t() @ full_rank_grad
-
-        return low_rank_grad
-
-    def project_back(self, low_rank_grad) -> Tensor:
-        out_features, in_features = low_rank_grad.shape
-
-        if out_features >= in_features:
-            full_rank_grad = low_rank_grad @ self.ortho_matrix
-        else:
-            full_rank_grad = self.ortho_matrix @ low_rank_grad
-
-        return full_rank_grad * self.scale
+    def project_back(self, low_rank_grad: Tensor) -> Tensor:
+        return project_back(low_rank_grad, self.ortho_matrix, self.side) * self.scale
 
     def get_orthogonal_matrix(self, weights: nn.Parameter, rank: int, type: str) -> Tensor:
-        dtype = weights.data.dtype
-        device = weights.data.device
-        matrix = weights.data.float()  # svd is only supported in float
-
-        U, Sig, Vt = torch.linalg.svd(matrix, full_matrices=False)
+        # U represent the eigenvectors in columns space, V the basis vectors in rows space.
+        # the paper assumes only one side of UΣVt captures the important part of the
+        # gradient. here is video for svd vibes check https://youtu.be/nbBvuuNVfco?si=G5bLJvOyreTOzQfC
+        basis = orthogonal_basis(weights.data, rank, type, self.svd, prev=self.ortho_matrix)
+        return basis.to(weights.dtype)
 
-        # this is where you will project the orthogonal matrix
-        # I am not comfertable with this, they are taking only one part of svd decomposition
-        # to project gradient in lower dimension each part of svd UΣVt have diffrent meaning
-        # U represent the eigenvectors in columns space
-        # V represent the basis vector, in rows space
-        # paper just assuimg useing only U or V is sufficient to capture gradient most impormant part
-        # which is not the case in mathamatical sense of svd (both U and V are important),
-        # will it scale? its just U and V sufficient for learning deep neural network?
-        # here is video for svd vibes check https://youtu.be/nbBvuuNVfco?si=G5bLJvOyreTOzQfC
-        if type == "right":
-            low_rank_matrix = Vt[:rank, :]
 
-        elif type == "left":
-            low_rank_matrix: Tensor = U[:, :rank]
-
-        low_rank_matrix = low_rank_matrix.to(device).to(dtype)
-        return low_rank_matrix
-
-
-# TODO: AdamW with glore projection
 class AdamW(Optimizer):
     """
-    Implements Adam algorithm with weight decay fix as introduced in [Decoupled Weight Decay
-    Regularization](https://arxiv.org/abs/1711.05101).
+    AdamW with GaLore gradient projection: https://arxiv.org/abs/2403.03507
+
+    Param groups with a "rank" key are projected, the rest is plain AdamW:
+        AdamW([{"params": matrices, "rank": 128, "update_proj_gap": 200, "scale": 0.25,
+                "proj_type": "std"}, {"params": others}], lr=1e-3)
+
+    Parameters of the same shape are stacked and projected with one batched matmul,
+    the Adam update runs with torch._foreach ops over a whole bucket. Projectors are
+    refreshed every update_proj_gap steps with `svd` (see `orthogonal_basis`); with
+    async_refresh on cuda the refresh runs on a side stream and the new projector is
+    picked up one step later.
 
     Parameters:
-        params (`Iterable[nn.parameter.Parameter]`):
-            Iterable of parameters to optimize or dictionaries defining parameter groups.
-        lr (`float`, *optional*, defaults to 0.001):
-            The learning rate to use.
-        betas (`Tuple[float,float]`, *optional*, defaults to `(0.9, 0.999)`):
-            Adam's betas parameters (b1, b2).
-        eps (`float`, *optional*, defaults to 1e-06):
-            Adam's epsilon for numerical stability.
-        weight_decay (`float`, *optional*, defaults to 0.0):
-            Decoupled weight decay to apply.
-        correct_bias (`bool`, *optional*, defaults to `True`):
-            Whether or not to correct bias in Adam (for instance, in Bert TF repository they use `False`).
-        no_deprecation_warning (`bool`, *optional*, defaults to `False`):
-            A flag used to disable the deprecation warning (set to `True` to disable the warning).
+        lr, betas, eps, weight_decay, correct_bias: as in the hf AdamW
+        svd: "full", "randomized" or "subspace"
+        async_refresh: compute projectors on a side cuda stream
     """
 
     def __init__(
@@ -115,6 +136,8 @@ class AdamW(Optimizer):
         eps: float = 1e-6,
         weight_decay: float = 0.0,
         correct_bias: bool = True,
+        svd: str = "subspace",
+        async_refresh: bool = False,
     ):
         assert lr >= 0.0, f"Invalid learning rate: {lr} - should be >= 0.0"
         assert (
@@ -124,6 +147,7 @@ class AdamW(Optimizer):
             0.0 <= betas[1] < 1.0
         ), f"Invalid beta parameter: {betas[1]} - should be in [0.0, 1.0)"
         assert eps >= 0.0, f"Invalid epsilon value: {eps} - should be >= 0.0"
+        assert svd in ("full", "randomized", "subspace"), f"unknown svd {svd}"
 
         defaults = {
             "lr": lr,
@@ -131,8 +155,11 @@ class AdamW(Optimizer):
             "eps": eps,
             "weight_decay": weight_decay,
             "correct_bias": correct_bias,
+            "svd": svd,
         }
         super().__init__(params, defaults)
+        self.async_refresh = async_refresh and torch.cuda.is_available()
+        self._refresh_stream = torch.cuda.Stream() if self.async_refresh else None
 
     @torch.no_grad()
     def step(self, closure: Callable = None):
@@ -144,114 +171,142 @@ class AdamW(Optimizer):
         """
         loss = None
         if closure is not None:
-            loss = closure()
+            with torch.enable_grad():
+                loss = closure()
 
-        p: Tensor
         for group in self.param_groups:
+            buckets = defaultdict(list)
             for p in group["params"]:
                 if p.grad is None:
                     continue
-                grad = p.grad
-                if grad.is_sparse:
+                if p.grad.is_sparse:
                     raise RuntimeError(
                         "Adam does not support sparse gradients, please consider SparseAdam instead"
                     )
-
-                state = self.state[p]
-
-                if "step" not in state:
-                    state["step"] = 0
-
-                # GaLore Projection
-                if "rank" in group:
-                    if "projector" not in state:
-                        state["projector"] = GaLoreProjector(
-                            group["rank"],
-                            update_proj_gap=group["update_proj_gap"],
-                            scale=group["scale"],
-                            proj_type=group["proj_type"],
-                        )
-
-                    grad = state["projector"].project(grad, state["step"])
-
-                # State initialization
-                if "exp_avg" not in state:
-                    # Exponential moving average of gradient values
-                    state["exp_avg"] = torch.zeros_like(grad)
-                    # Exponential moving average of squared gradient values
-                    state["exp_avg_sq"] = torch.zeros_like(grad)
-
-                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
-                beta1, beta2 = group["betas"]
-
-                state["step"] += 1
-
-                # Decay the first and second moment running average coefficient
-                # In-place operations to update the averages at the same time
-                exp_avg.mul_(beta1).add_(grad, alpha=(1.0 - beta1))
-                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1.0 - beta2)
-                denom = exp_avg_sq.sqrt().add_(group["eps"])
-
-                step_size = group["lr"]
-                if group["correct_bias"]:  # No bias correction for Bert
-                    bias_correction1 = 1.0 - beta1 ** state["step"]
-                    bias_correction2 = 1.0 - beta2 ** state["step"]
-                    step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
-
-                # compute norm gradient
-                norm_grad = exp_avg / denom
-
-                # GaLore Projection Back
-                if "rank" in group:
-                    norm_grad = state["projector"].project_back(norm_grad)
-
-                p.add_(norm_grad, alpha=-step_size)
-
-                # Just adding the square of the weights to the loss function is *not*
-                # the correct way of using L2 regularization/weight decay with Adam,
-                # since that will interact with the m and v parameters in strange ways.
-                #
-                # Instead we want to decay the weights in a manner that doesn't interact
-                # with the m/v parameters. This is equivalent to adding the square
-                # of the weights to the loss with plain (non-momentum) SGD.
-                # Add weight decay at the end (fixed version)
-                if group["weight_decay"] > 0.0:
-                    p.add_(p, alpha=(-group["lr"] * group["weight_decay"]))
+                # projected params share one batched matmul per shape,
+                # the rest only has to agree on device / dtype for foreach
+                key = (p.device, p.dtype, tuple(p.shape) if "rank" in group else None)
+                buckets[key].append(p)
+            for params in buckets.values():
+                self._step_bucket(group, params)
 
         return loss
 
+    def _refresh(self, group: dict, params: list[Tensor], grads: Tensor, side: str):
+        prev = [self.state[p].get("projector") for p in params]
+        prev = torch.stack(prev) if all(b is not None for b in prev) else None
+
+        def compute():
+            basis = orthogonal_basis(grads, group["rank"], side, group["svd"], prev=prev)
+            return basis.to(params[0].dtype).unbind(0)
+
+        if not self.async_refresh or prev is None:
+            for p, basis in zip(params, compute()):
+                self.state[p]["projector"] = basis
+            return
+
+        stream = self._refresh_stream
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            pending = compute()
+        grads.record_stream(stream)
+        prev.record_stream(stream)
+        for p, basis in zip(params, pending):
+            self.state[p]["pending_projector"] = basis
+
+    def _step_bucket(self, group: dict, params: list[Tensor]):
+        beta1, beta2 = group["betas"]
+        galore = "rank" in group
+        grads = [p.grad for p in params]
+
+        if galore:
+            side = projection_side(params[0].shape, group.get("proj_type", "std"))
+            if self.async_refresh and "pending_projector" in self.state[params[0]]:
+                torch.cuda.current_stream().wait_stream(self._refresh_stream)
+                for p in params:
+                    self.state[p]["projector"] = self.state[p].pop("pending_projector")
+            stacked = torch.stack(grads)
+            step = self.state[params[0]].get("step", 0)
+            if "projector" not in self.state[params[0]] or step % group.get("update_proj_gap", 200) == 0:
+                self._refresh(group, params, stacked, side)
+            basis = torch.stack([self.state[p]["projector"] for p in params])
+            grads = project(stacked, basis, side).unbind(0)
+
+        grads = [g.float() for g in grads]
+        for p, g in zip(params, grads):
+            state = self.state[p]
+            if "exp_avg" not in state:
+                state["step"] = 0
+                # Exponential moving average of gradient values and squared gradient values
+                state["exp_avg"] = torch.zeros_like(g)
+                state["exp_avg_sq"] = torch.zeros_like(g)
+            state["step"] += 1
+
+        exp_avgs = [self.state[p]["exp_avg"] for p in params]
+        exp_avg_sqs = [self.state[p]["exp_avg_sq"] for p in params]
+
+        # Decay the first and second moment running average coefficient
+        torch._foreach_lerp_(exp_avgs, grads, 1.0 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1.0 - beta2)
+        denom = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_add_(denom, group["eps"])
+        updates = torch._foreach_div(exp_avgs, denom)
+
+        # GaLore Projection Back
+        if galore:
+            updates = project_back(torch.stack(updates), basis.float(), side) * group.get("scale", 1.0)
+            updates = updates.unbind(0)
+
+        step_sizes = []
+        for p in params:
+            step_size = group["lr"]
+            if group["correct_bias"]:  # No bias correction for Bert
+                step = self.state[p]["step"]
+                step_size = step_size * math.sqrt(1.0 - beta2**step) / (1.0 - beta1**step)
+            step_sizes.append(-step_size)
+        updates = torch._foreach_mul(updates, step_sizes)
+
+        # decoupled weight decay, applied before the update as torch.optim.AdamW does
+        if group["weight_decay"] > 0.0:
+            torch._foreach_mul_(params, 1.0 - group["lr"] * group["weight_decay"])
+        torch._foreach_add_(params, [u.to(p.dtype) for u, p in zip(updates, params)])
+
 
 if __name__ == "__main__":
+    from torch.utils.benchmark import Timer
+
     torch.manual_seed(0)
-    rank: int = 2
-    verbose: bool = False
-    update_proj_gap: int = 200
-    scale: float = 1
-    proj_type: str = "std"
-    projector = GaLoreProjector(rank, verbose, update_proj_gap, scale, proj_type)
-    print(projector.ortho_matrix)
-    linear = nn.Linear(6, 5, bias=False)
-    params = linear.parameters()
-    x = torch.rand(50, 6)
-    y: Tensor = linear(x)
-    y.tanh().sum().backward()
-
-    # ret = projector.project(linear.weight.grad,0)
-    # print(ret)
-
-    xgrad = torch.rand(linear.weight.shape)
-    projector.project(torch.rand(linear.weight.shape), 0)
-    import os
-    import time
-
-    for step in range(2, 1000):
-        os.system("clear")
-        print(f"------------------------")
-        ret = projector.project(xgrad, step)
-        print(ret)
-        print(f"---------{step}---------")
-        time.sleep(0.1)
-        bk = projector.project_back(ret)
-
-        print(bk)
-        exit(0)
+
+    # the projector keeps the dominant subspace: projecting a rank-r matrix loses nothing
+    low_rank = torch.randn(64, 4) @ torch.randn(4, 32)
+    for svd in ("full", "randomized", "subspace"):
+        projector = GaLoreProjector(rank=4, svd=svd)
+        back = projector.project_back(projector.project(low_rank, 0))
+        assert torch.allclose(back, low_rank, atol=1e-3), svd
+
+    def layers(num_layers: int = 12, dim: int = 512) -> nn.Module:
+        torch.manual_seed(0)
+        return nn.Sequential(*[nn.Linear(dim, dim) for _ in range(num_layers)])
+
+    def galore_groups(model: nn.Module, rank: int = 64) -> list[dict]:
+        matrices = [p for p in model.parameters() if p.dim() == 2]
+        others = [p for p in model.parameters() if p.dim() != 2]
+        return [{"params": matrices, "rank": rank, "update_proj_gap": 10, "scale": 0.25}, {"params": others}]
+
+    # step time against plain AdamW, grads are fixed so only the optimizer is timed
+    optimizers = {
+        "torch AdamW (foreach)": lambda m: torch.optim.AdamW(m.parameters(), lr=1e-3, foreach=True),
+        "galore full svd": lambda m: AdamW(galore_groups(m), svd="full"),
+        "galore randomized svd": lambda m: AdamW(galore_groups(m), svd="randomized"),
+        "galore subspace iteration": lambda m: AdamW(galore_groups(m), svd="subspace"),
+    }
+    for name, build in optimizers.items():
+        model = layers()
+        for p in model.parameters():
+            p.grad = torch.randn_like(p)
+        opt = build(model)
+        opt.step()
+        # every 10th step refreshes the projectors, time a full period
+        timer = Timer("for _ in range(10): opt.step()", globals={"opt": opt})
+        print(f"{name:28s} {timer.blocked_autorange(min_run_time=1).median * 100:8.3f} ms / step")
@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -9,13 +11,47 @@ from torch import Tensor
 class XLinear(nn.Linear):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # folded (weight, bias) for inference, keyed on the weight / bias versions,
+        # any in place update (optimizer step, load_state_dict) invalidates it
+        self._folded: tuple[tuple, Tensor, Tensor | None] | None = None
 
-    def forward(self, x: Tensor) -> Tensor:
+    def normalized(self) -> tuple[Tensor, Tensor]:
+        "unit norm rows and the norm of each normalized row the output is scaled by"
         w = self.weight
         norm = w.square().sum(dim=-1, keepdim=True).sqrt()
         w = w / norm
-        output = nn.functional.linear(x, w, self.bias)
-        return output * w.square().sum(dim=-1).sqrt()
+        return w, w.square().sum(dim=-1).sqrt()
+
+    def folded(self) -> tuple[Tensor, Tensor | None]:
+        "weight and bias of the plain linear with the same output, normalization and scale folded in"
+        bias = self.bias
+        weight = self.weight
+        key = (weight._version, bias._version if bias is not None else None, weight.device, weight.dtype)
+        if self._folded is None or self._folded[0] != key:
+            with torch.no_grad():
+                w, scale = self.normalized()
+                bias = bias * scale if bias is not None else None
+                self._folded = (key, w * scale.unsqueeze(-1), bias)
+        return self._folded[1], self._folded[2]
+
+    def forward(self, x: Tensor) -> Tensor:
+        if torch.is_grad_enabled() and self.weight.requires_grad:
+            # training, normalize every step so gradients flow through the norm
+            w, scale = self.normalized()
+            output = nn.functional.linear(x, w, self.bias)
+            return output * scale
+        return nn.functional.linear(x, *self.folded())
+
+    def export(self) -> nn.Linear:
+        "plain nn.Linear for serving"
+        w, bias = self.folded()
+        linear = nn.Linear(self.in_features, self.out_features, bias=bias is not None)
+        linear = linear.to(w.device, w.dtype)
+        with torch.no_grad():
+            linear.weight.copy_(w)
+            if bias is not None:
+                linear.bias.copy_(bias)
+        return linear
 
 
 def monkey_patch_model(model: nn.Module, target_layers):
@@ -28,3 +64,28 @@ def monkey_patch_model(model: nn.Module, target_layers):
             )
         else:
             monkey_patch_model(module, target_layers)
+
+
+def export_model(model: nn.Module) -> nn.Module:
+    "replace every XLinear with its exported nn.Linear, in place"
+    for name, module in model.named_children():
+        if isinstance(module, XLinear):
+            setattr(model, name, module.export())
+        else:
+            export_model(module)
+    return model
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    layer = XLinear(64, 32)
+    x = torch.randn(4, 64)
+    train_out = layer(x)
+    with torch.no_grad():
+        assert torch.allclose(layer(x), train_out, atol=1e-6)
+        assert torch.allclose(layer.export()(x), train_out, atol=1e-6)
+        # an in place update invalidates the cached weight
+        layer.weight.mul_(2).add_(0.1)
+        cached = layer(x)
+    assert torch.allclose(cached, layer(x), atol=1e-6)  # training path, normalized on the fly
+    print("ok")
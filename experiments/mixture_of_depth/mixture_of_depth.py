@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -9,7 +11,7 @@ import ohara.models.llama as llama
 from ohara.modules.mlp import SwiGLU, MLP
 from ohara.modules.moe import MoE
 from ohara.modules.norm import RMSNorm
-from ohara.embedings_pos.rotatry import precompute_freqs_cis
+from ohara.embedings_pos.rotatry import rope_cache
 
 
 from huggingface_hub import PyTorchModelHubMixin
@@ -30,6 +32,9 @@ class Config(llama.Config):
     moe_num_experts_per_tok: int = 2
 
     mixture_of_depth: bool = True
+    # weight of the block output for routed tokens, "softmax" over the top-k as in the
+    # paper or "sigmoid" of each router logit, which is causal and so exact at decode time
+    router_weight: str = "softmax"  # softmax, sigmoid
 
     model_type: str = "mixture_of_depth"
     sliding_window_attention = False
@@ -64,12 +69,26 @@ class Block(nn.Module):
         if cfg.ffn == "swiglu":
             return SwiGLU(cfg.d_model, cfg.hidden_dim, cfg.dropout)
 
-    def forward(self, x, mask, freqs_cis, **kwargs):
-        x = x + self.attn(self.norm1(x), mask, freqs_cis)
+    def forward(self, x, mask, freqs_cis, kv_cache=None, position_ids=None, **kwargs):
+        x = x + self.attn(self.norm1(x), mask, freqs_cis, kv_cache, position_ids)
         x = x + self.ff(self.norm2(x))
         return x, None
 
 
+class MoDKVCache:
+    """
+    cache of one MoD layer: every row only keeps the tokens it routed through the
+    block, so rows grow at their own pace. `length` is the number of cached tokens
+    per row, which is also the (compacted) rope position of the next routed token.
+    """
+
+    def __init__(self, batch_size: int, max_seq_len: int, num_kv_heads: int, head_dim: int, device=None, dtype=None):
+        shape = (1, max_seq_len, num_kv_heads, head_dim)
+        self.rows = [llama.KVCache(shape, max_seq_len, device=device, dtype=dtype) for _ in range(batch_size)]
+        self.length = [0] * batch_size
+        self.seen = 0  # tokens per row the layer was asked about, routed or not
+
+
 class MoD(nn.Module):
     """
     Paper: https://arxiv.org/abs/2404.02258
@@ -81,6 +100,9 @@ class MoD(nn.Module):
         self.capacity_factor = cfg.capacity_factor
         self.dim = cfg.d_model
 
+        self.router_weight = cfg.router_weight
+        self.rope = rope_cache(cfg.d_model // cfg.num_heads)
+
         self.transformer_decoder_block = Block(cfg)
         self.router = nn.Linear(self.dim, 1, bias=False)
         self.aux_router = nn.Sequential(
@@ -127,10 +149,12 @@ class MoD(nn.Module):
         # I tried replacing it with sigmoid and too my surprise it "works"
         # I suspect author did not use it because they are using jax, jax does funny things
         # ...
-        token_weights = F.softmax(
-            token_weights, dim=1
-        )  # <<<== use this if you want execact paper replication
-        # token_weights = F.sigmoid(token_weights)
+        if self.router_weight == "sigmoid":
+            token_weights = F.sigmoid(token_weights)
+        else:
+            token_weights = F.softmax(
+                token_weights, dim=1
+            )  # <<<== use this if you want execact paper replication
         r_weights = torch.gather(token_weights, dim=1, index=index)
 
         # muliply by router weights, this add router in gradient stream
@@ -162,12 +186,41 @@ class MoD(nn.Module):
         # so binary_cross_entropy_with_logits == sigmoid + bce_loss
         return F.binary_cross_entropy_with_logits(aux_router_logits.view(-1), router_targets)
 
-    def inference(self, x: Tensor, *args, **kwargs):
+    @torch.no_grad()
+    def inference(
+        self, x: Tensor, mask: Tensor | None = None, kv_cache: MoDKVCache | None = None, threshold: float = 0.5
+    ) -> Tensor:
+        """
+        causal routing for generation, Page 7, Section 3.5: top-k over the sequence needs
+        future tokens, so the aux router decides per token (sigmoid > threshold) and
+        skipped tokens go to the next layer untouched, no attention, no mlp, no cache entry.
+
+        Routed tokens attend to the earlier routed tokens of their row at compacted
+        positions, same as the gathered tokens see each other in training.
+        kv_cache None runs the whole sequence, otherwise x holds the new tokens only.
+        Block outputs are weighted by sigmoid(router logit), exact for router_weight="sigmoid"
+        models, the closest causal stand in for the softmax over the top-k otherwise.
+        """
         batch_size, seq_len, dim = x.shape
-        top_k = int(seq_len * self.capacity_factor)
-
-        router_logits = self.router(x)
-        assert False, "TODO: will implement inference soon"
+        route = F.sigmoid(self.aux_router(x)).squeeze(-1) > threshold  # batch, seq_len
+        out = x.clone()
+        # rows route different tokens, so each row runs the block on its own tokens
+        for row, index in enumerate(route.unbind(0)):
+            index = index.nonzero().squeeze(-1)
+            start = 0 if kv_cache is None else kv_cache.length[row]
+            num_tokens = index.numel()
+            if num_tokens == 0:
+                continue
+            h = x[row : row + 1, index]
+            freqs_cis = self.rope.get(start + num_tokens, start, dtype=x.dtype, device=x.device)
+            cache = None if kv_cache is None else kv_cache.rows[row]
+            h_out, _ = self.transformer_decoder_block(h, mask if start == 0 else None, freqs_cis, cache, start)
+            out[row, index] += (F.sigmoid(self.router(h)) * h_out)[0]
+            if kv_cache is not None:
+                kv_cache.length[row] += num_tokens
+        if kv_cache is not None:
+            kv_cache.seen += seq_len
+        return out
 
 
 class TranformerDecoder(nn.Module):
@@ -198,23 +251,29 @@ class TranformerDecoder(nn.Module):
 
         self.token_emb.weight = self.vocab_proj.weight
 
-        self.cis = precompute_freqs_cis(cfg.d_model // cfg.num_heads, cfg.seq_len * 2)
+        self.rope = rope_cache(cfg.d_model // cfg.num_heads)
 
-        if hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        # sdpa runs causal without a mask, the mask is only for the slow path
+        if not hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+            print("WARNING: using slow attention | upgrade pytorch to 2.0 or above")
             mask = torch.full((1, 1, cfg.seq_len, cfg.seq_len), float("-inf"))
             mask = torch.triu(mask, diagonal=1)
             self.register_buffer("mask", mask)
         else:
-            print("WARNING: using slow attention | upgrade pytorch to 2.0 or above")
             self.mask = None
+            self._register_load_state_dict_pre_hook(self._drop_mask_buffer)
 
         self.apply(self._init_weights)
 
+    @staticmethod
+    def _drop_mask_buffer(state_dict, prefix, *args):
+        # older checkpoints saved the causal mask as a buffer
+        state_dict.pop(f"{prefix}mask", None)
+
     def forward(self, x: torch.Tensor, auxiliary_loss: bool = False, *args, **kwargs):
         batch, seqlen = x.shape
         x = self.token_emb(x)
-        device = self.token_emb.weight.device
-        freqs_cis = self.cis[0][:seqlen].to(device), self.cis[1][:seqlen].to(device)
+        freqs_cis = self.rope.get(seqlen, dtype=x.dtype, device=x.device)
         aux_loss = torch.tensor(0.0).to(x.device)
         for layer in self.layers:
             x, aloss = layer(x, self.mask, freqs_cis, auxiliary_loss=auxiliary_loss)
@@ -226,6 +285,48 @@ class TranformerDecoder(nn.Module):
             return x, aux_loss
         return x
 
+    @torch.no_grad()
+    def inference(
+        self, x: torch.Tensor, kv_cache: list | None = None, position_ids: int = 0, threshold: float = 0.5
+    ) -> torch.Tensor:
+        """
+        causal forward with per token routing (MoD.inference), same calling convention
+        as LLAMA with a regular cache: x is the full sequence, position_ids the number of
+        tokens already in kv_cache (from build_kv_cache). Without a cache the whole
+        sequence runs and matches a cached prefill + token by token decode.
+        """
+        start = 0
+        if kv_cache is not None:
+            x = x[:, position_ids:]
+            start = position_ids
+        x = self.token_emb(x)
+        mask = self.mask if start == 0 else None
+        freqs_cis = self.rope.get(start + x.shape[1], start, dtype=x.dtype, device=x.device)
+        for idx, layer in enumerate(self.layers):
+            cache = kv_cache[idx] if kv_cache is not None else None
+            if isinstance(layer, MoD):
+                x = layer.inference(x, mask, cache, threshold)
+            else:
+                x, _ = layer(x, mask, freqs_cis, cache, start)
+        x = self.norm(x)
+        x = self.vocab_proj(x)
+        return x
+
+    def build_kv_cache(self, batch_size: int = 1) -> list:
+        """llama KVCache for the dense layers, MoDKVCache for the MoD ones"""
+        attn = self.layers[-1].attn
+        dtype = self.token_emb.weight.dtype
+        device = self.token_emb.weight.device
+        seq_len = self.config.seq_len
+        kv_cache = []
+        for idx, layer in enumerate(self.layers):
+            if isinstance(layer, MoD):
+                kv_cache.append(MoDKVCache(batch_size, seq_len, attn.num_kv_heads, attn.head_dim, device, dtype))
+            else:
+                shape = (batch_size, seq_len, attn.num_kv_heads, attn.head_dim)
+                kv_cache.append(llama.KVCache(shape, seq_len, idx, device=device, dtype=dtype))
+        return kv_cache
+
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
@@ -243,6 +344,33 @@ class ModelingMixtureOfDepth(PyTorchModelHubMixin, L.LightningModule):
 
     def forward(self, x: torch.Tensor, mode: str = "train", **kwargs) -> torch.Tensor:
         if mode == "inference":
-            return self.model.inference(x)
+            return self.model.inference(x, **kwargs)
         else:
             return self.model(x, **kwargs)
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    config = Config(
+        vocab_size=128, seq_len=64, d_model=64, hidden_dim=128, num_heads=4, num_kv_heads=2, dropout=0.0
+    )
+    model = TranformerDecoder(config).eval()
+    tokens = torch.randint(0, config.vocab_size, (2, 40))
+
+    # training forward still runs with the gathered top-k tokens
+    logits, aux_loss = model(tokens, auxiliary_loss=True)
+    assert logits.shape == (2, 40, config.vocab_size)
+
+    # prefill + token by token decode matches the full causal inference forward
+    full = model.inference(tokens)
+    kv_cache = model.build_kv_cache(batch_size=2)
+    steps = [model.inference(tokens[:, :16], kv_cache, 0)]
+    for t in range(16, tokens.size(1)):
+        steps.append(model.inference(tokens[:, : t + 1], kv_cache, t))
+    cached = torch.cat(steps, dim=1)
+    assert torch.allclose(full, cached, atol=1e-4), (full - cached).abs().max()
+
+    for idx, cache in enumerate(kv_cache):
+        if isinstance(cache, MoDKVCache):
+            print(f"layer {idx}: routed {cache.length} of {cache.seen} tokens per row")
+    print("ok")
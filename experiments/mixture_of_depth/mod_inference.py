@@ -1,46 +1,116 @@
+from __future__ import annotations
+
 import time
-from mixture_of_depth import ModelingMixtureOfDepth, MoD
-from transformers import AutoTokenizer
-from ohara.utils import auto_accelerator
+from dataclasses import fields
+
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 from torch import Tensor
+from transformers import AutoTokenizer
 
+import ohara.models.llama as llama
+from ohara.sampling import sample
+from ohara.utils import auto_accelerator
+
+from mixture_of_depth import ModelingMixtureOfDepth, MoD
+
+# cached generation with per token routing against a dense llama of the same size:
+# same width, depth and attention, but every token goes through every layer.
+# flops are the matmuls of the decoder layers, embedding and lm head are the same for both.
+# decode routes with the aux router and weights blocks by sigmoid(router logit), which is
+# only the trained model for router_weight="sigmoid". The divergence from the training
+# forward (top-k over the whole sequence) on the generated text is reported as well.
 
 device = auto_accelerator("cpu")
 
 tokenizer_name = "EleutherAI/gpt-neo-125m"
 model_name = "joey00072/mixture-of-depth-TRex-320.0M"
+max_new_tokens = 128
 tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
-model = ModelingMixtureOfDepth.from_pretrained(model_name).to(device)
+model = ModelingMixtureOfDepth.from_pretrained(model_name).to(device).eval()
+mod = model.model
+config = mod.config
+
+llama_config = llama.Config(**{f.name: getattr(config, f.name) for f in fields(llama.Config)})
+llama_config.dropout = 0.0
+dense = llama.LLAMA(llama_config).to(device).eval()
+
+
+@torch.no_grad()
+def generate(forward, kv_cache: list, inputs: Tensor, max_new_tokens: int) -> Tensor:
+    position = 0
+    for _ in range(max_new_tokens):
+        logits = forward(inputs, kv_cache, position)
+        position = inputs.size(1)
+        inputs = torch.cat([inputs, sample(logits[:, -1])], dim=1)
+    return inputs
+
+
+def num_params(module: nn.Module) -> int:
+    return sum(p.numel() for p in module.parameters())
+
+
+def attention_flops(num_tokens: int) -> int:
+    "q @ k^T and attn @ v for tokens 1..num_tokens, each attending to itself and the ones before"
+    return 4 * config.d_model * num_tokens * (num_tokens + 1) // 2
+
+
+def block_flops(block: nn.Module, num_tokens: int) -> int:
+    return 2 * num_params(block) * num_tokens + attention_flops(num_tokens)
+
+
+def timed(fn) -> tuple[Tensor, float]:
+    fn()  # warmup
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    out = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - start
 
 
 prompt = "There is an apple on the"
 x: Tensor = tokenizer(prompt, return_tensors="pt").input_ids.to(device)
-print(f"1. {x.shape=}")
-batch, seqlen = x.shape
+num_tokens = x.size(1) + max_new_tokens - 1  # the last sampled token is never fed back
 
-x = model.model.token_emb(x)
-print(f"2. {x.shape=}")
+kv_cache = []
 
-mod1 = model.model.layers[0]
-freqs_cis = model.model.cis[0][:seqlen].to(device), model.model.cis[1][:seqlen].to(device)
-mask = model.model.mask
-cos, isin = freqs_cis
-print(f"2.1 {cos.shape=}, {isin.shape=}")
 
+def run_mod():
+    kv_cache[:] = mod.build_kv_cache()
+    return generate(mod.inference, kv_cache, x, max_new_tokens)
 
-def inference(self: MoD, x: Tensor, *args, **kwargs):
-    batch_size, seq_len, dim = x.shape
 
-    router_logits = self.router(x)
-    print(f"router_logits: {router_logits.reshape(-1).softmax(dim=-1)}")
+out, mod_seconds = timed(run_mod)
+_, dense_seconds = timed(lambda: generate(dense, dense.build_kv_cache(), x, max_new_tokens))
+print(tokenizer.decode(out[0]))
 
-    aux_logits = F.sigmoid(self.aux_router(x))
-    print(f"aux_logits: {aux_logits.reshape(-1)}")
-    mask = (aux_logits > 0.5).int()
-    print(f"mask: {mask.reshape(-1)=}")
+dense_flops = sum(block_flops(layer, num_tokens) for layer in dense.layers)
+mod_flops = 0
+for layer, cache in zip(mod.layers, kv_cache):
+    if isinstance(layer, MoD):
+        routed = cache.length[0]
+        print(f"routed {routed:4d} / {cache.seen} tokens ({routed / cache.seen:.0%})")
+        mod_flops += 2 * num_params(layer.aux_router) * num_tokens
+        mod_flops += 2 * num_params(layer.router) * routed + block_flops(layer.transformer_decoder_block, routed)
+    else:
+        mod_flops += block_flops(layer, num_tokens)
 
+# causal routing vs the training forward on the same tokens, next token distributions
+with torch.no_grad():
+    train_logits = mod(out).float()
+    decode_logits = mod.inference(out).float()
+kl = torch.nn.functional.kl_div(
+    decode_logits.log_softmax(-1), train_logits.log_softmax(-1), log_target=True, reduction="none"
+).sum(-1)
+agree = (train_logits.argmax(-1) == decode_logits.argmax(-1)).float().mean()
+router_weight = getattr(config, "router_weight", "softmax")
+if router_weight != "sigmoid":
+    print(f"NOTE: checkpoint trained with router_weight={router_weight!r}, decode outputs are approximate")
+print(f"vs training forward: top-1 agreement {agree:.1%}, mean KL {kl.mean():.4f} nats/token")
 
-x = inference(mod1, x, mask, freqs_cis)
+print(f"{'model':8s} {'GFLOPs':>10s} {'seconds':>10s} {'tok/s':>10s}")
+print(f"{'dense':8s} {dense_flops / 1e9:10.2f} {dense_seconds:10.3f} {max_new_tokens / dense_seconds:10.1f}")
+print(f"{'mod':8s} {mod_flops / 1e9:10.2f} {mod_seconds:10.3f} {max_new_tokens / mod_seconds:10.1f}")
+print(f"flops {mod_flops / dense_flops:.0%} of dense, latency {mod_seconds / dense_seconds:.0%} of dense")
@@ -1,39 +1,334 @@
 from __future__ import annotations
 
 import torch
-import os
-import numpy as np
-from sklearn.preprocessing import normalize
-from k_means_constrained import KMeansConstrained
+import torch.nn as nn
+import torch.nn.functional as F
 
 from torch import Tensor
 from dataclasses import dataclass
+from collections.abc import Iterable
+
+### dense FFN -> MoE, MoEfication: https://arxiv.org/abs/2110.01786
+# The hidden units of a trained FFN are split into equal sized groups with balanced
+# k-means on their input weight rows. Every group is one expert (its rows of gate / up
+# and columns of down), so running all experts and adding their outputs is exactly the
+# dense block. The router is fit on calibration activations to predict, from the block
+# input, which experts have the largest hidden activations.
+#
+# MoE / DSMoE weight the top k experts with weights that sum to 1, so the down
+# projections of routed experts are scaled by num_experts_per_tok: with equal router
+# weights the chosen experts add up like they do in the dense block.
 
 
 @dataclass
 class ModelConfig:
     filename: str
-    folder: str
-    split_num: int = 8
+    output: str
+    num_layers: int
+    num_experts: int = 8
+    num_experts_per_tok: int = 2
+    num_shared_experts: int = 0  # > 0 writes a DSMoE checkpoint, the most active clusters are shared
+    prefix: str = "layers.{}.ff"  # dense block of layer i
+    in_projs: tuple[str, ...] = ("gate", "up")
+    out_proj: str = "down"
+    kmeans_iters: int = 25
+    layers_per_pass: int | None = None  # None clusters all layers in one batch
+    ridge: float = 1e-3
+    device: str = "cpu"
+
+    @property
+    def split_num(self) -> int:
+        return self.num_experts + self.num_shared_experts
+
+
+def load_checkpoint(filename: str) -> dict[str, Tensor]:
+    "memory mapped, a tensor is only read from disk when it is used"
+    return torch.load(filename, map_location="cpu", mmap=True, weights_only=True)
+
+
+def ffn_weights(state_dict: dict[str, Tensor], config: ModelConfig, layer: int) -> dict[str, Tensor]:
+    "{proj}.weight / {proj}.bias of one dense block, a fused gate_up is split"
+    prefix = config.prefix.format(layer)
+    weights = {}
+    for kind in ("weight", "bias"):
+        fused = state_dict.get(f"{prefix}.gate_up.{kind}")
+        if fused is not None:  # SwiGLU(fused=True)
+            weights[f"gate.{kind}"], weights[f"up.{kind}"] = fused.chunk(2, dim=0)
+        for name in (*config.in_projs, config.out_proj):
+            if f"{prefix}.{name}.{kind}" in state_dict:
+                weights[f"{name}.{kind}"] = state_dict[f"{prefix}.{name}.{kind}"]
+    return weights
+
+
+def neuron_features(weights: dict[str, Tensor], config: ModelConfig) -> Tensor:
+    "(hidden_dim, len(in_projs) * dim), one row per hidden unit, every projection l2 normalized"
+    return torch.cat([F.normalize(weights[f"{name}.weight"].float(), dim=-1) for name in config.in_projs], dim=-1)
+
+
+def balanced_assign(scores: Tensor) -> Tensor:
+    """
+    scores (B, N, K) -> labels (B, N), every cluster gets exactly N / K points.
+
+    Rounds of proposals: every unassigned point proposes to its best cluster that still
+    has room, a cluster keeps its best proposers up to its room. A cluster either takes
+    all of its proposers or fills up, so it is done in at most K rounds of batched ops.
+    """
+    batch, num_points, num_clusters = scores.shape
+    assert num_points % num_clusters == 0, f"{num_points} points do not split into {num_clusters} equal clusters"
+    labels = scores.new_full((batch, num_points), -1, dtype=torch.long)
+    room = scores.new_full((batch, num_clusters), num_points // num_clusters, dtype=torch.long)
+    for _ in range(num_clusters):
+        pending = labels < 0
+        if not pending.any():
+            break
+        open_scores = scores.masked_fill(room.unsqueeze(1) == 0, float("-inf"))
+        best, choice = open_scores.max(dim=-1)
+        # rank of every proposer among the proposers of the same cluster, best first
+        order = best.masked_fill(~pending, float("-inf")).argsort(dim=1, descending=True)
+        proposals = F.one_hot(choice.gather(1, order), num_clusters) * pending.gather(1, order).unsqueeze(-1)
+        rank = (proposals.cumsum(dim=1) * proposals).sum(dim=-1) - 1
+        accepted = (proposals.sum(dim=-1) > 0) & (rank < room.gather(1, choice.gather(1, order)))
+        accepted = torch.zeros_like(pending).scatter(1, order, accepted)
+        labels = torch.where(accepted, choice, labels)
+        room -= (F.one_hot(choice, num_clusters) * accepted.unsqueeze(-1)).sum(dim=1)
+    return labels
+
+
+@torch.no_grad()
+def balanced_kmeans(x: Tensor, num_clusters: int, iters: int = 25, seed: int = 0) -> Tensor:
+    "x (B, N, D), B independent problems (layers) in one batch -> labels (B, N)"
+    batch, num_points, dim = x.shape
+    generator = torch.Generator(x.device).manual_seed(seed)
+    init = torch.rand(batch, num_points, generator=generator, device=x.device).argsort(dim=1)[:, :num_clusters]
+    centroids = x.gather(1, init.unsqueeze(-1).expand(-1, -1, dim))
+    labels = None
+    for _ in range(iters):
+        # -|x - c|^2 / 2 up to a per point constant
+        scores = x @ centroids.mT - 0.5 * centroids.pow(2).sum(dim=-1).unsqueeze(1)
+        new_labels = balanced_assign(scores)
+        if labels is not None and torch.equal(new_labels, labels):
+            break
+        labels = new_labels
+        onehot = F.one_hot(labels, num_clusters).to(x.dtype)
+        centroids = onehot.mT @ x / (num_points // num_clusters)
+    return labels
+
+
+def cluster_layers(state_dict: dict[str, Tensor], config: ModelConfig) -> Tensor:
+    "(num_layers, hidden_dim) cluster id of every hidden unit"
+    step = config.layers_per_pass or config.num_layers
+    labels = []
+    for start in range(0, config.num_layers, step):
+        layers = range(start, min(start + step, config.num_layers))
+        x = torch.stack([neuron_features(ffn_weights(state_dict, config, i), config) for i in layers])
+        labels.append(balanced_kmeans(x.to(config.device), config.split_num, config.kmeans_iters).cpu())
+    return torch.cat(labels)
+
+
+class RouterStats:
+    def __init__(self, dim: int, num_clusters: int, device: torch.device | str = "cpu"):
+        """
+        running normal equations of the router least squares fit, memory does not grow
+        with the number of calibration tokens.
+
+        targets are the log l2 norms of every cluster's hidden activations, centered per
+        token, so softmax(router(x)) is roughly each expert's share of the activation.
+        """
+        self.xtx = torch.zeros(dim, dim, dtype=torch.float64, device=device)
+        self.xty = torch.zeros(dim, num_clusters, dtype=torch.float64, device=device)
+        self.load = torch.zeros(num_clusters, dtype=torch.float64, device=device)
+        self.num_tokens = 0
+
+    def update(self, x: Tensor, norms: Tensor):
+        "x (T, dim) block inputs, norms (T, num_clusters)"
+        target = norms.clamp_min(1e-6).log()
+        target = target - target.mean(dim=-1, keepdim=True)
+        self.xtx += (x.mT @ x).double()
+        self.xty += (x.mT @ target).double()
+        self.load += norms.sum(dim=0).double()
+        self.num_tokens += x.size(0)
+
+    def fit(self, ridge: float = 1e-3) -> Tensor:
+        "-> (num_clusters, dim) router weight"
+        eye = torch.eye(self.xtx.size(0), dtype=self.xtx.dtype, device=self.xtx.device)
+        reg = ridge * self.xtx.diagonal().mean().clamp_min(1e-12)
+        return torch.linalg.solve(self.xtx + reg * eye, self.xty).mT.float()
+
+
+@torch.no_grad()
+def calibrate(model: nn.Module, batches: Iterable[Tensor], labels: Tensor, config: ModelConfig) -> list[RouterStats]:
+    """
+    run the dense model (eval mode, same weights as the checkpoint) on calibration
+    batches, hooks on every dense block collect the router statistics of its clusters
+    """
+    stats, inputs, hooks = [], {}, []
+    for layer in range(config.num_layers):
+        ffn = model.get_submodule(config.prefix.format(layer))
+        down = getattr(ffn, config.out_proj)
+        stats.append(RouterStats(down.out_features, config.split_num, down.weight.device))
+        onehot = F.one_hot(labels[layer], config.split_num).to(down.weight.device, torch.float)
+
+        def save_input(module, args, layer=layer):
+            inputs[layer] = args[0].reshape(-1, args[0].size(-1)).float()
+
+        def save_norms(module, args, layer=layer, onehot=onehot):
+            hidden = args[0].reshape(-1, args[0].size(-1)).float()
+            stats[layer].update(inputs.pop(layer), (hidden.pow(2) @ onehot).sqrt())
+
+        hooks.append(ffn.register_forward_pre_hook(save_input))
+        hooks.append(down.register_forward_pre_hook(save_norms))
+    try:
+        for batch in batches:
+            model(batch)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return stats
+
+
+def centroid_router(weights: dict[str, Tensor], labels: Tensor, config: ModelConfig) -> Tensor:
+    "router without calibration data: mean normalized first input projection row per cluster"
+    rows = F.normalize(weights[f"{config.in_projs[0]}.weight"].float(), dim=-1)
+    return F.one_hot(labels, config.split_num).float().mT @ rows / (labels.numel() // config.split_num)
+
+
+def moe_state_dict(
+    weights: dict[str, Tensor], labels: Tensor, router: Tensor, shared: list[int], config: ModelConfig
+) -> dict[str, Tensor]:
+    """
+    one layer, keys relative to the block prefix. Experts are in the nn.ModuleList layout
+    (experts.{i}.{proj}.weight), stacked experts load it as well.
+    MoE: gate + experts, DSMoE: + shared_experts and e_expert_biases
+    """
+    dtype = weights[f"{config.out_proj}.weight"].dtype
+
+    def expert(cluster: int, scale: float) -> dict[str, Tensor]:
+        units = (labels == cluster).nonzero().squeeze(-1)
+        out = {}
+        for name in config.in_projs:
+            out[f"{name}.weight"] = weights[f"{name}.weight"][units]
+            if f"{name}.bias" in weights:
+                out[f"{name}.bias"] = weights[f"{name}.bias"][units]
+        out[f"{config.out_proj}.weight"] = weights[f"{config.out_proj}.weight"][:, units] * scale
+        if f"{config.out_proj}.bias" in weights:
+            # added once by the dense block, every expert carries its share
+            out[f"{config.out_proj}.bias"] = weights[f"{config.out_proj}.bias"] * (scale / config.split_num)
+        return out
+
+    routed = [cluster for cluster in range(config.split_num) if cluster not in shared]
+    state_dict = {"gate.weight": router[routed].to(dtype)}
+    for idx, cluster in enumerate(routed):
+        for key, value in expert(cluster, config.num_experts_per_tok).items():
+            state_dict[f"experts.{idx}.{key}"] = value
+    for idx, cluster in enumerate(shared):
+        for key, value in expert(cluster, 1.0).items():
+            state_dict[f"shared_experts.{idx}.{key}"] = value
+    if shared:
+        state_dict["e_expert_biases"] = torch.zeros(config.num_experts, dtype=dtype)
+    return state_dict
+
+
+def convert(
+    state_dict: dict[str, Tensor],
+    config: ModelConfig,
+    model: nn.Module | None = None,
+    batches: Iterable[Tensor] | None = None,
+) -> dict[str, Tensor]:
+    """
+    dense checkpoint -> MoE / DSMoE checkpoint, every other tensor is kept as is.
+    Without a model and calibration batches the routers come from the cluster centroids.
+    """
+    labels = cluster_layers(state_dict, config)
+    stats = calibrate(model, batches, labels, config) if model is not None else None
+
+    prefixes = {config.prefix.format(layer) for layer in range(config.num_layers)}
+    converted = {key: value for key, value in state_dict.items() if key.rsplit(".", 2)[0] not in prefixes}
+    for layer in range(config.num_layers):
+        weights = ffn_weights(state_dict, config, layer)
+        if stats is None:
+            router = centroid_router(weights, labels[layer], config)
+            shared = list(range(config.num_shared_experts))
+        else:
+            router = stats[layer].fit(config.ridge).cpu()
+            shared = stats[layer].load.argsort(descending=True)[: config.num_shared_experts].tolist()
+        prefix = config.prefix.format(layer)
+        for key, value in moe_state_dict(weights, labels[layer], router, sorted(shared), config).items():
+            converted[f"{prefix}.{key}"] = value
+    return converted
+
+
+def make_moe(config: ModelConfig, model: nn.Module | None = None, batches: Iterable[Tensor] | None = None):
+    state_dict = load_checkpoint(config.filename)
+    torch.save(convert(state_dict, config, model, batches), config.output)
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import time
+
+    import ohara.models.llama as llama
+    from ohara.modules.moe import MoE
+
+    torch.manual_seed(0)
+
+    # balanced: every cluster the same size, one batch for all layers vs a loop
+    x = F.normalize(torch.randn(32, 2048, 256), dim=-1)
+    labels = balanced_kmeans(x, 8)
+    assert (torch.stack([torch.bincount(row, minlength=8) for row in labels]) == 2048 // 8).all()
+    start = time.perf_counter()
+    balanced_kmeans(x, 8)
+    batched = time.perf_counter() - start
+    start = time.perf_counter()
+    for layer in x:
+        balanced_kmeans(layer[None], 8)
+    looped = time.perf_counter() - start
+    print(f"k-means 32 layers: one batch {batched:.2f}s, layer by layer {looped:.2f}s")
 
+    cfg = llama.Config(vocab_size=256, seq_len=64, d_model=64, hidden_dim=256, num_heads=4, num_layers=2, dropout=0.0)
+    dense = llama.LLAMA(cfg).eval()
+    calibration = [torch.randint(0, cfg.vocab_size, (8, 64)) for _ in range(4)]
 
-def load_ffn_weight(filename: str, template: str, layer: int) -> np.ndarray:
-    model: dict[str, Tensor] = torch.load(filename, map_location="cpu")
-    key = template.format(layer)
-    return model[key].numpy()
+    with tempfile.TemporaryDirectory() as folder:
+        config = ModelConfig(
+            filename=os.path.join(folder, "dense.pt"),
+            output=os.path.join(folder, "moe.pt"),
+            num_layers=cfg.num_layers,
+            num_experts=8,
+            num_experts_per_tok=2,
+        )
+        torch.save(dense.state_dict(), config.filename)
+        make_moe(config, dense, calibration)
+        converted = torch.load(config.output, weights_only=True)
+        centroid = convert(load_checkpoint(config.filename), config)
 
+    def moe_layer(state_dict: dict[str, Tensor], layer: int) -> MoE:
+        moe = MoE(cfg.d_model, cfg.hidden_dim // config.num_experts, config.num_experts, config.num_experts_per_tok)
+        prefix = config.prefix.format(layer) + "."
+        moe.load_state_dict({k[len(prefix) :]: v for k, v in state_dict.items() if k.startswith(prefix)})
+        return moe.eval()
 
-def split_weights_into_experts(ffn_weight: np.ndarray, split_num: int) -> list[np.ndarray]:
-    ffn_weight_norm = normalize(ffn_weight)
-    kmeans = KMeansConstrained(
-        n_clusters=split_num,
-        size_min=ffn_weight.shape[0] // split_num,
-        size_max=ffn_weight.shape[0] // split_num,
-        random_state=0,
-    ).fit(ffn_weight_norm)
+    # inputs of the first block on held out tokens
+    inputs = []
+    hook = dense.layers[0].ff.register_forward_pre_hook(lambda module, args: inputs.append(args[0]))
+    with torch.no_grad():
+        dense(torch.randint(0, cfg.vocab_size, (8, 64)))
+    hook.remove()
+    h = inputs[0]
 
-    experts = [ffn_weight[kmeans.labels_ == i] for i in range(split_num)]
-    return experts
+    with torch.no_grad():
+        ref = dense.layers[0].ff(h)
+        moe = moe_layer(converted, 0)
+        # all experts, unweighted, are the dense block
+        everything = sum(expert(h) for expert in moe.experts) / config.num_experts_per_tok
+        assert torch.allclose(everything, ref, atol=1e-5), (everything - ref).abs().max()
 
+        def error(moe: MoE) -> float:
+            return ((moe(h) - ref).norm() / ref.norm()).item()
 
-## TODO: create router
+        random = moe_layer(converted, 0)
+        nn.init.normal_(random.gate.weight, std=cfg.d_model**-0.5)
+        print(f"top {config.num_experts_per_tok} of {config.num_experts} experts, relative error vs dense:")
+        print(f"  fitted router   {error(moe):.3f}")
+        print(f"  centroid router {error(moe_layer(centroid, 0)):.3f}")
+        print(f"  random router   {error(random):.3f}")
@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -14,7 +16,7 @@ from huggingface_hub import PyTorchModelHubMixin
 
 from collections import OrderedDict
 
-from pkv import Config, KAttention, Attention, PartialKVAttention
+from pkv import Config, KAttention, Attention, PartialKVAttention, PackedKVCache
 
 
 ATTENTION_MAP = {"attention": Attention, "k_is_v": KAttention, "partial_kv": PartialKVAttention}
@@ -37,8 +39,8 @@ class Block(nn.Module):
         self.norm1 = RMSNorm(config.d_model)
         self.norm2 = RMSNorm(config.d_model)
 
-    def forward(self, x, mask, freqs_cis):
-        x = x + self.attn(self.norm1(x), mask, freqs_cis)
+    def forward(self, x, mask, freqs_cis, kv_cache: PackedKVCache | None = None, start_pos: int = 0):
+        x = x + self.attn(self.norm1(x), mask, freqs_cis, kv_cache, start_pos)
         x = x + self.ff(self.norm2(x))
         return x
 
@@ -74,18 +76,35 @@ class Transformer(nn.Module):
 
         self.apply(self._init_weights)
 
-    def forward(self, x: torch.Tensor):
+    def forward(self, x: torch.Tensor, kv_cache: list[PackedKVCache] | None = None, position_ids: int = 0):
+        """
+        same cache convention as LLAMA: x is the full sequence and position_ids the
+        number of tokens already in kv_cache (from build_kv_cache)
+        """
+        start = 0
+        if kv_cache is not None:
+            x = x[:, position_ids:]
+            start = position_ids
         batch, seqlen = x.shape
         x = self.token_emb(x)
-        freqs_cis = self.freq_cos[:seqlen], self.freq_sin[:seqlen]
+        freqs_cis = self.freq_cos[start : start + seqlen], self.freq_sin[start : start + seqlen]
 
-        for layer in self.layers:
-            x = layer(x, self.mask, freqs_cis)
+        for idx, layer in enumerate(self.layers):
+            cache = kv_cache[idx] if kv_cache is not None else None
+            x = layer(x, self.mask, freqs_cis, cache, start)
 
         x = self.norm(x)
         x = self.vocab_proj(x)
         return x
 
+    def build_kv_cache(self, batch_size: int = 1) -> list[PackedKVCache]:
+        """one packed cache per layer, its layout depends on config.attention_type"""
+        dtype = self.token_emb.weight.dtype
+        device = self.token_emb.weight.device
+        return [
+            layer.attn.build_kv_cache(batch_size, self.config.seq_len, device, dtype) for layer in self.layers
+        ]
+
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
@@ -101,8 +120,8 @@ class ModelingLM(nn.Module, PyTorchModelHubMixin):
         self.config = config
         self.model = Transformer(self.config)
 
-    def forward(self, x: torch.Tensor):
-        return self.model(x)
+    def forward(self, x: torch.Tensor, kv_cache: list[PackedKVCache] | None = None, position_ids: int = 0):
+        return self.model(x, kv_cache, position_ids)
 
 
 if __name__ == "__main__":
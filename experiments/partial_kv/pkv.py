@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -43,6 +45,61 @@ class Config(OrderedDict):
             setattr(self, key, value)
 
 
+class PackedKVCache:
+    """
+    one (batch, max_seq_len, num_heads, width) buffer per layer, the parts an attention
+    caches (k and v, only k, or k_rope, s and v) sit side by side in the last dim, so
+    keys and values are strided views of the same memory and shared parts are stored once
+    """
+
+    def __init__(self, batch_size: int, max_seq_len: int, num_heads: int, width: int, device=None, dtype=None):
+        self.cache = torch.zeros(batch_size, max_seq_len, num_heads, width, device=device, dtype=dtype)
+        self.max_seq_length = max_seq_len
+
+    def forward(self, parts: list[Tensor], start_pos: int) -> Tensor:
+        "write (B, T, H, w) parts at start_pos -> (B, start_pos + T, H, width)"
+        bsz, T = parts[0].shape[:2]
+        offset = 0
+        for part in parts:
+            self.cache[:bsz, start_pos : start_pos + T, :, offset : offset + part.size(-1)] = part
+            offset += part.size(-1)
+        return self.cache[:bsz, : start_pos + T]
+
+    def nbytes(self) -> int:
+        return self.cache.numel() * self.cache.element_size()
+
+
+def pack(parts: list[Tensor], kv_cache: PackedKVCache | None, start_pos: int) -> Tensor:
+    "the same packed layout without a cache, one copy instead of a cat per k and v"
+    if kv_cache is None:
+        return torch.cat(parts, dim=-1)
+    return kv_cache.forward(parts, start_pos)
+
+
+def attention(q: Tensor, k: Tensor, v: Tensor, mask: Tensor | None, dropout_p: float, flash_attn: bool) -> Tensor:
+    """
+    causal attention of q (B, H, T, D) over k, v (B, H, S, D), the T queries are the
+    last T of the S positions (S > T after a cache prefix). mask is the slow path mask
+    """
+    seq_len, kv_len = q.size(2), k.size(2)
+    if flash_attn:
+        attn_mask = None
+        if 1 < seq_len < kv_len:
+            # chunk after a cached prefix, causal aligned to the bottom right
+            attn_mask = torch.ones(seq_len, kv_len, dtype=torch.bool, device=q.device).tril(kv_len - seq_len)
+        return torch.nn.functional.scaled_dot_product_attention(
+            q,
+            k,
+            v,  # order important
+            attn_mask=attn_mask,
+            dropout_p=dropout_p,
+            is_causal=seq_len == kv_len,
+        )
+    attn_mtx = torch.matmul(q, k.transpose(2, 3)) / math.sqrt(q.size(-1))
+    attn_mtx = attn_mtx + mask[:, :, kv_len - seq_len : kv_len, :kv_len]
+    attn_mtx = F.softmax(attn_mtx.float(), dim=-1).type_as(k)
+    attn_mtx = F.dropout(attn_mtx, dropout_p)
+    return torch.matmul(attn_mtx, v)  # (batch, n_head, seq_len, head_dim)
 
 
 class KAttention(nn.Module):
@@ -65,16 +122,16 @@ class KAttention(nn.Module):
 
         self.flash_attn = hasattr(torch.nn.functional, "scaled_dot_product_attention")
 
-    def forward(self, x: torch.Tensor, mask: torch.Tensor, freqs_cis) -> torch.Tensor:
+    def forward(
+        self, x: torch.Tensor, mask: torch.Tensor, freqs_cis, kv_cache: PackedKVCache | None = None, start_pos: int = 0
+    ) -> torch.Tensor:
         batch, seq_len, d_model = x.shape
 
         k: torch.Tensor  # type hint for lsp
         q: torch.Tensor  # ignore
-        v: torch.Tensor
 
         k = self.key(x)
         q = self.query(x)
-        v = k
 
         k = k.view(
             batch, seq_len, self.num_kv_heads, self.head_dim
@@ -83,6 +140,9 @@ class KAttention(nn.Module):
 
         q, k = apply_rope(q, k, freqs_cis)
 
+        # only k is cached, v is the same tensor
+        k = pack([k], kv_cache, start_pos)
+
         # Grouped Query Attention
         if self.num_kv_heads != self.num_heads:
             k = torch.repeat_interleave(k, self.num_queries_per_kv, dim=2)
@@ -90,28 +150,11 @@ class KAttention(nn.Module):
         k = k.transpose(1, 2)  # shape = (B, num_heads, seq_len, head_dim)
         q = q.transpose(1, 2)
 
-        
         # Setting up v to be the same as k
         v = k
-        
-        # print(f"{q.shape=} {k.shape=} {v.shape=}")
-        if self.flash_attn:
-            output = torch.nn.functional.scaled_dot_product_attention(
-                q,
-                k,
-                v,  # order important
-                attn_mask=None,
-                dropout_p=self.attn_dropout.p if self.training else 0.0,
-                is_causal=True,
-            )
-        else:
-            attn_mtx = torch.matmul(q, k.transpose(2, 3)) / math.sqrt(self.head_dim)
-            attn_mtx = attn_mtx + mask[:, :, :seq_len, :seq_len]
-            attn_mtx = F.softmax(attn_mtx.float(), dim=-1).type_as(k)
-            attn_mtx = self.attn_dropout(attn_mtx)
-
-            output = torch.matmul(attn_mtx, v)  # (batch, n_head, seq_len, head_dim)
-        # print(f"{output.shape=}")
+
+        dropout_p = self.attn_dropout.p if self.training else 0.0
+        output = attention(q, k, v, mask, dropout_p, self.flash_attn)
         output = output.transpose(1, 2).contiguous().view(batch, seq_len,self.head_dim * self.num_kv_heads )
 
         # final projection into the residual stream
@@ -119,6 +162,9 @@ class KAttention(nn.Module):
         output = self.res_dropout(output)
         return output
 
+    def build_kv_cache(self, batch_size: int, max_seq_len: int, device=None, dtype=None) -> PackedKVCache:
+        return PackedKVCache(batch_size, max_seq_len, self.num_kv_heads, self.head_dim, device, dtype)
+
 
 class PartialKVAttention(nn.Module):
     def __init__(self, config: Config):
@@ -139,7 +185,9 @@ class PartialKVAttention(nn.Module):
 
         self.flash_attn = hasattr(torch.nn.functional, "scaled_dot_product_attention")
 
-    def forward(self, x: torch.Tensor, mask: torch.Tensor, freqs_cis) -> torch.Tensor:
+    def forward(
+        self, x: torch.Tensor, mask: torch.Tensor, freqs_cis, kv_cache: PackedKVCache | None = None, start_pos: int = 0
+    ) -> torch.Tensor:
         batch, seq_len, d_model = x.shape
 
         k: torch.Tensor  # type hint for lsp
@@ -148,54 +196,40 @@ class PartialKVAttention(nn.Module):
 
         kv = self.keyvalue(x)
         q = self.query(x)
-        
-        # print(f"{self.num_heads * self.head_dim=} {kv.shape=} {x.shape=}")
+
         split_size = int(self.num_heads * self.head_dim* 1.5 / 3)
-        # print(f"{split_size=}")
         k,s,v = kv.split([split_size, split_size, split_size], dim=-1)
         q1,q2 = q.split([split_size, split_size], dim=-1)
-        
-        # print(f"{q.shape=} {q1.shape=} {q2.shape=} {split_size=}")
+
         q1 = q1.view(batch, seq_len, self.num_heads, self.head_dim//2)
         q2 = q2.view(batch, seq_len, self.num_heads, self.head_dim//2)
-        
+
         k = k.view(
             batch, seq_len, self.num_kv_heads, self.head_dim//2
-        )  # shape = (B, seq_len, num_kv_heads, head_dim)
-        
+        )  # shape = (B, seq_len, num_kv_heads, head_dim//2)
+
         v = v.view(batch, seq_len, self.num_kv_heads, self.head_dim//2)
-        
+
         s = s.view(batch, seq_len, self.num_kv_heads, self.head_dim//2)
 
         q2, k = apply_rope(q2, k, freqs_cis)
-        
-        k = torch.cat([s,k], dim=-1)
-        v = torch.cat([s,v], dim=-1)
-        q = torch.cat([q1,q2], dim=-1)
-        
+
+        # keys are [s, k] and values [s, v]. Packed per head as [k, s, v] (1.5x head_dim),
+        # keys [k, s] are the first head_dim and values [s, v] the last head_dim of the same
+        # memory, so s is stored once and nothing is concatenated per step.
+        # q is reordered to [q2, q1] to match, q . [k, s] == [q1, q2] . [s, k]
+        ksv = pack([k, s, v], kv_cache, start_pos)
+        k = ksv[..., : self.head_dim]
+        v = ksv[..., self.head_dim // 2 :]
+        q = torch.cat([q2,q1], dim=-1)
 
         k = k.transpose(1, 2)  # shape = (B, num_heads, seq_len, head_dim)
         q = q.transpose(1, 2)
         v = v.transpose(1, 2)
 
-        if self.flash_attn:
-            output = torch.nn.functional.scaled_dot_product_attention(
-                q,
-                k,
-                v,  # order important
-                attn_mask=None,
-                dropout_p=self.attn_dropout.p if self.training else 0.0,
-                is_causal=True,
-            )
-        else:
-            attn_mtx = torch.matmul(q, k.transpose(2, 3)) / math.sqrt(self.head_dim)
-            attn_mtx = attn_mtx + mask[:, :, :seq_len, :seq_len]
-            attn_mtx = F.softmax(attn_mtx.float(), dim=-1).type_as(k)
-            attn_mtx = self.attn_dropout(attn_mtx)
-
-            output = torch.matmul(attn_mtx, v)  # (batch, n_head, seq_len, head_dim)
+        dropout_p = self.attn_dropout.p if self.training else 0.0
+        output = attention(q, k, v, mask, dropout_p, self.flash_attn)
 
-        
         # restore time as batch dimension and concat heads
         output = output.transpose(1, 2).contiguous().view(batch, seq_len, self.head_dim * self.num_kv_heads)
 
@@ -204,6 +238,10 @@ class PartialKVAttention(nn.Module):
         output = self.res_dropout(output)
         return output
 
+    def build_kv_cache(self, batch_size: int, max_seq_len: int, device=None, dtype=None) -> PackedKVCache:
+        width = 3 * (self.head_dim // 2)
+        return PackedKVCache(batch_size, max_seq_len, self.num_kv_heads, width, device, dtype)
+
 
 
 class Attention(nn.Module):
@@ -226,7 +264,9 @@ class Attention(nn.Module):
 
         self.flash_attn = hasattr(torch.nn.functional, "scaled_dot_product_attention")
 
-    def forward(self, x: torch.Tensor, mask: torch.Tensor, freqs_cis) -> torch.Tensor:
+    def forward(
+        self, x: torch.Tensor, mask: torch.Tensor, freqs_cis, kv_cache: PackedKVCache | None = None, start_pos: int = 0
+    ) -> torch.Tensor:
         batch, seq_len, d_model = x.shape
 
         k: torch.Tensor  # type hint for lsp
@@ -245,28 +285,17 @@ class Attention(nn.Module):
 
         q, k = apply_rope(q, k, freqs_cis)
 
+        if kv_cache is not None:
+            kv = kv_cache.forward([k, v], start_pos)
+            k, v = kv[..., : self.head_dim], kv[..., self.head_dim :]
+
         k = k.transpose(1, 2)  # shape = (B, num_heads, seq_len, head_dim)
         q = q.transpose(1, 2)
         v = v.transpose(1, 2)
 
-        if self.flash_attn:
-            output = torch.nn.functional.scaled_dot_product_attention(
-                q,
-                k,
-                v,  # order important
-                attn_mask=None,
-                dropout_p=self.attn_dropout.p if self.training else 0.0,
-                is_causal=True,
-            )
-        else:
-            attn_mtx = torch.matmul(q, k.transpose(2, 3)) / math.sqrt(self.head_dim)
-            attn_mtx = attn_mtx + mask[:, :, :seq_len, :seq_len]
-            attn_mtx = F.softmax(attn_mtx.float(), dim=-1).type_as(k)
-            attn_mtx = self.attn_dropout(attn_mtx)
-
-            output = torch.matmul(attn_mtx, v)  # (batch, n_head, seq_len, head_dim)
+        dropout_p = self.attn_dropout.p if self.training else 0.0
+        output = attention(q, k, v, mask, dropout_p, self.flash_attn)
 
-        
         # restore time as batch dimension and concat heads
         output = output.transpose(1, 2).contiguous().view(batch, seq_len, self.head_dim * self.num_kv_heads )
 
@@ -275,6 +304,9 @@ class Attention(nn.Module):
         output = self.res_dropout(output)
         return output
 
+    def build_kv_cache(self, batch_size: int, max_seq_len: int, device=None, dtype=None) -> PackedKVCache:
+        return PackedKVCache(batch_size, max_seq_len, self.num_kv_heads, 2 * self.head_dim, device, dtype)
+
 
 if __name__ == "__main__":
     
@@ -325,4 +357,48 @@ if __name__ == "__main__":
     assert output.shape == (2,10,d_model)
     
     
-    
\ No newline at end of file
+    
+    print("-"*100)
+    # decode with a cache matches the full forward
+    pkv.eval()
+    x = torch.randn(2, 24, d_model)
+    with torch.no_grad():
+        full = pkv(x, None, freqs_cis)
+        cache = pkv.build_kv_cache(2, config.seq_len)
+        steps = [pkv(x[:, :8], None, freqs_cis, cache, 0)]
+        for t in range(8, x.size(1)):
+            cis = freqs_cis[0][t : t + 1], freqs_cis[1][t : t + 1]
+            steps.append(pkv(x[:, t : t + 1], None, cis, cache, t))
+    cached = torch.cat(steps, dim=1)
+    assert torch.allclose(full, cached, atol=1e-5), (full - cached).abs().max()
+
+    # cache memory and what one decode step reads, per layer:
+    #   mha          16 heads, k + v                   2    x head_dim per head
+    #   pkv naive    18 heads, [s, k] + [s, v] cached  2    x head_dim per head
+    #   pkv packed   18 heads, [k, s, v]               1.5  x head_dim per head
+    from torch.utils.benchmark import Timer
+
+    dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    batch = 1
+    print(f"{'cache':12s} {'context':>8s} {'MB':>8s} {'ms / step':>10s} {'GB/s':>8s}")
+    for context in (2048, 8192):
+        # cache layout (B, context, H, width), seen by attention as (B, H, context, width)
+        q16 = torch.randn(batch, 16, 1, head_dim, device=device, dtype=dtype)
+        q18 = torch.randn(batch, 18, 1, head_dim, device=device, dtype=dtype)
+        mha = torch.randn(batch, context, 16, 2 * head_dim, device=device, dtype=dtype).transpose(1, 2)
+        naive = torch.randn(batch, context, 18, 2 * head_dim, device=device, dtype=dtype).transpose(1, 2)
+        packed = torch.randn(batch, context, 18, 3 * head_dim // 2, device=device, dtype=dtype).transpose(1, 2)
+        cases = {
+            "mha": (q16, mha[..., :head_dim], mha[..., head_dim:], mha),
+            "pkv naive": (q18, naive[..., :head_dim], naive[..., head_dim:], naive),
+            "pkv packed": (q18, packed[..., :head_dim], packed[..., head_dim // 2 :], packed),
+        }
+        for name, (q, k, v, memory) in cases.items():
+            timer = Timer(
+                "attention(q, k, v, None, 0.0, True)",
+                globals={"attention": attention, "q": q, "k": k, "v": v},
+            )
+            seconds = timer.blocked_autorange(min_run_time=0.5).median
+            nbytes = memory.numel() * memory.element_size()
+            print(f"{name:12s} {context:8d} {nbytes / 2**20:8.1f} {seconds * 1e3:10.3f} {nbytes / seconds / 1e9:8.1f}")
@@ -1,7 +1,11 @@
+from __future__ import annotations
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from torch import Tensor
+
 
 class QSparse(torch.autograd.Function):
     @staticmethod
@@ -24,30 +28,121 @@ def q_sparse(tensor, K):
     return QSparse.apply(tensor, K)
 
 
+### sparse inference
+# After topk only K of the in_features inputs of a token are non zero, so only K
+# columns of the weight matter. Two ways to skip the rest:
+#   gather: per token, sum the K selected columns scaled by their values. One
+#           embedding_bag over the transposed weight, reads K / in_features of it per token
+#   union:  tokens that share support, run a dense matmul on the union of their
+#           selected columns only, wins when the union is much smaller than in_features
+
+
+def gather_linear(values: Tensor, indices: Tensor, weight_t: Tensor, bias: Tensor | None = None) -> Tensor:
+    "(N, K) values at (N, K) input indices, weight_t (in, out) -> (N, out)"
+    out = F.embedding_bag(indices, weight_t, per_sample_weights=values.to(weight_t.dtype), mode="sum")
+    return out if bias is None else out + bias
+
+
+def union_linear(
+    values: Tensor,
+    indices: Tensor,
+    weight_t: Tensor,
+    bias: Tensor | None = None,
+    unique: tuple[Tensor, Tensor] | None = None,
+) -> Tensor:
+    """
+    same as gather_linear, one dense matmul over the union of the selected columns.
+    unique is torch.unique(indices, return_inverse=True) if already computed
+    """
+    support, position = unique if unique is not None else torch.unique(indices, return_inverse=True)
+    x = values.new_zeros(values.size(0), support.numel())
+    x.scatter_(-1, position, values)
+    out = x @ weight_t[support]
+    return out if bias is None else out + bias
+
+
 class QSparseLinear(nn.Linear):
-    def __init__(self, pct, *args, **kwargs):
+    def __init__(self, pct, *args, mode: str = "auto", gather_max_tokens: int = 8, union_max_frac: float = 0.5, **kwargs):
+        """
+        mode, only used in eval, training always runs the dense straight through path:
+            "dense"   scatter into a zero tensor and F.linear
+            "gather"  gather_linear, memory bound decode
+            "union"   union_linear, tokens with shared support
+            "auto"    gather for up to gather_max_tokens tokens, union when the union of
+                      the selected columns is below union_max_frac of in_features, else dense
+        """
         super().__init__(*args, **kwargs)
-        self.K = int(pct * self.weight.shape[1])
-        print(self.in_features, self.out_features, self.K)
+        assert mode in ("dense", "gather", "union", "auto"), f"unknown mode {mode}"
+        self.K = int(pct * self.in_features)
+        self.mode = mode
+        self.gather_max_tokens = gather_max_tokens
+        self.union_max_frac = union_max_frac
+        # the weight is kept as (in, out) so a selected input is one contiguous row for the
+        # sparse paths, the dense paths use the (out, in) view. One copy of the weight,
+        # checkpoints keep the nn.Linear (out, in) layout
+        self.weight.data = self.weight.data.t().contiguous()
+        self._register_state_dict_hook(self._save_out_in)
+        self._register_load_state_dict_pre_hook(self._load_out_in)
+
+    @staticmethod
+    def _save_out_in(module, state_dict, prefix, local_metadata):
+        state_dict[f"{prefix}weight"] = state_dict[f"{prefix}weight"].t()
+
+    @staticmethod
+    def _load_out_in(state_dict, prefix, *args):
+        key = f"{prefix}weight"
+        if key in state_dict:
+            state_dict[key] = state_dict[key].t()
+
+    def weight_t(self) -> Tensor:
+        "(in, out), a selected column of the nn.Linear weight is one contiguous row"
+        return self.weight
 
     def forward(self, x: torch.Tensor):
-        x = QSparse.apply(x, self.K)
-        x = x / torch.norm(x, dim=-1, keepdim=True)
-        return F.linear(x, self.weight, self.bias)
+        if self.training or self.mode == "dense":
+            x = QSparse.apply(x, self.K)
+            x = x / torch.norm(x, dim=-1, keepdim=True)
+            return F.linear(x, self.weight.t(), self.bias)
+        return self.sparse_forward(x)
+
+    def sparse_forward(self, x: Tensor) -> Tensor:
+        shape = x.shape
+        x = x.reshape(-1, self.in_features)
+        values, indices = torch.topk(x, self.K, dim=-1)
+        # norm of the sparse vector is the norm of its non zeros
+        values = values / torch.norm(values, dim=-1, keepdim=True)
+
+        mode = self.mode
+        unique = None
+        if mode == "auto":
+            mode = "gather" if x.size(0) <= self.gather_max_tokens else "union"
+            if mode == "union":
+                # the union size is a host sync, fine outside of cuda graphs
+                unique = torch.unique(indices, return_inverse=True)
+                if unique[0].numel() > self.union_max_frac * self.in_features:
+                    mode = "dense"
+        if mode == "gather":
+            out = gather_linear(values, indices, self.weight_t(), self.bias)
+        elif mode == "union":
+            out = union_linear(values, indices, self.weight_t(), self.bias, unique)
+        else:
+            dense = torch.zeros_like(x).scatter_(-1, indices, values)
+            out = F.linear(dense, self.weight.t(), self.bias)
+        return out.view(*shape[:-1], self.out_features)
 
 
-def monkey_patch_model(model: nn.Module, target_layers: list[str], pct: float = 0.7):
+def monkey_patch_model(model: nn.Module, target_layers: list[str], pct: float = 0.7, mode: str = "auto"):
     for name, module in model.named_children():
         if isinstance(module, nn.Linear) and name in target_layers:
             setattr(
                 model,
                 name,
                 QSparseLinear(
-                    pct, module.in_features, module.out_features, bias=module.bias is not None
+                    pct, module.in_features, module.out_features, bias=module.bias is not None, mode=mode
                 ),
             )
         else:
-            monkey_patch_model(module, target_layers, pct)
+            monkey_patch_model(module, target_layers, pct, mode)
 
 
 if __name__ == "__main__":
@@ -58,3 +153,30 @@ if __name__ == "__main__":
     output.sum().backward()
 
     print(tensor.grad)
+
+    # sparse inference matches the dense path
+    layer = QSparseLinear(0.25, 256, 128).eval()
+    x = torch.randn(2, 5, 256)
+    with torch.no_grad():
+        layer.mode = "dense"
+        ref = layer(x)
+        for mode in ("gather", "union", "auto"):
+            layer.mode = mode
+            assert torch.allclose(layer(x), ref, atol=1e-5), mode
+
+    # cpu: where does skipping the zero columns beat the dense matmul
+    from torch.utils.benchmark import Timer
+
+    dim = 4096
+    print(f"{'pct':>5s} {'tokens':>6s} {'dense ms':>9s} {'gather ms':>10s} {'union ms':>9s}")
+    for num_tokens in (1, 16, 128):
+        for pct in (0.05, 0.1, 0.25, 0.5, 0.7):
+            layer = QSparseLinear(pct, dim, dim, bias=False).eval()
+            x = torch.randn(num_tokens, dim)
+            row = []
+            for mode in ("dense", "gather", "union"):
+                layer.mode = mode
+                with torch.inference_mode():
+                    timer = Timer("layer(x)", globals={"layer": layer, "x": x})
+                    row.append(timer.blocked_autorange(min_run_time=0.3).median * 1e3)
+            print(f"{pct:5.2f} {num_tokens:6d} {row[0]:9.3f} {row[1]:10.3f} {row[2]:9.3f}")
@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -6,6 +8,7 @@ import math
 from dataclasses import dataclass
 from ohara.modules.activations import ACT2FN
 from ohara.modules.norm import RMSNorm
+from ohara.modules.kv_cache import KVCache
 
 from ohara.embedings_pos.rotatry import precompute_freqs_cis
 from ohara.embedings_pos.rotatry import apply_rope
@@ -127,7 +130,7 @@ class GLU(nn.Module):
     def forward(self, x):
         up = self.up(x)
         gate = self.gate(x)
-        down = self.down(F.silu(gate) * up)
+        down = self.down(self.activation(gate) * up)
         return self.dropout(down)
 
 
@@ -155,7 +158,9 @@ class Attention(nn.Module):
 
         self.flash_attn = hasattr(torch.nn.functional, "scaled_dot_product_attention")
 
-    def forward(self, x: torch.Tensor, mask: torch.Tensor, freqs_cis) -> torch.Tensor:
+    def forward(
+        self, x: torch.Tensor, mask: torch.Tensor, freqs_cis, kv_cache: KVCache | None = None, start_pos: int = 0
+    ) -> torch.Tensor:
         batch, seq_len, d_model = x.shape
 
         k: torch.Tensor  # type hint for lsp
@@ -174,6 +179,10 @@ class Attention(nn.Module):
 
         q, k = apply_rope(q, k, freqs_cis)
 
+        if kv_cache is not None:
+            assert seq_len == 1 or start_pos == 0, "prefill from 0, then one token at a time"
+            k, v = kv_cache.forward(k, v, start_pos)
+
         # Grouped Query Attention
         if self.num_kv_heads != self.num_heads:
             k = torch.repeat_interleave(k, self.num_queries_per_kv, dim=2)
@@ -190,11 +199,12 @@ class Attention(nn.Module):
                 v,  # order impotent
                 attn_mask=None,
                 dropout_p=self.attn_dropout.p if self.training else 0.0,
-                is_causal=True,
+                is_causal=q.size(2) == k.size(2),  # a decode step sees the whole cache
             )
         else:
             attn_mtx = torch.matmul(q, k.transpose(2, 3)) / math.sqrt(self.head_dim)
-            attn_mtx = attn_mtx + mask[:, :, :seq_len, :seq_len]
+            if seq_len > 1:
+                attn_mtx = attn_mtx + mask[:, :, :seq_len, :seq_len]
             attn_mtx = F.softmax(attn_mtx.float(), dim=-1).type_as(k)
             attn_mtx = self.attn_dropout(attn_mtx)
 
@@ -214,18 +224,21 @@ class Block(nn.Module):
         super().__init__()
 
         self.attn = Attention(config)
+        # MLP and GLU name the activation argument differently
+        activation = {"MLP": "activation_fn", "GLU": "activation"}[config.mlp]
         self.ff = MLP_BLOCK[config.mlp](
             dim=config.d_model,
             hidden_dim=config.hidden_dim,
             dropout=config.dropout,
             bias=config.bias,
+            **{activation: config.activation},
         )
 
         self.norm1 = RMSNorm(config.d_model)
         self.norm2 = RMSNorm(config.d_model)
 
-    def forward(self, x, mask, freqs_cis):
-        x = x + self.attn(self.norm1(x), mask, freqs_cis)
+    def forward(self, x, mask, freqs_cis, kv_cache: KVCache | None = None, start_pos: int = 0):
+        x = x + self.attn(self.norm1(x), mask, freqs_cis, kv_cache, start_pos)
         x = x + self.ff(self.norm2(x))
         return x
 
@@ -260,19 +273,34 @@ class Transformer(nn.Module):
 
         self.apply(self._init_weights)
 
-    def forward(self, x: torch.Tensor):
+    def forward(self, x: torch.Tensor, kv_cache: list[KVCache] | None = None, position_ids: int = 0):
+        """
+        same cache convention as LLAMA: x is the full sequence and position_ids the
+        number of tokens already in kv_cache (from build_kv_cache)
+        """
+        start = 0
+        if kv_cache is not None:
+            x = x[:, position_ids:]
+            start = position_ids
         batch, seqlen = x.shape
         x = self.token_emb(x)
-        device = self.token_emb.weight.device
-        freqs_cis = self.freq_cos[:seqlen], self.freq_sin[:seqlen]
+        freqs_cis = self.freq_cos[start : start + seqlen], self.freq_sin[start : start + seqlen]
 
-        for layer in self.layers:
-            x = layer(x, self.mask, freqs_cis)
+        for idx, layer in enumerate(self.layers):
+            cache = kv_cache[idx] if kv_cache is not None else None
+            x = layer(x, self.mask, freqs_cis, cache, start)
 
         x = self.norm(x)
         x = self.vocab_proj(x)
         return x
 
+    def build_kv_cache(self, batch_size: int = 1) -> list[KVCache]:
+        attn = self.layers[0].attn
+        shape = (batch_size, self.config.seq_len, attn.num_heads, attn.head_dim)
+        dtype = self.token_emb.weight.dtype
+        device = self.token_emb.weight.device
+        return [KVCache(shape, self.config.seq_len, idx, device, dtype) for idx in range(len(self.layers))]
+
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
@@ -288,8 +316,8 @@ class ModelingLM(nn.Module, PyTorchModelHubMixin):
         self.config = config
         self.model = Transformer(self.config)
 
-    def forward(self, x: torch.Tensor):
-        return self.model(x)
+    def forward(self, x: torch.Tensor, kv_cache: list[KVCache] | None = None, position_ids: int = 0):
+        return self.model(x, kv_cache, position_ids)
 
 
 if __name__ == "__main__":
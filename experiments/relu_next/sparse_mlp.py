@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from torch import Tensor
+
+from model_relu_next import MLP, GLU, MLP_BLOCK
+
+### activation sparsity at inference
+# relu2 / relu3 hidden states are exactly zero wherever the pre activation is <= 0,
+# often 90%+ of the units of a trained model. A zero unit contributes nothing to
+# `down`, so only the rows of down.weight^T of the active units are read.
+# With a predictor (DejaVu: https://arxiv.org/abs/2310.17157) the inactive units are
+# guessed from x before up / gate run, and those columns are skipped as well.
+
+
+def sparse_down(
+    hidden: Tensor, down_t: Tensor, bias: Tensor | None = None, units: Tensor | None = None
+) -> Tensor:
+    """
+    hidden (N, units) @ down_t (hidden_dim, dim), reading only the rows of the units
+    active in any of the N tokens. units are the hidden_dim indices of the columns of
+    hidden when it only holds some of them (predictor), None for all
+    """
+    active = (hidden != 0).any(dim=0).nonzero().squeeze(-1)
+    rows = active if units is None else units[active]
+    out = hidden[:, active] @ down_t[rows]
+    return out if bias is None else out + bias
+
+
+class SparseMLP(nn.Module):
+    def __init__(
+        self,
+        mlp: MLP | GLU,
+        predictor_rank: int = 0,
+        predictor_threshold: float = 0.5,
+        max_active_frac: float = 0.5,
+    ):
+        """
+        inference wrapper around a relu_next MLP / GLU, training runs the same math densely.
+        mlp.down.weight is stored as (hidden_dim, dim) from here on, so an active unit is one
+        contiguous row and there is no second copy; wrap after training (optimizer states
+        keep the old shape), checkpoints keep the nn.Linear layout.
+
+        predictor_rank > 0 adds a (dim -> rank -> hidden_dim) predictor of the active
+        units, fit it with `fit_predictor`. Units it drops are never computed, so a
+        predicted-inactive unit that was actually active is an approximation error.
+        Above max_active_frac active units the dense path is faster and is used instead.
+        """
+        super().__init__()
+        self.mlp = mlp
+        self.glu = isinstance(mlp, GLU)
+        self.activation = mlp.activation if self.glu else mlp.activation_fn
+        self.hidden_dim = mlp.down.in_features
+        self.max_active_frac = max_active_frac
+        self.predictor_threshold = predictor_threshold
+        self.predictor = None
+        if predictor_rank > 0:
+            dim = mlp.up.in_features
+            self.predictor = nn.Sequential(
+                nn.Linear(dim, predictor_rank, bias=False), nn.Linear(predictor_rank, self.hidden_dim)
+            ).to(mlp.up.weight.device, mlp.up.weight.dtype)
+        down = mlp.down
+        down.weight.data = down.weight.data.t().contiguous()
+        self._register_state_dict_hook(self._save_out_in)
+        self._register_load_state_dict_pre_hook(self._load_out_in)
+        # active units / total units over every token seen, reset with reset_stats
+        active_units = torch.zeros((), dtype=torch.long, device=mlp.up.weight.device)
+        self.register_buffer("active_units", active_units, persistent=False)
+        self.num_tokens = 0
+
+    @staticmethod
+    def _save_out_in(module, state_dict, prefix, local_metadata):
+        state_dict[f"{prefix}mlp.down.weight"] = state_dict[f"{prefix}mlp.down.weight"].t()
+
+    @staticmethod
+    def _load_out_in(state_dict, prefix, *args):
+        key = f"{prefix}mlp.down.weight"
+        if key in state_dict:
+            state_dict[key] = state_dict[key].t()
+
+    def down_t(self) -> Tensor:
+        "(hidden_dim, dim) down weight, an active unit is one contiguous row"
+        return self.mlp.down.weight
+
+    def dense_down(self, hidden: Tensor) -> Tensor:
+        return F.linear(hidden, self.down_t().t(), self.mlp.down.bias)
+
+    def hidden(self, x: Tensor, units: Tensor | None = None) -> Tensor:
+        "activation(gate) * up, or activation(up), for all units or only `units`"
+        def project(linear: nn.Linear) -> Tensor:
+            if units is None:
+                return linear(x)
+            bias = None if linear.bias is None else linear.bias[units]
+            return F.linear(x, linear.weight[units], bias)
+
+        if self.glu:
+            return self.activation(project(self.mlp.gate)) * project(self.mlp.up)
+        return self.activation(project(self.mlp.up))
+
+    def forward(self, x: Tensor) -> Tensor:
+        if self.training:
+            return self.mlp.dropout(self.dense_down(self.hidden(x)))
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+
+        units = None
+        if self.predictor is not None:
+            predicted = torch.sigmoid(self.predictor(x)) > self.predictor_threshold
+            units = predicted.any(dim=0).nonzero().squeeze(-1)
+        hidden = self.hidden(x, units)
+
+        self.active_units += (hidden != 0).sum()
+        self.num_tokens += x.size(0)
+
+        if units is None and (hidden != 0).any(dim=0).float().mean() > self.max_active_frac:
+            out = self.dense_down(hidden)
+        else:
+            out = sparse_down(hidden, self.down_t(), self.mlp.down.bias, units)
+        return self.mlp.dropout(out).view(*shape[:-1], -1)
+
+    def sparsity(self) -> float:
+        "fraction of zero hidden units per token so far"
+        if self.num_tokens == 0:
+            return 0.0
+        return 1.0 - self.active_units.item() / (self.num_tokens * self.hidden_dim)
+
+    def reset_stats(self):
+        self.active_units.zero_()
+        self.num_tokens = 0
+
+    @torch.enable_grad()
+    def fit_predictor(self, x: Tensor, steps: int = 300, lr: float = 1e-2) -> float:
+        """
+        fit the predictor on block inputs x (..., dim) against the true active units,
+        positives are up weighted so misses (dropped active units) are rare -> recall
+        """
+        assert self.predictor is not None, "built without a predictor, set predictor_rank"
+        x = x.reshape(-1, x.size(-1)).detach()
+        with torch.no_grad():
+            target = (self.hidden(x) != 0).to(x.dtype)
+        pos_weight = ((1 - target.mean()) / target.mean().clamp_min(1e-3)).clamp(1, 10)
+        opt = torch.optim.Adam(self.predictor.parameters(), lr=lr)
+        for _ in range(steps):
+            loss = F.binary_cross_entropy_with_logits(self.predictor(x), target, pos_weight=pos_weight)
+            loss.backward()
+            opt.step()
+            opt.zero_grad()
+        with torch.no_grad():
+            predicted = torch.sigmoid(self.predictor(x)) > self.predictor_threshold
+            recall = (predicted & target.bool()).sum() / target.sum().clamp_min(1)
+        return recall.item()
+
+
+def sparsify(model: nn.Module, **kwargs) -> nn.Module:
+    "wrap every relu_next MLP / GLU in a SparseMLP, in place"
+    for name, module in model.named_children():
+        if isinstance(module, tuple(MLP_BLOCK.values())):
+            setattr(model, name, SparseMLP(module, **kwargs))
+        else:
+            sparsify(module, **kwargs)
+    return model
+
+
+if __name__ == "__main__":
+    import copy
+
+    from torch.utils.benchmark import Timer
+
+    from model_relu_next import Config, Transformer
+
+    torch.manual_seed(0)
+
+    # exact without a predictor, for both block types
+    for block in (MLP(64, 256, activation_fn="relu2"), GLU(64, 256, activation="relu2")):
+        block.eval()
+        x = torch.randn(3, 7, 64)
+        with torch.no_grad():
+            ref = block(x)
+            sparse = SparseMLP(copy.deepcopy(block)).eval()
+            assert torch.allclose(sparse(x), ref, atol=1e-5)
+            assert torch.allclose(sparse.train()(x), ref, atol=1e-5)
+            # checkpoints keep the nn.Linear layout
+            assert sparse.state_dict()["mlp.down.weight"].shape == block.down.weight.shape
+            sparse.load_state_dict(sparse.state_dict())
+
+    # down projection alone, 1 decode token, against the dense matmul
+    dim, hidden_dim = 2048, 8192
+    down = nn.Linear(hidden_dim, dim, bias=False)
+    down_t = down.weight.t().contiguous()
+    print(f"{'sparsity':>8s} {'dense ms':>9s} {'sparse ms':>10s}")
+    for sparsity in (0.5, 0.8, 0.9, 0.95, 0.99):
+        hidden = torch.randn(1, hidden_dim) * (torch.rand(1, hidden_dim) > sparsity)
+        with torch.inference_mode():
+            dense = Timer("down(h)", globals={"down": down, "h": hidden}).blocked_autorange(min_run_time=0.3)
+            sparse = Timer("f(h, w)", globals={"f": sparse_down, "h": hidden, "w": down_t})
+            sparse = sparse.blocked_autorange(min_run_time=0.3)
+        print(f"{sparsity:8.2f} {dense.median * 1e3:9.3f} {sparse.median * 1e3:10.3f}")
+
+    # end to end cached greedy decode of a relu2 model. A random init sits near 50%
+    # sparsity, right at max_active_frac, so either load a trained relu2 checkpoint or
+    # shift up.bias per unit until `target_sparsity` of the units are off
+    checkpoint: str | None = None
+    target_sparsity = 0.9
+    config = Config(
+        vocab_size=1024, seq_len=512, d_model=512, hidden_dim=2048, num_heads=8, num_layers=6,
+        dropout=0.0, activation="relu2", mlp="MLP", bias=True,
+    )
+    model = Transformer(config).eval()
+    prompt = torch.randint(0, config.vocab_size, (1, 16))
+    if checkpoint is not None:
+        model.load_state_dict(torch.load(checkpoint, map_location="cpu", weights_only=True))
+    else:
+        calibration = torch.randint(0, config.vocab_size, (4, 256))
+        with torch.no_grad():
+            for layer in model.layers:
+                inputs = []
+                hook = layer.ff.register_forward_pre_hook(lambda module, args: inputs.append(args[0]))
+                model(calibration)
+                hook.remove()
+                up = layer.ff.up
+                pre = inputs[0].reshape(-1, up.in_features) @ up.weight.t()
+                up.bias.copy_(-pre.quantile(target_sparsity, dim=0))
+
+    @torch.no_grad()
+    def decode(model: Transformer, new_tokens: int = 128) -> Tensor:
+        kv_cache = model.build_kv_cache()
+        tokens, position = prompt, 0
+        for _ in range(new_tokens):
+            logits = model(tokens, kv_cache, position)
+            position = tokens.size(1)
+            tokens = torch.cat([tokens, logits[:, -1:].argmax(-1)], dim=1)
+        return tokens
+
+    def seconds(model: Transformer) -> float:
+        decode(model)  # warmup
+        return Timer("decode(model)", globals={"decode": decode, "model": model}).blocked_autorange(min_run_time=3).median
+
+    dense = copy.deepcopy(model)
+    sparsify(model)
+    with torch.no_grad():
+        assert torch.allclose(model(prompt), dense(prompt), atol=1e-4)
+    dense_seconds = seconds(dense)
+    for layer in model.layers:
+        layer.ff.reset_stats()
+    sparse_seconds = seconds(model)
+    for idx, layer in enumerate(model.layers):
+        print(f"layer {idx}: {layer.ff.sparsity():.1%} of hidden units are zero")
+    print(f"decode: dense {dense_seconds:.3f}s, sparse {sparse_seconds:.3f}s ({dense_seconds / sparse_seconds:.2f}x)")
+
+    # predictor: also skip up for the units predicted inactive
+    calibration = torch.randn(4096, 64)
+    block = MLP(64, 1024, activation_fn="relu2").eval()
+    sparse = SparseMLP(copy.deepcopy(block), predictor_rank=16).eval()
+    recall = sparse.fit_predictor(calibration)
+    with torch.no_grad():
+        x = torch.randn(256, 64)
+        err = (sparse(x) - block(x)).norm() / block(x).norm()
+    print(f"predictor recall {recall:.1%}, relative error {err:.3f}")
@@ -136,6 +136,7 @@ def main():
 
     # fabric init
     fabric = L.Fabric(loggers=loggers, precision="bf16-mixed")
+    fabric.launch()
     fabric.logger.log_hyperparams(hyper_params)
 
     tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
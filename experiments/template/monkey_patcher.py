@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -72,17 +74,42 @@ class DMLinear(nn.Linear):
         super().__init__(in_features, out_features, bias, device, dtype)
 
         self.scale = nn.Parameter(torch.ones(1, out_features))
+        # normalized and scaled weight for inference, keyed on the weight / scale versions
+        # so an optimizer step or load_state_dict invalidates it
+        self._folded: tuple[tuple, torch.Tensor] | None = None
 
-    def forward(self, x):
+    def folded_weight(self) -> torch.Tensor:
+        "w / |w| * scale as one (out, in) weight"
         w = self.weight
+        key = (w._version, self.scale._version, w.device, w.dtype)
+        if self._folded is None or self._folded[0] != key:
+            with torch.no_grad():
+                self._folded = (key, w / w.norm(dim=1, keepdim=True) * self.scale.T)
+        return self._folded[1]
+
+    def forward(self, x):
+        if torch.is_grad_enabled() and (self.weight.requires_grad or self.scale.requires_grad):
+            # training, normalize every step so gradients flow through the norm
+            w = self.weight
+
+            w = w / w.norm(dim=1, keepdim=True)
 
-        w = w / w.norm(dim=1, keepdim=True)
+            out = F.linear(x, w) * self.scale
 
-        out = F.linear(x, w) * self.scale
+            if self.bias is not None:
+                out = out + self.bias
+            return out
+        return F.linear(x, self.folded_weight(), self.bias)
 
-        if self.bias is not None:
-            out = out + self.bias
-        return out
+    def export(self) -> nn.Linear:
+        "plain nn.Linear for serving"
+        w = self.folded_weight()
+        linear = nn.Linear(self.in_features, self.out_features, self.bias is not None, w.device, w.dtype)
+        with torch.no_grad():
+            linear.weight.copy_(w)
+            if self.bias is not None:
+                linear.bias.copy_(self.bias)
+        return linear
 
 
 def monkey_patch_layer(
@@ -108,7 +135,25 @@ def dm_linear_monkey_patch(*args, **kwargs):
     return monkey_patch_layer(DMLinear, *args, **kwargs)
 
 
+def export_dm_linear(model: nn.Module) -> nn.Module:
+    "replace every DMLinear with its exported nn.Linear, in place"
+    for name, module in model.named_children():
+        if isinstance(module, DMLinear):
+            setattr(model, name, module.export())
+        else:
+            export_dm_linear(module)
+    return model
+
+
 if __name__ == "__main__":
     model = StackedMLP(64)
     dm_linear_monkey_patch(model, ["up"])
     print(model)
+
+    x = torch.randn(4, 64)
+    train_out = model(x)
+    with torch.no_grad():
+        assert torch.allclose(model(x), train_out, atol=1e-5)
+        export_dm_linear(model)
+        assert torch.allclose(model(x), train_out, atol=1e-5)
+    print(model)
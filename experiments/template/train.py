@@ -15,6 +15,7 @@ import torch.optim as optim
 from torch import Tensor
 
 from ohara.lr_scheduler import CosineScheduler
+from ohara.optimizers import build_optimizer
 from ohara.dataset import PreTokenizedDataset
 from ohara.utils import BetterCycle
 
@@ -71,6 +72,8 @@ activation_fn: str = "silu"
 
 weight_tying: bool = False
 
+optimizer_name: str = "adamw"  # "adamw8bit" for 8-bit moments, "adamw8bit_offload" to keep them on cpu
+
 MONKEY_PATCH = False
 model_name = f"joey00072/model_name{'Baseline' if MONKEY_PATCH is None else str(MONKEY_PATCH)}"
 
@@ -117,6 +120,7 @@ def main():
         "resume_training": resume_training,
         "save_ckpt_iters": save_ckpt_iters,
         "weight_tying": weight_tying,
+        "optimizer_name": optimizer_name,
     }
     
     print("="*100)  
@@ -136,6 +140,7 @@ def main():
 
     # fabric init
     fabric = L.Fabric(loggers=loggers, precision="bf16-mixed")
+    fabric.launch()
     fabric.logger.log_hyperparams(hyper_params)
 
     tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
@@ -198,7 +203,7 @@ def main():
     )
 
     # inputs = torch.tensor(tokenizer.encode("The")).unsqueeze(0).clone().detach()
-    optimizer = optim.AdamW(model.parameters(), lr=get_lr(0))
+    optimizer = build_optimizer(optimizer_name, model.parameters(), lr=get_lr(0))
     optimizer = fabric.setup_optimizers(optimizer)
 
     trainer = Trainer(
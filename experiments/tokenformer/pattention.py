@@ -1,6 +1,9 @@
+from __future__ import annotations
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.optim as optim
 
 from ohara.modules.activations import ACT2FN
 
@@ -58,6 +61,9 @@ class Pattention(nn.Module):
             torch.nn.init.xavier_uniform_(self.key_param_tokens)
             torch.nn.init.xavier_uniform_(self.value_param_tokens)
 
+        # checkpoints of a grown model load into a fresh (smaller) one
+        self._register_load_state_dict_pre_hook(self._grow_to_checkpoint)
+
     def forward(self, inputs, dropout_p=0.0):
         query = inputs
         key, value = self.key_param_tokens, self.value_param_tokens
@@ -70,30 +76,83 @@ class Pattention(nn.Module):
 
         return output
 
-    def expand_tokens(self, new_param_token_num: int):
+    @torch.no_grad()
+    def expand_tokens(self, new_param_token_num: int, optimizer: optim.Optimizer | None = None):
+        """
+        grow to new_param_token_num parameter tokens in place, same device and dtype.
+
+        New key tokens are zero, so their attention weight gelu(q . 0) is zero and the
+        output is unchanged; new value tokens get the usual init so the keys receive
+        gradient (zero keys and zero values would never move). gelu_l2_norm scales by
+        sqrt(param_token_num), the old value tokens are scaled by sqrt(old / new) to
+        cancel it, so growth is function preserving.
+
+        The parameters stay the same objects (only .data grows), so the optimizer and a
+        single device fabric keep working. Pass the optimizer to pad its state along with
+        them. Not under DDP / FSDP: the gradient buckets and flat params are sized when the
+        model is wrapped, growing underneath them breaks the next backward.
+        """
         assert (
             new_param_token_num > self.param_token_num
         ), "new_param_token_num must be greater than current param_token_num"
-        with torch.no_grad():
-            key_param_tokens = torch.cat(
-                [
-                    self.key_param_tokens,
-                    torch.zeros((new_param_token_num - self.param_token_num, self.param_key_dim)),
-                ],
-                dim=0,
-            )
-            value_param_tokens = torch.cat(
-                [
-                    self.value_param_tokens,
-                    torch.zeros((new_param_token_num - self.param_token_num, self.param_value_dim)),
-                ],
-                dim=0,
-            )
-
-        self.key_param_tokens = nn.Parameter(key_param_tokens)
-        self.value_param_tokens = nn.Parameter(value_param_tokens)
+        num_new = new_param_token_num - self.param_token_num
+        value_scale = 1.0
+        if self.activation_func is gelu_l2_norm:
+            value_scale = math.sqrt(self.param_token_num / new_param_token_num)
+
+        key, value = self.key_param_tokens, self.value_param_tokens
+        new_values = value.new_empty(num_new, self.param_value_dim)
+        torch.nn.init.xavier_uniform_(new_values)
+        key.data = torch.cat([key, key.new_zeros(num_new, self.param_key_dim)], dim=0)
+        value.data = torch.cat([value * value_scale, new_values], dim=0)
+        key.grad = value.grad = None
+
+        if optimizer is not None:
+            pad_optimizer_state(optimizer, key, num_new)
+            pad_optimizer_state(optimizer, value, num_new, scale=value_scale)
         self.param_token_num = new_param_token_num
 
+    def _grow_to_checkpoint(self, state_dict, prefix, *args):
+        key = state_dict.get(f"{prefix}key_param_tokens")
+        if key is not None and key.shape[0] > self.param_token_num:
+            self.expand_tokens(key.shape[0])
+
+
+@torch.no_grad()
+def pad_optimizer_state(optimizer: optim.Optimizer, param: nn.Parameter, num_new: int, scale: float = 1.0):
+    """
+    zero pad the per element state (adam exp_avg / exp_avg_sq, ...) of a parameter that
+    grew by num_new rows. scale is what the old rows were multiplied by, first moments
+    scale with it and second moments with its square. State that is not laid out like
+    the parameter (e.g. blockwise quantized) can't be padded and starts over.
+    """
+    state = optimizer.state.get(param)
+    if not state:
+        return
+    old_shape = (param.shape[0] - num_new, *param.shape[1:])
+    tensors = {name: value for name, value in state.items() if torch.is_tensor(value) and value.dim() > 0}
+    if any(value.shape != old_shape for value in tensors.values()):
+        del optimizer.state[param]
+        return
+    for name, value in tensors.items():
+        if scale != 1.0:
+            value = value * (scale**2 if name.endswith("_sq") else scale)
+        state[name] = torch.cat([value, value.new_zeros(num_new, *old_shape[1:])], dim=0)
+
+
+def grow_model(model: nn.Module, factor: float = 2.0, optimizer: optim.Optimizer | None = None) -> int:
+    """
+    grow every Pattention in the model to `factor` times its parameter tokens, in place,
+    carrying the optimizer state along -> number of parameters added
+    """
+    added = 0
+    for module in model.modules():
+        if isinstance(module, Pattention):
+            new_param_token_num = int(module.param_token_num * factor)
+            added += (new_param_token_num - module.param_token_num) * (module.param_key_dim + module.param_value_dim)
+            module.expand_tokens(new_param_token_num, optimizer)
+    return added
+
 
 class MLP(nn.Module):
     """
@@ -138,3 +197,34 @@ class MLP(nn.Module):
         output = hidden_states @ down_proj
 
         return output
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    model = nn.Sequential(
+        Pattention(32, 32, 64, activation_fn="gelu_l2_norm"), Pattention(32, 16, 48, activation_fn="gelu")
+    )
+    opt = optim.AdamW(model.parameters(), lr=1e-2)
+    x = torch.randn(8, 32)
+    for _ in range(3):
+        model(x).square().mean().backward()
+        opt.step()
+        opt.zero_grad()
+
+    before = model(x)
+    params = list(model.parameters())
+    added = grow_model(model, 2.0, opt)
+    # same parameter objects, output unchanged, moments padded
+    assert all(a is b for a, b in zip(params, model.parameters()))
+    assert torch.allclose(model(x), before, atol=1e-5)
+    assert all(opt.state[p]["exp_avg"].shape == p.shape for p in model.parameters())
+    model(x).square().mean().backward()
+    opt.step()
+    assert model[0].key_param_tokens[64:].abs().sum() > 0, "new key tokens get gradient"
+
+    # a grown checkpoint loads into a fresh model
+    fresh = nn.Sequential(
+        Pattention(32, 32, 64, activation_fn="gelu_l2_norm"), Pattention(32, 16, 48, activation_fn="gelu")
+    )
+    fresh.load_state_dict(model.state_dict())
+    print(f"ok, grew by {added} parameters")
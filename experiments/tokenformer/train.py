@@ -28,10 +28,12 @@ from transformers import AutoTokenizer
 from rich import print, traceback
 
 import lightning as L
+from lightning.fabric.strategies import ParallelStrategy
 from lightning.pytorch.loggers import WandbLogger
 from lightning.fabric.loggers import TensorBoardLogger
 
 from tokenformer import ModelingLM, Config
+from pattention import grow_model
 from ohara.trainer import Trainer
 
 
@@ -67,6 +69,11 @@ num_heads: int = 8
 mlp: str = "Pattention"
 activation_fn: str = "gelu_l2_norm"
 
+# iter -> factor, every Pattention grows in place to factor x its parameter tokens,
+# optimizer state is carried along, eg {max_iters // 2: 2.0}. single device only: DDP
+# buckets and FSDP flat params are sized when the model is wrapped and can't grow
+growth_schedule: dict[int, float] = {}
+
 MONKEY_PATCH = False
 model_name = f"joey00072/tokenformer"
 
@@ -112,6 +119,7 @@ def main():
         "dataset_name": dataset_name,
         "resume_training": resume_training,
         "save_ckpt_iters": save_ckpt_iters,
+        "growth_schedule": growth_schedule,
     }
     
     print("="*100)  
@@ -131,6 +139,7 @@ def main():
 
     # fabric init
     fabric = L.Fabric(loggers=loggers, precision="bf16-mixed")
+    fabric.launch()
     fabric.logger.log_hyperparams(hyper_params)
 
     tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
@@ -192,6 +201,17 @@ def main():
     optimizer = optim.AdamW(model.parameters(), lr=get_lr(0))
     optimizer = fabric.setup_optimizers(optimizer)
 
+    def grow(factor: float):
+        assert not isinstance(fabric.strategy, ParallelStrategy), (
+            f"growth_schedule needs a single device strategy, got {type(fabric.strategy).__name__}"
+        )
+
+        def callback(trainer: Trainer):
+            added = grow_model(trainer.model, factor, trainer.optimizer)
+            print(f"grew every Pattention {factor}x, +{added / 1e6:.2f}M parameters")
+
+        return callback
+
     trainer = Trainer(
         fabric=fabric,
         model=model,
@@ -206,6 +226,7 @@ def main():
         ignore_index=-1,
         push_to_hub=push_to_hub,
         model_name=model_name,
+        step_callbacks={idx: grow(factor) for idx, factor in growth_schedule.items()},
     )
 
     start_iter = 0
@@ -46,11 +46,25 @@ class LoRALinear(nn.Module):
         self.lora_A.requires_grad = True
         self.lora_B.requires_grad = True
 
+    def delta_weight(self) -> torch.Tensor:
+        "(out, in) update the adapter adds to linear.weight, in fp32"
+        return (self.lora_B.float() @ self.lora_A.float()) * self.scaling
+
+    @torch.no_grad()
     def merge(self):
         if not self.merged and self.rank > 0:
-            self.linear.weight.data += (self.lora_B @ self.lora_A) * self.scaling
+            weight = self.linear.weight
+            weight.copy_(weight.float() + self.delta_weight())
             self.merged = True
 
+    @torch.no_grad()
+    def unmerge(self):
+        "undo merge, back to base weight + separate adapter (exact up to rounding of the weight dtype)"
+        if self.merged:
+            weight = self.linear.weight
+            weight.copy_(weight.float() - self.delta_weight())
+            self.merged = False
+
     def forward(self, x: torch.Tensor):
         pretrained = self.linear(x)
         if self.rank == 0 or self.merged:
@@ -68,9 +82,11 @@ def lora_from_linear(linear: nn.Linear, lora_alpha: int = 1, lora_dropout: float
         lora_alpha=lora_alpha,
         lora_dropout=lora_dropout,
         rank=rank,  # Pass rank 16
+        bias=linear.bias is not None,
     )
     lora = lora.to(device)
-    lora.load_state_dict(linear.state_dict(), strict=False)  # Ensure only matching keys are loaded
+    # base weights live under lora.linear, loading into lora itself matched no keys
+    lora.linear.load_state_dict(linear.state_dict())
     return lora.to(device).to(dtype)
 
 
@@ -110,6 +126,13 @@ def merge_lora(model: nn.Module, target_layer: list[str] | None = None):
     return model
 
 
+def unmerge_lora(model: nn.Module):
+    for module in model.modules():
+        if isinstance(module, LoRALinear):
+            module.unmerge()
+    return model
+
+
 if __name__ == "__main__":
 
     class Network(nn.Module):
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+from torch import Tensor
+
+
+class MultiLoRALinear(nn.Module):
+    def __init__(self, linear: nn.Linear, max_adapters: int = 8, max_rank: int = 16):
+        """
+        frozen base linear + a table of LoRA adapters, every row of the batch picks one.
+
+        Adapters live in stacked (slot, ...) buffers, ranks below max_rank are zero
+        padded. Slot 0 is "no adapter" and stays zero, so base model rows need no
+        special casing. The low rank path gathers each row's A / B and runs two bmm,
+        the BGMV / SGMV formulation of punica: https://arxiv.org/abs/2310.18547
+        """
+        super().__init__()
+        self.linear = linear
+        self.max_rank = max_rank
+        factory = {"device": linear.weight.device, "dtype": linear.weight.dtype}
+        slots = max_adapters + 1
+        # adapters are loaded through the registry, not saved with the model
+        self.register_buffer("lora_A", torch.zeros(slots, max_rank, linear.in_features, **factory), persistent=False)
+        self.register_buffer("lora_B", torch.zeros(slots, linear.out_features, max_rank, **factory), persistent=False)
+        self.register_buffer("scaling", torch.zeros(slots, **factory), persistent=False)
+        self.adapter_ids: Tensor | None = None
+        self.merged: int | None = None
+
+    @torch.no_grad()
+    def set_adapter(self, slot: int, lora_A: Tensor, lora_B: Tensor, scaling: float):
+        "lora_A (rank, in), lora_B (out, rank) as saved by LoRALinear"
+        assert slot > 0, "slot 0 is the base model"
+        rank = lora_A.size(0)
+        assert rank <= self.max_rank, f"adapter rank {rank} > max_rank {self.max_rank}"
+        self.clear_adapter(slot)
+        self.lora_A[slot, :rank] = lora_A
+        self.lora_B[slot, :, :rank] = lora_B
+        self.scaling[slot] = scaling
+
+    @torch.no_grad()
+    def clear_adapter(self, slot: int):
+        assert self.merged != slot, "unmerge before replacing the merged adapter"
+        self.lora_A[slot].zero_()
+        self.lora_B[slot].zero_()
+        self.scaling[slot] = 0.0
+
+    def delta_weight(self, slot: int) -> Tensor:
+        return (self.lora_B[slot].float() @ self.lora_A[slot].float()) * self.scaling[slot].float()
+
+    @torch.no_grad()
+    def merge(self, slot: int):
+        "fold one adapter into the base weight, rows using it then skip the low rank path"
+        self.unmerge()
+        weight = self.linear.weight
+        weight.copy_(weight.float() + self.delta_weight(slot))
+        self.merged = slot
+
+    @torch.no_grad()
+    def unmerge(self):
+        if self.merged is not None:
+            weight = self.linear.weight
+            weight.copy_(weight.float() - self.delta_weight(self.merged))
+            self.merged = None
+
+    def _lora(self, x: Tensor, ids: Tensor) -> Tensor:
+        rows = ids.size(0)
+        h = x.reshape(rows, -1, x.size(-1))  # (rows, tokens, in)
+        h = torch.bmm(h, self.lora_A[ids].mT)  # (rows, tokens, rank)
+        h = torch.bmm(h, self.lora_B[ids].mT) * self.scaling[ids].view(-1, 1, 1)
+        return h.view(*x.shape[:-1], -1)
+
+    def forward(self, x: Tensor) -> Tensor:
+        out = self.linear(x)
+        ids = self.adapter_ids
+        if ids is None:
+            return out
+        if self.merged is None:
+            return out + self._lora(x, ids)
+        # the base weight holds the merged adapter: its rows are done, the others
+        # add their own adapter and take the merged one back out
+        other = ids != self.merged
+        own = torch.where(other, ids, 0)
+        merged = torch.where(other, self.merged, 0)
+        return out + self._lora(x, own) - self._lora(x, merged)
+
+
+def attach_multi_lora(
+    model: nn.Module, target_layer: list[str] | None = None, max_adapters: int = 8, max_rank: int = 16
+) -> nn.Module:
+    "wrap nn.Linear children (all, or the ones named in target_layer) in MultiLoRALinear, in place"
+    for name, module in model.named_children():
+        if isinstance(module, nn.Linear) and (target_layer is None or name in target_layer):
+            setattr(model, name, MultiLoRALinear(module, max_adapters, max_rank))
+        else:
+            attach_multi_lora(module, target_layer, max_adapters, max_rank)
+    return model
+
+
+class LoRARegistry:
+    def __init__(
+        self, model: nn.Module, target_layer: list[str] | None = None, max_adapters: int = 8, max_rank: int = 16
+    ):
+        """
+        serve many LoRA fine-tunes of one base model:
+
+            registry = LoRARegistry(model, ["query", "key", "value", "proj"])
+            registry.load("chat", torch.load("chat_lora.pt"), lora_alpha=16)
+            ids = registry.ids(["chat", None, "chat"])  # None is the base model
+            with registry.use(ids):
+                logits = model(tokens)
+
+        state dicts are the ones `replace_with_lora` models save ({path}.lora_A / lora_B),
+        base weights are never touched except by merge / unmerge.
+        """
+        self.model = attach_multi_lora(model, target_layer, max_adapters, max_rank)
+        self.layers = {name: m for name, m in model.named_modules() if isinstance(m, MultiLoRALinear)}
+        self.max_adapters = max_adapters
+        self.slots: dict[str, int] = {}
+
+    def load(self, name: str, state_dict: dict[str, Tensor], lora_alpha: float = 1.0) -> int:
+        if name in self.slots:
+            self.unload(name)
+        free = [slot for slot in range(1, self.max_adapters + 1) if slot not in self.slots.values()]
+        assert free, f"all {self.max_adapters} adapter slots are in use, unload one first"
+        slot = free[0]
+        found = 0
+        for path, layer in self.layers.items():
+            lora_A = state_dict.get(f"{path}.lora_A")
+            if lora_A is None:
+                layer.clear_adapter(slot)
+                continue
+            lora_B = state_dict[f"{path}.lora_B"]
+            layer.set_adapter(slot, lora_A, lora_B, lora_alpha / lora_A.size(0))
+            found += 1
+        assert found > 0, f"no lora weights for {name} match the model"
+        self.slots[name] = slot
+        return slot
+
+    def unload(self, name: str):
+        slot = self.slots.pop(name)
+        for layer in self.layers.values():
+            if layer.merged == slot:
+                layer.unmerge()
+            layer.clear_adapter(slot)
+
+    def ids(self, names: list[str | None], device: torch.device | str | None = None) -> Tensor:
+        "adapter names per batch row -> slot ids, None is the base model"
+        return torch.tensor([0 if name is None else self.slots[name] for name in names], device=device)
+
+    @contextmanager
+    def use(self, adapter_ids: Tensor):
+        for layer in self.layers.values():
+            layer.adapter_ids = adapter_ids
+        try:
+            yield
+        finally:
+            for layer in self.layers.values():
+                layer.adapter_ids = None
+
+    def merge(self, name: str):
+        "fold the hottest adapter into the base weights, other rows stay correct"
+        for layer in self.layers.values():
+            layer.merge(self.slots[name])
+
+    def unmerge(self):
+        for layer in self.layers.values():
+            layer.unmerge()
+
+
+if __name__ == "__main__":
+    import copy
+
+    from ohara.adaptor.lora import replace_with_lora
+
+    torch.manual_seed(0)
+    base = nn.Sequential(nn.Linear(16, 32), nn.GELU(), nn.Linear(32, 8))
+    base_state = copy.deepcopy(base.state_dict())
+
+    # two fine-tunes with different ranks, non zero B so they actually do something
+    finetunes = {}
+    for name, rank in (("a", 4), ("b", 8)):
+        tuned = replace_with_lora(copy.deepcopy(base), rank=rank, lora_alpha=2)
+        for module in tuned.modules():
+            if hasattr(module, "lora_B"):
+                nn.init.normal_(module.lora_B)
+        finetunes[name] = tuned.eval()
+
+    registry = LoRARegistry(base, max_adapters=4, max_rank=8)
+    for name, tuned in finetunes.items():
+        registry.load(name, tuned.state_dict(), lora_alpha=2)
+
+    x = torch.randn(3, 5, 16)
+    names = ["a", None, "b"]
+    with torch.no_grad():
+        expected = torch.stack(
+            [(finetunes[n](x[i]) if n else nn.Sequential(*base)(x[i])) for i, n in enumerate(names)]
+        )
+        with registry.use(registry.ids(names)):
+            assert torch.allclose(base(x), expected, atol=1e-5)
+            registry.merge("b")
+            assert torch.allclose(base(x), expected, atol=1e-5)
+            registry.unmerge()
+
+    # base weights come back after unmerge / unload
+    registry.unload("b")
+    for key, value in base_state.items():
+        layer, param = key.split(".")
+        assert torch.allclose(base[int(layer)].linear.state_dict()[param], value, atol=1e-6)
+    print("ok")
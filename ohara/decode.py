@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import torch
+import torch.nn as nn
+
+from torch import Tensor
+
+from ohara.sampling import sample
+
+
+class StaticDecoder:
+    def __init__(
+        self,
+        model: nn.Module,
+        batch_size: int = 1,
+        max_seq_len: int | None = None,
+        temperature: float = 0.0,
+        top_k: int | None = None,
+        compile: bool = True,
+        cuda_graph: bool = True,
+    ):
+        """
+        prefill + one token decode steps on static shape caches.
+
+        The model needs `setup_static_cache` (LLAMA, Phi). Every decode step sees
+        the same shapes, so it compiles once. On cuda the step is captured in a cuda
+        graph: through torch.compile(mode="reduce-overhead") when compiling, or a
+        manual torch.cuda.CUDAGraph otherwise. On cpu it runs compiled or eager.
+        """
+        self.model = model.eval()
+        self.batch_size = batch_size
+        self.temperature = temperature
+        self.top_k = top_k
+        self.device = next(model.parameters()).device
+        self.kv_cache = model.setup_static_cache(batch_size, max_seq_len)
+        self.max_seq_len = self.kv_cache[0].max_seq_len
+
+        use_graph = cuda_graph and self.device.type == "cuda"
+        self._graph: torch.cuda.CUDAGraph | None = None
+        self._step = self._decode_step
+        if compile:
+            mode = "reduce-overhead" if use_graph else None
+            self._step = torch.compile(self._decode_step, mode=mode, fullgraph=True)
+        elif use_graph:
+            self._capture()
+
+    def _decode_step(self, token: Tensor, input_pos: Tensor) -> Tensor:
+        logits = self.model(token, self.kv_cache, input_pos)
+        return sample(logits[:, -1], self.temperature, self.top_k)
+
+    @torch.inference_mode()
+    def _capture(self):
+        self._token = torch.zeros(self.batch_size, 1, dtype=torch.long, device=self.device)
+        self._pos = torch.zeros(1, dtype=torch.long, device=self.device)
+
+        # warmup on a side stream before capture, as torch.cuda.graphs asks for
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._decode_step(self._token, self._pos)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self._graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._graph):
+            self._next = self._decode_step(self._token, self._pos)
+        self.reset()
+
+    def decode(self, token: Tensor, input_pos: Tensor) -> Tensor:
+        "one step, token (B, 1), input_pos (1,) -> next token (B, 1)"
+        if self._graph is None:
+            # reduce-overhead outputs live in the graph pool and get overwritten next step
+            return self._step(token, input_pos).clone()
+        self._token.copy_(token)
+        self._pos.copy_(input_pos)
+        self._graph.replay()
+        return self._next.clone()
+
+    def reset(self):
+        for cache in self.kv_cache:
+            cache.reset()
+
+    @torch.inference_mode()
+    def generate(self, prompt: Tensor, max_new_tokens: int, eos_id: int | None = None, check_every: int = 16) -> Tensor:
+        """
+        prompt (B, T) -> (B, T + new tokens)
+        eos is tracked on device and only synced every `check_every` tokens
+        """
+        batch, prompt_len = prompt.shape
+        assert batch == self.batch_size, f"decoder was set up for batch {self.batch_size}, got {batch}"
+        max_new_tokens = min(max_new_tokens, self.max_seq_len - prompt_len)
+
+        # prefill has a different length every call, keep it out of the compiled step
+        input_pos = torch.arange(prompt_len, device=self.device)
+        logits = self.model(prompt, self.kv_cache, input_pos)
+        token = sample(logits[:, -1], self.temperature, self.top_k)
+
+        tokens = [prompt, token]
+        done = torch.zeros(batch, 1, dtype=torch.bool, device=self.device)
+        for i in range(1, max_new_tokens):
+            if eos_id is not None:
+                done |= token == eos_id
+                if i % check_every == 0 and bool(done.all()):
+                    break
+            input_pos = torch.tensor([prompt_len + i - 1], device=self.device)
+            token = self.decode(token, input_pos)
+            if eos_id is not None:
+                # rows that finished keep emitting eos
+                token = token.masked_fill(done, eos_id)
+            tokens.append(token)
+        return torch.cat(tokens, dim=1)
+
+
+if __name__ == "__main__":
+    from ohara.models.llama import LLAMA, Config
+
+    torch.manual_seed(0)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    config = Config(vocab_size=256, seq_len=64, d_model=64, num_heads=4, num_layers=2, dropout=0.0)
+    model = LLAMA(config).to(device).eval()
+    prompt = torch.randint(0, config.vocab_size, (1, 8), device=device)
+
+    # greedy static decode must match greedy decode without a cache
+    out = StaticDecoder(model, max_seq_len=32, compile=False).generate(prompt, 16)
+    ref = prompt
+    with torch.inference_mode():
+        for _ in range(16):
+            ref = torch.cat([ref, model(ref)[:, -1].argmax(-1, keepdim=True)], dim=1)
+    assert torch.equal(out, ref), (out, ref)
+    print("ok")
@@ -3,8 +3,11 @@ from __future__ import annotations
 import torch
 import torch.nn as nn
 from torch import Tensor
+from torch.profiler import record_function
 
 import math
+import functools
+from dataclasses import dataclass
 
 
 class RotatryEmbedding(nn.Module):
@@ -84,53 +87,127 @@ def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     return freqs_cis.view(shape)
 
 
-def apply_rope(q,k, cis):
-    # Idea suppose vector v = [x,y,x1,y1,...] # v.shape = dim
-    # convert vetor into complex num # ie two vec one real, one imagery
-    # [x,y,x1,y1,...] -> x+iy, x1+iy1
-    # Multiplying by complex num == roatate vector
-    # => (x + iy) * (cos + isin) -> x'+iy'
-    # restack
-    # x'+iy' -> [x',y',x1',y1'...]
-    # you roated vector in chunks of two lfg!!!
-    _, seq_len, _, _ = q.shape
-
+def _rope_tables(cis, x: Tensor) -> tuple[Tensor, Tensor]:
+    "(T, C//2) cos/sin -> (1, T, 1, C) cos and signed sin for interleaved pairs, in x.dtype"
     freqs_cos, freqs_sin = cis
-    freqs_cos, freqs_sin = freqs_cos[:seq_len], freqs_sin[:seq_len]
+    seq_len = x.shape[1]
+    freqs_cos = freqs_cos[:seq_len].to(x.dtype)
+    freqs_sin = freqs_sin[:seq_len].to(x.dtype)
+    cos = freqs_cos.repeat_interleave(2, dim=-1)  # [c0, c0, c1, c1, ...]
+    sin = torch.stack([-freqs_sin, freqs_sin], dim=-1).flatten(-2)  # [-s0, s0, -s1, s1, ...]
+    return cos[None, :, None, :], sin[None, :, None, :]
 
-    #  rehsape a shape (...,n )-> (..., n//2,2)
-    q_cis = q.float().reshape(
-        q.shape[:-1] + (-1, 2)
-    )  # (B,T,nhead,C) -> (B,T,nhead,Cc,2) # Cc = C//2
-    k_cis = k.float().reshape(k.shape[:-1] + (-1, 2))  # (B,T,nhead,C) -> (B,T,nhead,Cc,2)
 
-    xq_r, xq_i = q_cis.unbind(-1)  # (B,T,nhead,Cc,2) -> ((B,T,Cc), (B,T,Cc)) split into two tuple
-    xk_r, xk_i = k_cis.unbind(-1)  # (B,T,nhead,Cc,2) -> ((B,T,Cc), (B,T,Cc))
+def _swap_pairs(x: Tensor) -> Tensor:
+    # [x0, x1, x2, x3, ...] -> [x1, x0, x3, x2, ...]
+    return x.unflatten(-1, (-1, 2)).flip(-1).flatten(-2)
 
-    freqs_cos = reshape_for_broadcast(freqs_cos, xq_r)  # freqs.shape = (1,T,1,Cc)
-    freqs_sin = reshape_for_broadcast(freqs_sin, xq_r)
 
-    # e+if = (a+ib) * (c+di) = (ac-bd) + i (ad+bc)
-    # a = xq_r , b = xq_i
-    # c = fcos , d = fsin
-    # ...
-    # e = (ac-bd) = xq_r * freqs_cos - xq_i * freqs_sin
-    # f = (c+di)  = xq_r * freqs_sin + xq_i * freqs_cos
+# rope is a function, not a module, so ohara.utils.profiler module hooks never see it
+@record_function("ohara::rope")
+def apply_rope(q,k, cis):
+    # Idea suppose vector v = [x,y,x1,y1,...] # v.shape = dim
+    # treat every pair as complex num x+iy and multiply by (cos + isin) to rotate it
+    # (x + iy) * (c + is) = (xc - ys) + i(xs + yc)
+    # so with cos = [c,c,..] and sin = [-s,s,...]
+    # v' = v * cos + [y,x,y1,x1,...] * sin
+    # you roated vector in chunks of two lfg!!!
+    # runs in q.dtype, the tables are the only thing cast
+    cos, sin = _rope_tables(cis, q)
+    q_out = q * cos + _swap_pairs(q) * sin
+    k_out = k * cos + _swap_pairs(k) * sin
+    return q_out, k_out.type_as(q)
 
-    xq_out_r = xq_r * freqs_cos - xq_i * freqs_sin  # (ac-bd)   # shape =  # (B,T,nhead,Cc)
-    xq_out_i = xq_r * freqs_sin + xq_i * freqs_cos  # (ad+bc) * i
-    xk_out_r = xk_r * freqs_cos - xk_i * freqs_sin  # (ac-bd)
-    xk_out_i = xk_r * freqs_sin + xk_i * freqs_cos  # (ad+bc) * i
 
-    # now we stack r,i -> [r,i,r2,i2]
-    xq_out = torch.stack([xq_out_r, xq_out_i], dim=-1)  # (B,T,nhead,Cc,2)
-    xk_out = torch.stack([xk_out_r, xk_out_i], dim=-1)  # (B,T,nhead,Cc,2)
+@record_function("ohara::rope")
+def apply_rope_(q, k, cis):
+    "in place apply_rope, for inference where q and k are not needed by autograd"
+    cos, sin = _rope_tables(cis, q)
+    for x in (q, k):
+        swapped = _swap_pairs(x)
+        x.mul_(cos).addcmul_(swapped, sin)
+    return q, k
 
-    # flatten last two dimensions
-    xq_out = xq_out.flatten(3)  # (B,T,nhead,C)
-    xk_out = xk_out.flatten(3)  # (B,T,nhead,C)
 
-    return xq_out.type_as(q), xk_out.type_as(q)
+@dataclass(frozen=True)
+class RopeScaling:
+    """
+    stretch rope past the trained context length
+    linear: position interpolation, positions / factor
+    ntk:    ntk-aware, base * factor ** (dim / (dim - 2)), high freqs stay intact
+    yarn:   per frequency blend of the two plus attention temperature
+            https://arxiv.org/abs/2309.00071
+    """
+
+    type: str = "linear"
+    factor: float = 1.0
+    original_seq_len: int = 2048
+    beta_fast: float = 32.0
+    beta_slow: float = 1.0
+
+
+def rope_inv_freq(dim: int, base: float = 10000.0, scaling: RopeScaling | None = None) -> tuple[Tensor, float]:
+    "inverse frequencies for `dim` rotated features and the magnitude scale of cos/sin"
+    inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
+    if scaling is None or scaling.factor == 1.0:
+        return inv_freq, 1.0
+    if scaling.type == "linear":
+        return inv_freq / scaling.factor, 1.0
+    if scaling.type == "ntk":
+        return rope_inv_freq(dim, base * scaling.factor ** (dim / (dim - 2)))
+    if scaling.type == "yarn":
+        # pair index whose wavelength fits `num_rotations` times in the original context
+        def correction_dim(num_rotations: float) -> float:
+            return dim * math.log(scaling.original_seq_len / (num_rotations * 2 * math.pi)) / (2 * math.log(base))
+
+        low = max(math.floor(correction_dim(scaling.beta_fast)), 0)
+        high = min(math.ceil(correction_dim(scaling.beta_slow)), dim - 1)
+        # 0 -> high freq, extrapolate (keep), 1 -> low freq, interpolate
+        ramp = ((torch.arange(dim // 2).float() - low) / max(high - low, 1e-3)).clamp(0, 1)
+        inv_freq = inv_freq * (1 - ramp) + (inv_freq / scaling.factor) * ramp
+        return inv_freq, 0.1 * math.log(scaling.factor) + 1.0
+    raise ValueError(f"unknown rope scaling {scaling.type!r}, expected linear, ntk or yarn")
+
+
+class RopeCache:
+    """
+    cos/sin tables for one (dim, base, scaling), grown to the next power of two
+    on demand and kept per (dtype, device), so a forward is a slice not a recompute.
+    Get a shared instance with `rope_cache(...)`.
+    """
+
+    def __init__(self, dim: int, base: float = 10000.0, scaling: RopeScaling | None = None):
+        self.dim = dim
+        self.base = base
+        self.scaling = scaling
+        self.inv_freq, self.mscale = rope_inv_freq(dim, base, scaling)
+        self._tables: dict[tuple, tuple[Tensor, Tensor]] = {}
+
+    def _build(self, length: int, dtype: torch.dtype, device: torch.device) -> tuple[Tensor, Tensor]:
+        t = torch.arange(length, device=device, dtype=torch.float32)
+        freqs = torch.outer(t, self.inv_freq.to(device))
+        cos = (torch.cos(freqs) * self.mscale).to(dtype)
+        sin = (torch.sin(freqs) * self.mscale).to(dtype)
+        return cos, sin
+
+    def get(
+        self, end: int, offset: int = 0, dtype: torch.dtype = torch.float32, device=None
+    ) -> tuple[Tensor, Tensor]:
+        "(cos, sin) for positions [offset, end), each (end - offset, dim // 2)"
+        end = int(end)
+        device = torch.device(device or "cpu")
+        key = (dtype, device)
+        tables = self._tables.get(key)
+        if tables is None or tables[0].shape[0] < end:
+            tables = self._build(1 << max(end - 1, 1).bit_length(), dtype, device)
+            self._tables[key] = tables
+        cos, sin = tables
+        return cos[offset:end], sin[offset:end]
+
+
+@functools.lru_cache(maxsize=None)
+def rope_cache(dim: int, base: float = 10000.0, scaling: RopeScaling | None = None) -> RopeCache:
+    return RopeCache(dim, base, scaling)
 
 
 class RoPE(nn.Module):
@@ -166,6 +243,9 @@ class RoPE(nn.Module):
         self.traditional = traditional
         self.base = base
         self.scale = scale
+        # scaling positions by `scale` == linear interpolation with factor 1 / scale
+        scaling = RopeScaling("linear", 1 / scale) if scale != 1.0 else None
+        self.cache = rope_cache(dims, base, scaling)
 
     def _extra_repr(self):
         return f"{self.dims}, traditional={self.traditional}"
@@ -200,9 +280,7 @@ class RoPE(nn.Module):
         shape = x.shape
         x = x.reshape(-1, shape[-2], shape[-1])
         N = x.shape[1] + offset
-        costheta, sintheta = RoPE.create_cos_sin_theta(
-            N, self.dims, offset=offset, base=self.base, scale=self.scale, dtype=x.dtype
-        )
+        costheta, sintheta = self.cache.get(N, offset, dtype=x.dtype, device=x.device)
 
         rope = self._compute_traditional_rope if self.traditional else self._compute_rope
         rx = rope(costheta, sintheta, x)
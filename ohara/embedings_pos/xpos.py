@@ -17,12 +17,22 @@ class XPos(nn.Module):
         self.register_buffer("angle", angle)
         self.register_buffer("decay", decay)
 
-    def forward(self, slen, recurrent=False):
-        # todo chukwire retation
+    def forward(self, slen, recurrent=False, chunkwise=False, offset=0):
+        """
+        parallel  -> ((cos, sin), decay mask (H, T, T))
+        recurrent -> ((cos, sin) of position slen - 1, gamma (H,))
+        chunkwise -> ((cos, sin) of positions offset .. offset + slen, log gamma (H,)),
+                     no O(T^2) mask, see ohara.models.retnet.chunkwise_retention
+        """
         if recurrent:
             sin = torch.sin(self.angle * (slen - 1))
             cos = torch.cos(self.angle * (slen - 1))
             retention_rel_pos = ((cos, sin), self.decay.exp())
+        elif chunkwise:
+            index = torch.arange(offset, offset + slen).to(self.decay)
+            sin = torch.sin(index[:, None] * self.angle[None, :])
+            cos = torch.cos(index[:, None] * self.angle[None, :])
+            retention_rel_pos = ((cos, sin), self.decay)
         else:
             index = torch.arange(slen).to(self.decay)
             sin = torch.sin(index[:, None] * self.angle[None, :])
@@ -36,7 +46,6 @@ class XPos(nn.Module):
 
         return retention_rel_pos
 
-
 if __name__ == "__main__":
     xpos = XPos(64, 4)
     ((cos, sin), decay) = xpos.forward(8)
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import copy
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from torch import Tensor
+from collections.abc import Iterator
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    "strip torch.compile and fabric wrappers"
+    model = getattr(model, "_orig_mod", model)
+    model = getattr(model, "_original_module", model)
+    return getattr(model, "_orig_mod", model)
+
+
+class Evaluator:
+    def __init__(
+        self,
+        dataloader: Iterator,
+        num_batches: int = 100,
+        device: torch.device | str | None = None,
+        ignore_index: int = -1,
+        max_batch_size: int | None = None,
+        async_device: torch.device | str | None = None,
+    ):
+        """
+        Fixed held-out set evaluation.
+
+        `num_batches` batches are pulled from the dataloader once and kept on device,
+        so every eval sees the same tokens and no time is spent in the dataloader.
+        The eval batch size is probed once (doubling until OOM) instead of reusing the
+        training batch size. With `async_device` the eval runs on a replica of the model
+        on that device in a background thread while training continues.
+        """
+        self.ignore_index = ignore_index
+        self.async_device = torch.device(async_device) if async_device is not None else None
+        self.device = self.async_device or (torch.device(device) if device is not None else None)
+
+        data, target = [], []
+        for _ in range(num_batches):
+            (x, y) = next(dataloader)
+            data.append(x)
+            target.append(y)
+        self.data: Tensor = torch.cat(data).to(self.device)
+        self.target: Tensor = torch.cat(target).to(self.device)
+
+        self.batch_size: int = data[0].shape[0]
+        self.max_batch_size = max_batch_size or self.data.shape[0]
+        self._probed = False
+
+        self._replica: nn.Module | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending: list[tuple[int, Future]] = []
+
+    @property
+    def is_async(self) -> bool:
+        return self.async_device is not None
+
+    @property
+    def num_tokens(self) -> int:
+        return self.data.numel()
+
+    @torch.no_grad()
+    def _loss_sum(self, model: nn.Module, start: int, end: int) -> tuple[Tensor, Tensor]:
+        logits: Tensor = model(self.data[start:end])
+        target = self.target[start:end].reshape(-1)
+        loss = F.cross_entropy(
+            logits.view(-1, logits.size(-1)),
+            target,
+            ignore_index=self.ignore_index,
+            reduction="sum",
+        )
+        return loss, (target != self.ignore_index).sum()
+
+    @torch.no_grad()
+    def find_batch_size(self, model: nn.Module) -> int:
+        "largest power of two multiple of the loader batch size that fits in memory"
+        if self.data.device.type != "cuda":
+            self._probed = True
+            return self.batch_size
+
+        batch_size = self.batch_size
+        while batch_size * 2 <= self.max_batch_size:
+            try:
+                self._loss_sum(model, 0, batch_size * 2)
+            except torch.cuda.OutOfMemoryError:
+                break
+            finally:
+                torch.cuda.empty_cache()
+            batch_size *= 2
+        self.batch_size = batch_size
+        self._probed = True
+        return batch_size
+
+    @torch.no_grad()
+    def evaluate(self, model: nn.Module) -> Tensor:
+        "mean token loss over the cached set"
+        was_training = model.training
+        model.eval()
+        if not self._probed:
+            self.find_batch_size(model)
+
+        total = torch.zeros((), device=self.data.device)
+        count = torch.zeros((), device=self.data.device)
+        for start in range(0, self.data.shape[0], self.batch_size):
+            loss, n = self._loss_sum(model, start, start + self.batch_size)
+            total += loss.float()
+            count += n
+        model.train(was_training)
+        return total / count.clamp(min=1)
+
+    def submit(self, model: nn.Module, idx: int) -> None:
+        "snapshot weights onto the eval device and evaluate them in the background"
+        assert self.is_async, "pass async_device to use async evaluation"
+        if self._replica is None:
+            self._replica = copy.deepcopy(unwrap_model(model)).to(self.async_device).eval()
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        # wait for the previous eval, the replica is about to be overwritten
+        for _, future in self._pending:
+            future.result()
+        state = unwrap_model(model).state_dict()
+        self._replica.load_state_dict({k: v.to(self.async_device, non_blocking=True) for k, v in state.items()})
+        self._pending.append((idx, self._executor.submit(self.evaluate, self._replica)))
+
+    def poll(self, wait: bool = False) -> list[tuple[int, float]]:
+        "finished (idx, val_loss) pairs since last poll"
+        done, pending = [], []
+        for idx, future in self._pending:
+            if wait or future.done():
+                done.append((idx, future.result().item()))
+            else:
+                pending.append((idx, future))
+        self._pending = pending
+        return done
+
+    def close(self) -> list[tuple[int, float]]:
+        done = self.poll(wait=True)
+        if self._executor is not None:
+            self._executor.shutdown()
+        return done
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import os
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+
+from torch.distributed.fsdp import MixedPrecision
+
+import lightning as L
+from lightning.fabric.strategies import FSDPStrategy
+
+
+# param_dtype is what forward/backward runs in, reduce_dtype is what grads are
+# all-reduced in, buffers (rope tables, masks) stay in fp32 so positions don't drift
+MIXED_PRECISION = {
+    "32-true": None,
+    "bf16-mixed": MixedPrecision(
+        param_dtype=torch.bfloat16,
+        reduce_dtype=torch.float32,
+        buffer_dtype=torch.float32,
+    ),
+    "bf16-true": MixedPrecision(
+        param_dtype=torch.bfloat16,
+        reduce_dtype=torch.bfloat16,
+        buffer_dtype=torch.float32,
+    ),
+    "16-mixed": MixedPrecision(
+        param_dtype=torch.float16,
+        reduce_dtype=torch.float32,
+        buffer_dtype=torch.float32,
+    ),
+    "16-true": MixedPrecision(
+        param_dtype=torch.float16,
+        reduce_dtype=torch.float16,
+        buffer_dtype=torch.float32,
+    ),
+}
+
+
+def block_classes(model: nn.Module) -> set[type[nn.Module]]:
+    """
+    Module classes FSDP should wrap (one shard unit per transformer block).
+    Every ohara model keeps its blocks in `model.layers`, fall back to anything named *Block.
+    """
+    layers = getattr(model, "layers", None)
+    if isinstance(layers, nn.ModuleList) and len(layers) > 0:
+        return {type(layer) for layer in layers}
+    return {type(m) for m in model.modules() if type(m).__name__.endswith("Block")}
+
+
+def fsdp_strategy(
+    auto_wrap_policy: set[type[nn.Module]],
+    precision: str | None = None,
+    sharding_strategy: str = "FULL_SHARD",
+    cpu_offload: bool = False,
+    activation_checkpointing: bool = False,
+    state_dict_type: str = "sharded",
+) -> FSDPStrategy:
+    """
+    Build a Fabric FSDP strategy that shards params, grads and optimizer state per block.
+
+    Args:
+        auto_wrap_policy: block classes to wrap, eg. `{Block}` or `block_classes(model)`
+        precision: key of MIXED_PRECISION, None lets Fabric derive it from its own `precision`
+        sharding_strategy: "FULL_SHARD" (ZeRO-3), "SHARD_GRAD_OP" (ZeRO-2), "NO_SHARD" (DDP)
+        cpu_offload: keep sharded params on cpu between uses
+        activation_checkpointing: recompute block activations in backward
+        state_dict_type: "sharded" writes one file per rank, "full" gathers on rank 0
+    """
+    return FSDPStrategy(
+        auto_wrap_policy=auto_wrap_policy,
+        activation_checkpointing_policy=auto_wrap_policy if activation_checkpointing else None,
+        mixed_precision=MIXED_PRECISION[precision] if precision else None,
+        sharding_strategy=sharding_strategy,
+        cpu_offload=cpu_offload,
+        state_dict_type=state_dict_type,
+    )
+
+
+def save_checkpoint(
+    fabric: L.Fabric, path: str, model: nn.Module, optimizer: optim.Optimizer, **kwargs
+) -> None:
+    """
+    Pass module/optimizer objects (not state dicts) so fabric can gather or shard them
+    according to the strategy. Extra kwargs (idx, lr, ...) are stored as is.
+    """
+    state = {"model": model, "optimizer": optimizer, **kwargs}
+    fabric.save(path, state)
+
+
+def load_checkpoint(
+    fabric: L.Fabric, path: str, model: nn.Module, optimizer: optim.Optimizer | None = None
+) -> dict:
+    """
+    Load a (sharded or full) checkpoint in place and return the non-module entries.
+    """
+    state = {"model": model}
+    if optimizer is not None:
+        state["optimizer"] = optimizer
+    return fabric.load(path, state)
+
+
+# ------------------------------------------------------------------------------------------------
+# cpu/gloo loss parity check through the same path the Trainer uses (fsdp_strategy, Fabric,
+# save_checkpoint / load_checkpoint): FSDP on N processes must match a single process on the
+# full batch, and a model restored from the sharded checkpoint must continue the same curve.
+# run with: python -m ohara.fsdp
+
+
+def _tiny_llama():
+    from ohara.models.llama import LLAMA, Config
+
+    torch.manual_seed(0)
+    config = Config(
+        vocab_size=64,
+        seq_len=16,
+        d_model=32,
+        hidden_dim=64,
+        num_heads=4,
+        num_layers=2,
+        dropout=0.0,
+    )
+    return LLAMA(config)
+
+
+def _parity_batch(batch_size: int = 8, seq_len: int = 16, vocab_size: int = 64):
+    generator = torch.Generator().manual_seed(1)
+    tokens = torch.randint(0, vocab_size, (batch_size, seq_len + 1), generator=generator)
+    return tokens[:, :-1], tokens[:, 1:]
+
+
+def _train_steps(model, optimizer, data, target, steps: int, backward=None) -> list[torch.Tensor]:
+    losses = []
+    for _ in range(steps):
+        logits = model(data)
+        loss = F.cross_entropy(logits.view(-1, logits.size(-1)), target.reshape(-1))
+        backward(loss) if backward is not None else loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        losses.append(loss.detach())
+    return losses
+
+
+def _fabric_setup(fabric: L.Fabric):
+    # same order as trainer.main: module first, optimizer on the sharded parameters
+    model = fabric.setup_module(_tiny_llama())
+    optimizer = fabric.setup_optimizers(optim.AdamW(model.parameters(), lr=1e-3))
+    return model, optimizer
+
+
+def check_loss_parity(
+    world_size: int = 2, steps: int = 5, precision: str = "32-true", path: str | None = None, atol: float = 1e-4
+):
+    import tempfile
+
+    from ohara.models.llama import Block
+
+    strategy = fsdp_strategy({Block}, precision=precision, state_dict_type="sharded")
+    fabric = L.Fabric(accelerator="cpu", devices=world_size, strategy=strategy, precision=precision)
+    fabric.launch()
+    path = path or os.path.join(tempfile.gettempdir(), "ohara_fsdp_parity")
+
+    data, target = _parity_batch()
+    # reference: one process, full batch, one step past the checkpoint
+    model = _tiny_llama()
+    single = _train_steps(model, optim.AdamW(model.parameters(), lr=1e-3), data, target, steps + 1)
+    single = torch.stack(single).tolist()
+
+    data, target = data.chunk(world_size)[fabric.global_rank], target.chunk(world_size)[fabric.global_rank]
+    model, optimizer = _fabric_setup(fabric)
+    sharded = _train_steps(model, optimizer, data, target, steps, fabric.backward)
+    save_checkpoint(fabric, path, model, optimizer, idx=steps)
+
+    # fresh model and optimizer restored from the sharded checkpoint, one more step
+    model, optimizer = _fabric_setup(fabric)
+    remainder = load_checkpoint(fabric, path, model, optimizer)
+    assert remainder["idx"] == steps, remainder
+    sharded += _train_steps(model, optimizer, data, target, 1, fabric.backward)
+    sharded = (fabric.all_reduce(torch.stack(sharded), reduce_op="mean")).tolist()
+
+    if fabric.global_rank == 0:
+        for step, (a, b) in enumerate(zip(single, sharded)):
+            note = " (after checkpoint reload)" if step == steps else ""
+            print(f"step: {step} | single: {a:.6f} | fsdp x{world_size}: {b:.6f}{note}")
+            assert abs(a - b) < atol, f"loss mismatch at step {step}: {a} vs {b}"
+    return single, sharded
+
+
+if __name__ == "__main__":
+    check_loss_parity()
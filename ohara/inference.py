@@ -8,6 +8,8 @@ from typing import Optional
 
 from transformers import AutoTokenizer
 
+from ohara.sampling import sample_batched
+
 
 class Inference:
     def __init__(
@@ -15,8 +17,8 @@ class Inference:
         model: nn.Module,
         tokenizer: AutoTokenizer,
         device: str = None,
-        temperature: float = 1.0,
-        top_p: float = 0.0,
+        temperature: float = 0.0,
+        top_p: float = 1.0,
         max_new_tokens: int = 500,
         use_kv_cache: bool = True,
     ):
@@ -38,28 +40,17 @@ class Inference:
 
     @staticmethod
     @torch.inference_mode()
-    def sampler(logits, temperature=1, top_p=0.0) -> torch.Tensor:
+    def sampler(logits, temperature=0.0, top_p=1.0) -> torch.Tensor:
+        "(B, T, vocab) -> (B, 1), temperature 0 is greedy"
         logits = logits[:, -1]
-        if temperature == 1:
-            return torch.argmax(logits, dim=-1, keepdim=True)
-        logits = logits / temperature
-
-        probs = torch.softmax(logits, dim=-1)
-
-        probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)  # (B, vocab_size)
-
-        probs_sum = torch.cumsum(probs_sort, dim=-1)
-
-        mask = probs_sum - probs_sort > top_p
-
-        probs_sort[mask] = 0.0
-
-        probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
-
-        next_token = torch.multinomial(probs_sort, num_samples=1)
-
-        next_token = torch.gather(probs_idx, -1, next_token)
-        return next_token
+        batch = logits.size(0)
+        return sample_batched(
+            logits,
+            temperature=logits.new_full((batch,), temperature, dtype=torch.float),
+            top_k=logits.new_zeros(batch, dtype=torch.long),
+            top_p=logits.new_full((batch,), top_p, dtype=torch.float),
+            min_p=logits.new_zeros(batch, dtype=torch.float),
+        )
 
     def generate(
         self,
@@ -73,36 +64,49 @@ class Inference:
             temperature = self.default_temperature
         if top_p is None:
             top_p = self.default_top_p
-        if hasattr(self.model, "build_kv_cache"):
+        if max_new_tokens is None:
+            max_new_tokens = self.max_new_tokens
+        if self.use_kv_cache and hasattr(self.model, "build_kv_cache"):
             self.kv_cache = self.model.build_kv_cache()
         else:
             self.kv_cache = None
-        device = torch.device("cuda")
         inputs = self.tokenizer.encode(prompt)
-        inputs = torch.tensor(inputs).reshape(1, -1).to(device)
+        inputs = torch.tensor(inputs).reshape(1, -1).to(self.device)
+        prompt_len = inputs.shape[1]
+        eos_id = self.tokenizer.eos_token_id
+        done = torch.zeros(1, 1, dtype=torch.bool, device=self.device)
         input_pos = 0
         start_time = time.time()
         with torch.no_grad():
             if stream:
                 print(self.tokenizer.decode(inputs.tolist()[0]), end="")
-            for _ in range(max_new_tokens):
-                logits = (
-                    self.model(inputs, self.kv_cache, input_pos)
-                    if self.use_kv_cache
-                    else self.model(inputs)
-                )
+            for step in range(max_new_tokens):
+                if self.kv_cache is not None:
+                    # models take the whole sequence and only run the tokens from input_pos on
+                    logits = self.model(inputs, self.kv_cache, input_pos)
+                else:
+                    logits = self.model(inputs)
                 next_token = self.sampler(logits, temperature=temperature, top_p=top_p)
-                if next_token[:, -1:].item() == self.tokenizer.eos_token_id:
-                    break
-                inputs = torch.cat((inputs, next_token[:, -1:]), dim=-1)
-                input_pos = inputs.shape[1] - 1
+                input_pos = inputs.shape[1]
+                if eos_id is not None:
+                    # eos stays on device, printing is the only thing that syncs
+                    done |= next_token == eos_id
+                    next_token = next_token.masked_fill(done, eos_id)
+                inputs = torch.cat((inputs, next_token), dim=-1)
                 if stream:
-                    print(self.tokenizer.decode(inputs.tolist()[0][-1]), end="", flush=True)
+                    token = next_token.item()
+                    if token == eos_id:
+                        break
+                    print(self.tokenizer.decode(token), end="", flush=True)
+                elif eos_id is not None and step % 16 == 15 and bool(done.all()):
+                    break
             end_time = time.time()
+        generated = inputs[0, prompt_len:].tolist()
+        if eos_id in generated:
+            generated = generated[: generated.index(eos_id)]
         if stream:
             print(f"\nTime: {end_time - start_time}s")
-        return self.tokenizer.decode(inputs.tolist()[0][-1])
-
+        return self.tokenizer.decode(generated)
 
 if __name__ == "__main__":
     torch.manual_seed(0)
@@ -20,8 +20,13 @@ from typing import Tuple
 
 from ohara.modules.mlp import GEGLU
 from ohara.modules.norm import RMSNorm
-from ohara.embedings_pos.rotatry import precompute_freqs_cis
-from ohara.embedings_pos.rotatry import apply_rope
+from ohara.modules.kv_cache import KVCache, StaticKVCache, static_attention_mask
+from ohara.embedings_pos.rotatry import rope_cache
+from ohara.embedings_pos.rotatry import apply_rope, apply_rope_
+
+
+# sdpa broadcasts kv heads over query groups itself from torch 2.5 on, no repeat_interleave copy
+SDPA_GQA = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 5)
 
 
 @dataclass
@@ -69,11 +74,15 @@ class GemmaAttention(nn.Module):
 
         self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.d_model)
 
+        self.flash_attn = hasattr(torch.nn.functional, "scaled_dot_product_attention")
+
     def forward(
         self,
         x: torch.Tensor,
-        freqs_cis: torch.Tensor,
-        mask: torch.Tensor = None,
+        freqs_cis: tuple[Tensor, Tensor],
+        mask: torch.Tensor | None = None,
+        kv_cache: KVCache | StaticKVCache | None = None,
+        position_ids: Tensor | int | None = None,
     ) -> torch.Tensor:
         input_shape = x.shape
         assert len(input_shape) == 3
@@ -87,26 +96,50 @@ class GemmaAttention(nn.Module):
         k: Tensor = k.view(batch_size, -1, self.num_kv_heads, self.head_dim)
         v: Tensor = v.view(batch_size, -1, self.num_kv_heads, self.head_dim)
 
-        # Positional embedding.
-        q = apply_rope(q, freqs_cis=freqs_cis)
-        k = apply_rope(k, freqs_cis=freqs_cis)
-
-        # TODO: add code for kv chache
+        # Positional embedding, keys are rotated before they are cached
+        if torch.is_grad_enabled():
+            q, k = apply_rope(q, k, freqs_cis)
+        else:
+            q, k = apply_rope_(q, k, freqs_cis)
 
-        # Grouped Query Attention
-        if self.num_kv_heads != self.num_heads:
-            key = torch.repeat_interleave(k, self.num_queries_per_kv, dim=2)
-            value = torch.repeat_interleave(v, self.num_queries_per_kv, dim=2)
+        # the cache holds num_kv_heads heads, query groups are only expanded below
+        if kv_cache is not None:
+            k, v = kv_cache.forward(k, v, position_ids)
 
         q = q.transpose(1, 2)
-        k = key.transpose(1, 2)
-        v = value.transpose(1, 2)
-
-        attn_mtx = torch.matmul(q, k.transpose(2, 3)) * self.scaling
-        attn_mtx = attn_mtx + mask
-        attn_mtx = F.softmax(attn_mtx.float(), dim=-1).type_as(q)
+        k = k.transpose(1, 2)
+        v = v.transpose(1, 2)
 
-        output = torch.matmul(attn_mtx, v)
+        # Grouped Query Attention
+        grouped = self.num_kv_heads != self.num_heads
+        if grouped and not (self.flash_attn and SDPA_GQA):
+            k = torch.repeat_interleave(k, self.num_queries_per_kv, dim=1)
+            v = torch.repeat_interleave(v, self.num_queries_per_kv, dim=1)
+
+        kv_len = k.size(2)
+        if mask is None and seq_len > 1 and kv_len > seq_len:
+            # chunk of several new tokens after a cached prefix: causal, bottom right aligned
+            mask = torch.ones(seq_len, kv_len, dtype=torch.bool, device=q.device).tril(kv_len - seq_len)
+
+        if self.flash_attn:
+            kwargs = {"enable_gqa": True} if grouped and SDPA_GQA else {}
+            output = F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=mask,
+                is_causal=mask is None and seq_len == kv_len,
+                scale=self.scaling,
+                **kwargs,
+            )
+        else:
+            attn_mtx = torch.matmul(q, k.transpose(2, 3)) * self.scaling
+            if mask is not None and mask.dtype == torch.bool:
+                attn_mtx = attn_mtx.masked_fill(~mask, float("-inf"))
+            elif mask is not None:
+                attn_mtx = attn_mtx + mask[..., :seq_len, :kv_len]
+            attn_mtx = F.softmax(attn_mtx.float(), dim=-1).type_as(q)
+            output = torch.matmul(attn_mtx, v)
 
         output = output.transpose(1, 2).contiguous().view(batch_size, seq_len, -1)
         output = self.o_proj(output)
@@ -134,10 +167,12 @@ class Block(nn.Module):
     def forward(
         self,
         x: torch.Tensor,
-        freqs_cis: torch.Tensor,
-        mask: torch.Tensor,
+        freqs_cis: tuple[Tensor, Tensor],
+        mask: torch.Tensor | None,
+        kv_cache: KVCache | StaticKVCache | None = None,
+        position_ids: Tensor | int | None = None,
     ) -> torch.Tensor:
-        x = x + self.self_attn(x=self.ln1(x), freqs_cis=freqs_cis, mask=mask)
+        x = x + self.self_attn(self.ln1(x), freqs_cis, mask, kv_cache, position_ids)
         x = x + self.mlp(self.ln2(x))
 
         return x
@@ -158,28 +193,96 @@ class Gemma(nn.Module):
 
         self.token_emb.weight = self.vocab_proj.weight
 
-        self.cos, self.sin = precompute_freqs_cis(
-            model_args.d_model // model_args.num_heads, model_args.seq_len * 2
-        )
+        # shared cos/sin tables, created on the device / dtype they are asked for
+        self.rope = rope_cache(model_args.d_model // model_args.num_heads)
 
-        if hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        if not hasattr(torch.nn.functional, "scaled_dot_product_attention"):
             print("WARNING: using slow attention | upgrade pytorch to 2.0 or above")
             mask = torch.full((1, 1, model_args.seq_len, model_args.seq_len), float("-inf"))
             mask = torch.triu(mask, diagonal=1)
-            self.register_buffer("mask", mask)
+            self.register_buffer("mask", mask, persistent=False)
         else:
             self.mask = None
+        self._register_load_state_dict_pre_hook(self._drop_mask_buffer)
 
-    def forward(self, x: torch.Tensor):
-        batch, seqlen = x.shape
-        x = self.token_emb(x)
+    @staticmethod
+    def _drop_mask_buffer(state_dict, prefix, *args):
+        # older checkpoints saved the causal mask as a buffer
+        state_dict.pop(f"{prefix}mask", None)
 
-        device = self.token_emb.weight.device
-        freqs_cis = self.cos[:seqlen].to(device), self.sin[:seqlen].to(device)
-
-        for layer in self.layers:
-            x = layer(x, self.mask, freqs_cis)
+    def forward(
+        self, x: torch.Tensor, kv_cache: list[KVCache] | None = None, position_ids: Tensor | int | None = None
+    ):
+        """
+        same calling convention as LLAMA:
+        - no cache: x is the full sequence
+        - KVCache (build_kv_cache): x is everything so far, position_ids the int start of the new tokens
+        - StaticKVCache (setup_static_cache): x only the new tokens, position_ids their (T,) positions
+        """
+        if kv_cache is not None and isinstance(kv_cache[0], StaticKVCache):
+            x = self.token_emb(x)
+            freqs_cis = self.static_cos[position_ids], self.static_sin[position_ids]
+            mask = static_attention_mask(position_ids, kv_cache[0].max_seq_len, x.dtype)
+        else:
+            mask = self.mask
+            offset = 0
+            if kv_cache is not None:
+                x = x[:, position_ids:]
+                mask = None
+                offset = position_ids
+            x = self.token_emb(x)
+            freqs_cis = self.rope.get(offset + x.shape[1], offset, dtype=x.dtype, device=x.device)
+
+        for idx, layer in enumerate(self.layers):
+            cache = kv_cache[idx] if kv_cache is not None else None
+            x = layer(x, freqs_cis, mask, cache, position_ids)
 
         x = self.norm(x)
         x = self.vocab_proj(x)
         return x
+
+    def build_kv_cache(self) -> list[KVCache]:
+        "one cache per layer sized by num_kv_heads, not num_heads"
+        attn = self.layers[0].self_attn
+        shape = (1, self.config.seq_len, attn.num_kv_heads, attn.head_dim)
+        dtype = self.token_emb.weight.dtype
+        device = self.token_emb.weight.device
+        return [
+            KVCache(shape, self.config.seq_len, idx, device=device, dtype=dtype)
+            for idx in range(self.config.num_layers)
+        ]
+
+    def setup_static_cache(self, batch_size: int = 1, max_seq_len: int | None = None) -> list[StaticKVCache]:
+        "static shape caches for ohara.decode.StaticDecoder, see LLAMA.setup_static_cache"
+        max_seq_len = max_seq_len or self.config.seq_len
+        attn = self.layers[0].self_attn
+        dtype = self.token_emb.weight.dtype
+        device = self.token_emb.weight.device
+
+        cos, sin = self.rope.get(max_seq_len, dtype=torch.float32, device=device)
+        self.register_buffer("static_cos", cos, persistent=False)
+        self.register_buffer("static_sin", sin, persistent=False)
+        return [
+            StaticKVCache(batch_size, max_seq_len, attn.num_kv_heads, attn.head_dim, device=device, dtype=dtype)
+            for _ in range(self.config.num_layers)
+        ]
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    config = GemmaConfig(vocab_size=256, seq_len=64, d_model=64, num_heads=4, num_kv_heads=2, num_layers=2)
+    config.intermediate_size = 128
+    model = Gemma(config).eval()
+    tokens = torch.randint(0, config.vocab_size, (1, 24))
+
+    with torch.inference_mode():
+        full = model(tokens)
+
+        # prefill 16, then one token at a time through the cache
+        kv_cache = model.build_kv_cache()
+        logits = [model(tokens[:, :16], kv_cache, 0)]
+        for t in range(16, tokens.size(1)):
+            logits.append(model(tokens[:, : t + 1], kv_cache, t))
+        cached = torch.cat(logits, dim=1)
+    assert torch.allclose(full, cached, atol=1e-4), (full - cached).abs().max()
+    print("ok")
@@ -5,10 +5,12 @@ import torch.nn.functional as F
 import math
 from dataclasses import dataclass
 from ..modules.mlp import SwiGLU
-from ..modules.norm import RMSNorm
+from ..modules.norm import RMSNorm, AddRMSNorm
+from ..modules.fused import register_fused_layout
+from ..modules.kv_cache import StaticKVCache, static_attention_mask
 
-from ohara.embedings_pos.rotatry import precompute_freqs_cis
-from ohara.embedings_pos.rotatry import apply_rope
+from ohara.embedings_pos.rotatry import RopeScaling, rope_cache
+from ohara.embedings_pos.rotatry import apply_rope, apply_rope_
 
 
 
@@ -26,6 +28,8 @@ class Config:
     bias: int = False
     weight_tying: bool = False
     rope_theta: float = 100000
+    rope_scaling: RopeScaling | None = None
+    fused_proj: bool = False  # one qkv and one gate_up matmul per block
 
 
 class KVCache:
@@ -54,9 +58,16 @@ class Attention(nn.Module):
         assert self.num_heads % self.num_kv_heads == 0
         self.num_queries_per_kv = self.num_heads // self.num_kv_heads
 
-        self.key = nn.Linear(d_model, self.head_dim * self.num_kv_heads, cfg.bias)
-        self.query = nn.Linear(d_model, self.head_dim * self.num_heads, cfg.bias)
-        self.value = nn.Linear(d_model, self.head_dim * self.num_kv_heads, cfg.bias)
+        q_size = self.head_dim * self.num_heads
+        kv_size = self.head_dim * self.num_kv_heads
+        self.qkv_sizes = (q_size, kv_size, kv_size)
+        if cfg.fused_proj:
+            self.qkv = nn.Linear(d_model, q_size + 2 * kv_size, cfg.bias)
+        else:
+            self.key = nn.Linear(d_model, kv_size, cfg.bias)
+            self.query = nn.Linear(d_model, q_size, cfg.bias)
+            self.value = nn.Linear(d_model, kv_size, cfg.bias)
+        register_fused_layout(self, "qkv", ("query", "key", "value"), self.qkv_sizes)
         self.proj = nn.Linear(self.head_dim * self.num_heads, d_model, cfg.bias)
 
         self.attn_dropout = nn.Dropout(cfg.dropout)
@@ -71,21 +82,23 @@ class Attention(nn.Module):
         q: torch.Tensor
         v: torch.Tensor
 
-        k = self.key(x)
-        q = self.query(x)
-        v = self.value(x)
+        if hasattr(self, "qkv"):
+            q, k, v = self.qkv(x).split(self.qkv_sizes, dim=-1)
+        else:
+            k = self.key(x)
+            q = self.query(x)
+            v = self.value(x)
 
         k = k.view(batch, seq_len, self.num_kv_heads, self.head_dim)
         q = q.view(batch, seq_len, self.num_heads, self.head_dim)
         v = v.view(batch, seq_len, self.num_kv_heads, self.head_dim)
 
-        # Apply RoPE with position offset if using KV cache
-        offset = position_ids if kv_cache else 0
-        freqs_cos, freqs_sin = freqs_cis
-        if offset:
-            freqs_cos = freqs_cos[offset:offset + seq_len]
-            freqs_sin = freqs_sin[offset:offset + seq_len]
-        q, k = apply_rope(q, k, (freqs_cos, freqs_sin))
+        # freqs_cis already starts at the cache offset, keys are rotated once here before
+        # they are written so cached keys never get rotated again
+        if torch.is_grad_enabled():
+            q, k = apply_rope(q, k, freqs_cis)
+        else:
+            q, k = apply_rope_(q, k, freqs_cis)
 
         # Apply KV cache if provided
         if kv_cache is not None:
@@ -100,18 +113,27 @@ class Attention(nn.Module):
         q = q.transpose(1, 2)
         v = v.transpose(1, 2)
 
+        q_len, kv_len = q.size(2), k.size(2)
+        if mask is None and 1 < q_len < kv_len:
+            # chunk of several new tokens after a cached prefix: causal, bottom right aligned
+            mask = torch.ones(q_len, kv_len, dtype=torch.bool, device=q.device).tril(kv_len - q_len)
+
         if self.flash_attn:
+            # a decode step with a regular cache has a single query that sees every
+            # cached key, so it must not be causal (top left aligned)
             output = torch.nn.functional.scaled_dot_product_attention(
                 q,
                 k,
                 v,
-                attn_mask=None,
+                attn_mask=mask,
                 dropout_p=self.attn_dropout.p if self.training else 0.0,
-                is_causal=True,
+                is_causal=mask is None and q_len == kv_len,
             )
         else:
             attn_mtx = torch.matmul(q, k.transpose(2, 3)) / math.sqrt(self.head_dim)
-            if mask is not None:
+            if mask is not None and mask.dtype == torch.bool:
+                attn_mtx = attn_mtx.masked_fill(~mask, float("-inf"))
+            elif mask is not None:
                 attn_mtx = attn_mtx + mask[:, :, :seq_len, :k.size(2)]
             attn_mtx = F.softmax(attn_mtx.float(), dim=-1).type_as(k)
             attn_mtx = self.attn_dropout(attn_mtx)
@@ -133,15 +155,16 @@ class Block(nn.Module):
             hidden_dim=cfg.hidden_dim,
             dropout=cfg.dropout,
             bias=cfg.bias,
+            fused=cfg.fused_proj,
         )
 
         self.norm1 = RMSNorm(cfg.d_model)
-        self.norm2 = RMSNorm(cfg.d_model)
+        self.norm2 = AddRMSNorm(cfg.d_model)
 
     def forward(self, x, mask, freqs_cis, kv_cache: KVCache | None = None, position_ids: torch.Tensor | None = None):
-        x = x + self.attn(self.norm1(x), mask, freqs_cis, kv_cache, position_ids)
-        x = x + self.ff(self.norm2(x))
-        return x
+        # attention residual is added inside norm2, one pass over x instead of two
+        h, x = self.norm2(self.attn(self.norm1(x), mask, freqs_cis, kv_cache, position_ids), residual=x)
+        return x + self.ff(h)
 
 
 class LLAMA(nn.Module):
@@ -160,9 +183,10 @@ class LLAMA(nn.Module):
         if cfg.weight_tying:
             self.token_emb.weight = self.vocab_proj.weight
 
-        cos, isin = precompute_freqs_cis(cfg.d_model // cfg.num_heads, cfg.seq_len * 2)
-        self.register_buffer("freq_cos", cos)
-        self.register_buffer("freq_sin", isin)
+        # shared cos/sin tables, grown on demand instead of seq_len * 2 buffers.
+        # base stays at 10000 (not cfg.rope_theta), that is what existing checkpoints were trained with
+        self.rope = rope_cache(cfg.d_model // cfg.num_heads, 10000.0, cfg.rope_scaling)
+        self._register_load_state_dict_pre_hook(self._drop_rope_buffers)
 
         if not hasattr(torch.nn.functional, "scaled_dot_product_attention"):
             print("WARNING: using slow attention | upgrade pytorch to 2.0 or above")
@@ -177,14 +201,22 @@ class LLAMA(nn.Module):
     def forward(self, x: torch.Tensor, kv_cache: list[KVCache] | None = None, position_ids: torch.Tensor | None = None):
         batch, seqlen = x.shape
         x = self.token_emb(x)
-        device = self.token_emb.weight.device
-        freqs_cis = self.freq_cos[:seqlen], self.freq_sin[:seqlen]
 
-        # Handle KV caching mask adjustment
-        mask = self.mask
-        if kv_cache is not None:
-            x = x[:, position_ids:]
-            mask = None
+        if kv_cache is not None and isinstance(kv_cache[0], StaticKVCache):
+            # x only holds the new tokens and position_ids their (T,) positions,
+            # no python ints so every decode step has the same graph
+            freqs_cis = self.static_cos[position_ids], self.static_sin[position_ids]
+            mask = static_attention_mask(position_ids, kv_cache[0].max_seq_len, x.dtype)
+        else:
+            # Handle KV caching mask adjustment
+            mask = self.mask
+            offset = 0
+            if kv_cache is not None:
+                x = x[:, position_ids:]
+                mask = None
+                offset = position_ids
+
+            freqs_cis = self.rope.get(offset + x.shape[1], offset, dtype=x.dtype, device=x.device)
 
         # Forward through layers with KV cache
         for idx, layer in enumerate(self.layers):
@@ -195,13 +227,20 @@ class LLAMA(nn.Module):
         x = self.vocab_proj(x)
         return x
 
+    @staticmethod
+    def _drop_rope_buffers(state_dict, prefix, *args):
+        # older checkpoints stored the rope tables as buffers
+        for name in ("freq_cos", "freq_sin"):
+            state_dict.pop(f"{prefix}{name}", None)
+
     def build_kv_cache(self) -> list[KVCache]:
         """Build an empty KV cache suitable for the model's configuration."""
+        attn = self.layers[0].attn
         shape = (
             1,
             self.config.seq_len,
-            self.config.num_heads,
-            self.config.d_model // self.config.num_heads,
+            attn.num_kv_heads,
+            attn.head_dim,
         )
         kv_cache = []
         dtype = self.token_emb.weight.dtype
@@ -211,6 +250,24 @@ class LLAMA(nn.Module):
             kv_cache.append(KVCache(shape, self.config.seq_len, idx, device=device, dtype=dtype))
         return kv_cache
 
+    def setup_static_cache(self, batch_size: int = 1, max_seq_len: int | None = None) -> list[StaticKVCache]:
+        """
+        static shape caches for compiled / cuda graph decode, pass them as kv_cache
+        with position_ids as a (T,) LongTensor of the positions of the tokens in x
+        """
+        max_seq_len = max_seq_len or self.config.seq_len
+        attn = self.layers[0].attn
+        dtype = self.token_emb.weight.dtype
+        device = self.token_emb.weight.device
+
+        cos, sin = self.rope.get(max_seq_len, dtype=torch.float32, device=device)
+        self.register_buffer("static_cos", cos, persistent=False)
+        self.register_buffer("static_sin", sin, persistent=False)
+        return [
+            StaticKVCache(batch_size, max_seq_len, attn.num_kv_heads, attn.head_dim, device=device, dtype=dtype)
+            for _ in range(self.config.num_layers)
+        ]
+
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
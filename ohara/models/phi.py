@@ -12,6 +12,9 @@ import torch.nn as nn
 from torch import Tensor
 from safetensors import safe_open
 from ohara.utils.load import download_hf_model
+from ohara.modules.fused import register_fused_layout
+from ohara.embedings_pos.rotatry import RopeScaling, rope_cache
+from ohara.modules.kv_cache import StaticKVCache, static_attention_mask
 
 from tqdm import tqdm
 
@@ -28,6 +31,7 @@ class PhiConfig:
     bias: bool = True
     eps: float = 1e-5
     rotary_dim: float = 0.4
+    fused_qkv: bool = False
 
 
 class KVCache:
@@ -61,6 +65,9 @@ class RoPE(nn.Module):
         self.traditional = traditional
         self.base = base
         self.scale = scale
+        # scaling positions by `scale` == linear interpolation with factor 1 / scale
+        scaling = RopeScaling("linear", 1 / scale) if scale != 1.0 else None
+        self.cache = rope_cache(dims, base, scaling)
 
     def _extra_repr(self):
         return f"{self.dims}, traditional={self.traditional}"
@@ -90,19 +97,15 @@ class RoPE(nn.Module):
 
         return rx
 
-    def forward(self, x: Tensor, offset: int = 0):
+    def forward(self, x: Tensor, offset: int = 0, cis: tuple[Tensor, Tensor] | None = None):
+        "cis: (cos, sin) already gathered at the positions of x, used instead of offset"
         shape = x.shape
         x = x.reshape(-1, shape[-2], shape[-1])
-        N = x.shape[1] + offset
-        costheta, sintheta = RoPE.create_cos_sin_theta(
-            N,
-            self.dims,
-            offset=offset,
-            base=self.base,
-            scale=self.scale,
-            dtype=x.dtype,
-            device=x.device,
-        )
+        if cis is None:
+            N = x.shape[1] + offset
+            costheta, sintheta = self.cache.get(N, offset, dtype=x.dtype, device=x.device)
+        else:
+            costheta, sintheta = cis
 
         rope = self._compute_traditional_rope if self.traditional else self._compute_rope
         rx = rope(costheta, sintheta, x)
@@ -153,17 +156,23 @@ class LayerNorm(nn.LayerNorm):
 
 
 class PhiMHA(nn.Module):
-    def __init__(self, layer_idx, dim, num_heads, rotary_dim) -> None:
+    def __init__(self, layer_idx, dim, num_heads, rotary_dim, fused: bool = False) -> None:
         super().__init__()
         self.dim = dim
         self.num_heads = num_heads
         self.head_dim = dim // num_heads
         self.layer_idx = layer_idx
+        self.fused = fused
 
-        self.k_proj = nn.Linear(dim, dim)
-        self.q_proj = nn.Linear(dim, dim)
-        self.v_proj = nn.Linear(dim, dim)
+        if fused:
+            self.qkv_proj = nn.Linear(dim, 3 * dim)
+        else:
+            self.k_proj = nn.Linear(dim, dim)
+            self.q_proj = nn.Linear(dim, dim)
+            self.v_proj = nn.Linear(dim, dim)
         self.dense = nn.Linear(dim, dim)
+        # hf checkpoints ship q/k/v separately
+        register_fused_layout(self, "qkv_proj", ("q_proj", "k_proj", "v_proj"), (dim, dim, dim))
 
         self.rope = RoPE(int(rotary_dim * self.head_dim), traditional=False)
 
@@ -173,35 +182,42 @@ class PhiMHA(nn.Module):
         mask: Tensor = None,
         kv_cache: KVCache | None = None,
         position_ids: Tensor | None = None,
+        cis: tuple[Tensor, Tensor] | None = None,
     ) -> Tensor:
         batch_size, seq_length, d_model = x.shape
         # print(f"{batch_size}, {seq_length}, {d_model}")
-        k = self.k_proj(x)
-        q = self.q_proj(x)
-        v = self.v_proj(x)
+        if self.fused:
+            q, k, v = self.qkv_proj(x).chunk(3, dim=-1)
+        else:
+            k = self.k_proj(x)
+            q = self.q_proj(x)
+            v = self.v_proj(x)
 
         k = k.view(batch_size, seq_length, self.num_heads, self.head_dim)
         q = q.view(batch_size, seq_length, self.num_heads, self.head_dim)
         v = v.view(batch_size, seq_length, self.num_heads, self.head_dim)
 
+        # rotate new keys once at their position before they go into the cache,
+        # cached keys are already rotated
+        static = isinstance(kv_cache, StaticKVCache)
+        offset = position_ids if kv_cache and not static else 0
+        q = self.rope.forward(q.transpose(1, 2).float(), offset, cis)  # rope wants (..., seq_len, head_dim)
+        k = self.rope.forward(k.transpose(1, 2).float(), offset, cis).transpose(1, 2).type_as(v)
+
         if kv_cache is not None:
             k, v = kv_cache.forward(k, v, position_ids)
 
         k: Tensor = k.transpose(1, 2).to(torch.float32)  # shape = (B, num_heads, seq_len, head_dim)
-        q: Tensor = q.transpose(1, 2).to(torch.float32)
+        q: Tensor = q.to(torch.float32)
         v: Tensor = v.transpose(1, 2).to(torch.float32)
 
-        offset = position_ids if kv_cache else 0
-
-        q = self.rope.forward(q, offset=offset).to(torch.float32)
-        k = self.rope.forward(k).to(torch.float32)
-
         # Finally perform the attention computation
         scale = math.sqrt(1 / q.shape[-1])
         scores = (q @ k.transpose(-1, -2)) * scale
 
         if mask is not None:
-            mask = mask[:, :, :seq_length, :seq_length]
+            # static masks already cover (seq_length, max_seq_len)
+            mask = mask if static else mask[:, :, :seq_length, :seq_length]
             scores = scores + mask
 
         scores = torch.softmax(scores, dim=-1).type_as(v)
@@ -241,7 +257,9 @@ class Block(nn.Module):
         self.ln = LayerNorm(config.d_model, eps=config.eps)
         self.block_idx = block_idx
 
-        self.mixer = PhiMHA(block_idx, config.d_model, config.num_heads, config.rotary_dim)
+        self.mixer = PhiMHA(
+            block_idx, config.d_model, config.num_heads, config.rotary_dim, fused=config.fused_qkv
+        )
         self.mlp = MLP(config.d_model, config.multiple_of * config.d_model)
 
     def forward(
@@ -250,10 +268,11 @@ class Block(nn.Module):
         mask: torch.BoolTensor | None = None,
         kv_cache: list[KVCache] | None = None,
         position_ids: torch.LongTensor | None = None,
+        cis: tuple[Tensor, Tensor] | None = None,
     ) -> torch.FloatTensor:
         residual = x
         x = self.ln(x)
-        return self.mixer(x, mask, kv_cache, position_ids) + self.mlp(x) + residual
+        return self.mixer(x, mask, kv_cache, position_ids, cis) + self.mlp(x) + residual
 
 
 class Phi(nn.Module):
@@ -281,7 +300,12 @@ class Phi(nn.Module):
 
     def forward(self, x, kv_cache: list[KVCache] | None = None, position_ids=None):
         mask = self.mask
-        if kv_cache is not None:
+        cis = None
+        if kv_cache is not None and isinstance(kv_cache[0], StaticKVCache):
+            # x only holds the new tokens, position_ids is their (T,) LongTensor of positions
+            mask = static_attention_mask(position_ids, kv_cache[0].max_seq_len)
+            cis = self.static_cos[position_ids], self.static_sin[position_ids]
+        elif kv_cache is not None:
             x = x[:, position_ids:]
             mask = None
         # print(f"{x.shape=} {kv_cache=}")
@@ -291,7 +315,7 @@ class Phi(nn.Module):
         for idx, layer in enumerate(self.layers):
             if kv_cache is not None:
                 cache = kv_cache[idx]
-            x = layer(x.to(self.wte.weight.dtype), mask, cache, position_ids=position_ids)
+            x = layer(x.to(self.wte.weight.dtype), mask, cache, position_ids=position_ids, cis=cis)
 
         x = self.ln(x)
         x = self.lm_head(x)
@@ -316,9 +340,25 @@ class Phi(nn.Module):
             kv_cache.append(KVCache(shape, self.config.seq_len, idx, device=device, dtype=dtype))
         return kv_cache
 
+    def setup_static_cache(self, batch_size: int = 1, max_seq_len: int | None = None) -> list[StaticKVCache]:
+        "static shape caches for compiled / cuda graph decode, see LLAMA.setup_static_cache"
+        max_seq_len = max_seq_len or self.config.seq_len
+        dtype = self.wte.weight.dtype
+        device = self.wte.weight.device
+        rope = self.layers[0].mixer.rope
+
+        cos, sin = rope.cache.get(max_seq_len, dtype=torch.float32, device=device)
+        self.register_buffer("static_cos", cos, persistent=False)
+        self.register_buffer("static_sin", sin, persistent=False)
+        head_dim = self.config.d_model // self.config.num_heads
+        return [
+            StaticKVCache(batch_size, max_seq_len, self.config.num_heads, head_dim, device=device, dtype=dtype)
+            for _ in range(self.config.num_layers)
+        ]
+
     @staticmethod
-    def from_pretrained(name: str) -> nn.Module:
-        config = PhiConfig()
+    def from_pretrained(name: str, config: PhiConfig | None = None) -> nn.Module:
+        config = config or PhiConfig()
         with torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16):
             model = Phi(config).half()
         # return model
@@ -375,53 +415,15 @@ class Phi(nn.Module):
             )
             layer.mlp.fc2.bias.data = weights[f"model.layers.{idx}.mlp.fc2.bias"]
 
-            assert (
-                layer.mixer.q_proj.weight.data.shape
-                == weights[f"model.layers.{idx}.self_attn.q_proj.weight"].shape
-            )
-            layer.mixer.q_proj.weight.data = weights[f"model.layers.{idx}.self_attn.q_proj.weight"]
-
-            assert (
-                layer.mixer.q_proj.bias.data.shape
-                == weights[f"model.layers.{idx}.self_attn.q_proj.bias"].shape
-            )
-            layer.mixer.q_proj.bias.data = weights[f"model.layers.{idx}.self_attn.q_proj.bias"]
-
-            assert (
-                layer.mixer.k_proj.weight.data.shape
-                == weights[f"model.layers.{idx}.self_attn.k_proj.weight"].shape
-            )
-            layer.mixer.k_proj.weight.data = weights[f"model.layers.{idx}.self_attn.k_proj.weight"]
-
-            assert (
-                layer.mixer.k_proj.bias.data.shape
-                == weights[f"model.layers.{idx}.self_attn.k_proj.bias"].shape
-            )
-            layer.mixer.k_proj.bias.data = weights[f"model.layers.{idx}.self_attn.k_proj.bias"]
-
-            assert (
-                layer.mixer.v_proj.weight.data.shape
-                == weights[f"model.layers.{idx}.self_attn.v_proj.weight"].shape
-            )
-            layer.mixer.v_proj.weight.data = weights[f"model.layers.{idx}.self_attn.v_proj.weight"]
-
-            assert (
-                layer.mixer.v_proj.bias.data.shape
-                == weights[f"model.layers.{idx}.self_attn.v_proj.bias"].shape
-            )
-            layer.mixer.v_proj.bias.data = weights[f"model.layers.{idx}.self_attn.v_proj.bias"]
-
-            assert (
-                layer.mixer.dense.weight.data.shape
-                == weights[f"model.layers.{idx}.self_attn.dense.weight"].shape
-            )
-            layer.mixer.dense.weight.data = weights[f"model.layers.{idx}.self_attn.dense.weight"]
-
-            assert (
-                layer.mixer.dense.bias.data.shape
-                == weights[f"model.layers.{idx}.self_attn.dense.bias"].shape
+            # goes through the fused layout hook, shapes are checked by load_state_dict
+            attn = f"model.layers.{idx}.self_attn."
+            layer.mixer.load_state_dict(
+                {
+                    f"{proj}.{p}": weights[f"{attn}{proj}.{p}"]
+                    for proj in ("q_proj", "k_proj", "v_proj", "dense")
+                    for p in ("weight", "bias")
+                }
             )
-            layer.mixer.dense.bias.data = weights[f"model.layers.{idx}.self_attn.dense.bias"]
 
             assert (
                 layer.ln.weight.data.shape
@@ -1,6 +1,9 @@
+from __future__ import annotations
+
 import torch
 import torch.nn as nn
 
+from torch import Tensor
 from dataclasses import dataclass
 
 from ohara.modules.mlp import SwiGLU
@@ -19,85 +22,93 @@ class Config:
     multiple_of: int = 4
     bias: bool = False
     eps: float = 1e-5
-
-
-# rotary embedding
-
-
-def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
-    freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
-    # [: (dim // 2)] for odd number truncation
-    # torch.arange(0, dim, 2) -> 2(i-1)//d while i= 1,2,..,(d//2)
-
-    t = torch.arange(end, device=freqs.device)
-    freqs = torch.outer(t, freqs).float()  # gives diffrent angle vector
-
-    # e^it = cos(t) + i sin(t)
-    freqs_cos = torch.cos(freqs)  # real
-    freqs_sin = torch.sin(freqs)  # imaginary
-    return freqs_cos, freqs_sin
-
-
-def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
-    ndim = x.dim()
-    assert 1 < ndim
-    assert freqs_cis.shape == (
-        x.shape[1],
-        x.shape[-1],
-    ), f"{freqs_cis.shape=}, {(x.shape[1], x.shape[-1])=}"
-
-    # keep 2nd (T) and last(freq) dim same else make dim 1 for freq_cis
-    shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
-    # print(shape)
-    return freqs_cis.view(shape)
-
-
-def apply_rope(k, q, freqs_sin, freqs_cos):
-    # Idea suppose vector v = [x,y,x1,y1,...] # v.shape = dim
-    # convert vetor into complex num # ie two vec one real, one imagery
-    # [x,y,x1,y1,...] -> x+iy, x1+iy1
-    # Multiplying by complex num == roatate vector
-    # => (x + iy) * (cos + isin) -> x'+iy'
-    # restack
-    # x'+iy' -> [x',y',x1',y1'...]
-    # you roated vector in chunks of two lfg!!!
-
-    #  rehsape a shape (...,n )-> (..., n//2,2)
-    q_cis = q.float().reshape(
-        q.shape[:-1] + (-1, 2)
-    )  # (B,T,nhead,C) -> (B,T,nhead,Cc,2) # Cc = C//2
-    k_cis = k.float().reshape(k.shape[:-1] + (-1, 2))  # (B,T,nhead,C) -> (B,T,nhead,Cc,2)
-
-    xq_r, xq_i = q_cis.unbind(-1)  # (B,T,nhead,Cc,2) -> ((B,T,Cc), (B,T,Cc)) split into two tuple
-    xk_r, xk_i = k_cis.unbind(-1)  # (B,T,nhead,Cc,2) -> ((B,T,Cc), (B,T,Cc))
-
-    freqs_cos = reshape_for_broadcast(freqs_cos, xq_r)  # freqs.shape = (1,T,1,Cc)
-    freqs_sin = reshape_for_broadcast(freqs_cos, xq_r)
-
-    # e+if = (a+ib) * (c+di) = (ac-bd) + i (ad+bc)
-    # a = xq_r , b = xq_i
-    # c = fcos , d = fsin
-    # ...
-    # e = (ac-bd) = xq_r * freqs_cos - xq_i * freqs_sin
-    # f = (c+di)  = xq_r * freqs_sin + xq_i * freqs_cos
-
-    xq_out_r = xq_r * freqs_cos - xq_i * freqs_sin  # (ac-bd)   # shape =  # (B,T,nhead,Cc)
-    xq_out_i = xq_r * freqs_sin + xq_i * freqs_cos  # (ad+bc) * i
-    xk_out_r = xk_r * freqs_cos - xk_i * freqs_sin  # (ac-bd)
-    xk_out_i = xk_r * freqs_sin + xk_i * freqs_cos  # (ad+bc) * i
-
-    # now we stack r,i -> [r,i,r2,i2]
-    xq_out = torch.stack([xq_out_r, xq_out_i], dim=-1)  # (B,T,nhead,Cc,2)
-    xk_out = torch.stack([xk_out_r, xk_out_i], dim=-1)  # (B,T,nhead,Cc,2)
-
-    # flatten last two dimensions
-    xq_out = xq_out.flatten(3)  # (B,T,nhead,C)
-    xk_out = xk_out.flatten(3)  # (B,T,nhead,C)
-
-    return xq_out.type_as(q), xk_out.type_as(q)
-
-
-class Retation(nn.Module):
+    chunk_size: int = 64
+
+
+# Retention: https://arxiv.org/abs/2307.08621
+#
+# Every mode computes o_i = sum_{j<=i} gamma^(i-j) (q_i . k_j) v_j / sqrt(sum_{j<=i} gamma^(i-j))
+# per head. The parallel form gets the normalizer from the XPos mask rows, the others
+# from its closed form, so the three agree exactly. Chunkwise / recurrent keep the
+# running state in fp32.
+
+
+def decay_norm(position: Tensor, log_decay: Tensor) -> Tensor:
+    "sqrt(sum_{j<=i} gamma^(i-j)) = sqrt((1 - gamma^(i+1)) / (1 - gamma)) -> (H, T, 1)"
+    log_decay = log_decay.float().view(-1, 1)
+    total = torch.expm1((position.float() + 1) * log_decay) / torch.expm1(log_decay)
+    return total.sqrt().unsqueeze(-1)
+
+
+def rotate_every_two(x: Tensor) -> Tensor:
+    x1, x2 = x[..., ::2], x[..., 1::2]
+    return torch.stack((-x2, x1), dim=-1).flatten(-2)
+
+
+def theta_shift(x: Tensor, cos: Tensor, sin: Tensor) -> Tensor:
+    "xpos rotation, cos / sin are (T, head_dim) with every angle repeated twice"
+    return x * cos + rotate_every_two(x) * sin
+
+
+def parallel_retention(q: Tensor, k: Tensor, v: Tensor, mask: Tensor) -> Tensor:
+    "O(T^2) form for training, mask (H, T, T) from XPos"
+    return (q @ k.mT * mask) @ v
+
+
+def chunkwise_retention(
+    q: Tensor,
+    k: Tensor,
+    v: Tensor,
+    log_decay: Tensor,
+    chunk_size: int,
+    state: Tensor | None = None,
+    offset: int = 0,
+) -> tuple[Tensor, Tensor]:
+    """
+    chunkwise recurrent form: parallel inside chunks of `chunk_size`, recurrent across
+    them, so memory is O(T * chunk_size) instead of O(T^2).
+    q, k, v (B, H, T, D), log_decay (H,), offset = tokens already in state
+    -> (out (B, H, T, D), state (B, H, D, D))
+    """
+    batch, num_heads, seq_len, head_dim = q.shape
+    if state is None:
+        state = q.new_zeros(batch, num_heads, head_dim, v.size(-1), dtype=torch.float)
+    log_decay = log_decay.float().view(num_heads, 1)
+    index = torch.arange(chunk_size, device=q.device)
+    # gamma^(i - j) for j <= i inside a chunk
+    distance = (index[:, None] - index[None, :]).masked_fill(index[:, None] < index[None, :], 0)
+    inner_decay = torch.exp(distance * log_decay[..., None]).tril()  # (H, C, C)
+
+    out = []
+    for start in range(0, seq_len, chunk_size):
+        qc, kc, vc = (t[:, :, start : start + chunk_size].float() for t in (q, k, v))
+        n = qc.size(2)
+        # query i reads the carried state decayed by gamma^(i + 1),
+        # key j reaches the next state decayed by gamma^(n - 1 - j)
+        q_decay = torch.exp((index[:n] + 1) * log_decay).unsqueeze(-1)
+        k_decay = torch.exp((n - 1 - index[:n]) * log_decay).unsqueeze(-1)
+        inner = (qc @ kc.mT * inner_decay[:, :n, :n]) @ vc
+        cross = (qc * q_decay) @ state
+        norm = decay_norm(offset + start + index[:n], log_decay)
+        out.append(((inner + cross) / norm).to(q.dtype))
+        state = state * torch.exp(n * log_decay).unsqueeze(-1) + (kc * k_decay).mT @ vc
+    return torch.cat(out, dim=2), state
+
+
+def recurrent_retention(
+    q: Tensor, k: Tensor, v: Tensor, decay: Tensor, state: Tensor | None = None, offset: int = 0
+) -> tuple[Tensor, Tensor]:
+    """
+    one token at position `offset`, O(1) in T: S = gamma S + k^T v, o = q S
+    q, k, v (B, H, 1, D), decay (H,) gamma
+    """
+    kv = k.float().mT @ v.float()
+    state = kv if state is None else state * decay.float().view(1, -1, 1, 1) + kv
+    norm = decay_norm(torch.tensor([offset], device=q.device), decay.log())
+    return (q.float() @ state / norm).to(q.dtype), state
+
+
+class Retention(nn.Module):
     def __init__(self, model_args: Config):
         super().__init__()
         self.d_model = model_args.d_model
@@ -112,57 +123,58 @@ class Retation(nn.Module):
         self.gate = nn.Linear(self.d_model, self.d_model)
         self.proj = nn.Linear(self.d_model, self.d_model)
 
-        self.norm = RMSNorm(self.head_dim, model_args.e)
-
-        self.flash_attn = hasattr(torch.nn.functional, "scaled_dot_product_attention")
-
-    def forward(self, x: torch.Tensor, freqs_cos, freqs_sin, mask: torch.Tensor) -> torch.Tensor:
+        self.norm = RMSNorm(self.head_dim, model_args.eps)
+
+    def forward(
+        self,
+        x: Tensor,
+        rel_pos: tuple[tuple[Tensor, Tensor], Tensor],
+        mode: str = "parallel",
+        state: Tensor | None = None,
+        chunk_size: int = 64,
+        offset: int = 0,
+    ) -> tuple[Tensor, Tensor | None]:
+        """
+        rel_pos is what XPos returns for `mode` (parallel, chunkwise or recurrent)
+        -> (output, retention state after the last token, None in parallel mode)
+        """
         batch, seq_len, d_model = x.shape
+        (cos, sin), decay = rel_pos
 
-        k: torch.Tensor  # type hint for lsp
-        q: torch.Tensor  # ignore
-        v: torch.Tensor
-
-        k = self.key(x)
-        q = self.query(x)
-        v = self.value(x)
+        k = (self.key(x) * self.scaling).view(batch, seq_len, self.num_heads, self.head_dim)
+        q = self.query(x).view(batch, seq_len, self.num_heads, self.head_dim)
+        v = self.value(x).view(batch, seq_len, self.num_heads, self.head_dim)
         g = self.gate(x)
 
-        k = k * self.scaling
+        # (B, num_heads, seq_len, head_dim)
+        q = theta_shift(q.transpose(1, 2), cos, sin)
+        k = theta_shift(k.transpose(1, 2), cos, sin)
+        v = v.transpose(1, 2)
 
-        k = k.view(
-            seq_len, self.num_heads, self.head_dim
-        )  # shape = (B, seq_len, num_heads, head_dim)
-        q = q.view(seq_len, self.num_heads, self.head_dim)
-        v = v.view(seq_len, self.num_heads, self.head_dim)
-
-        q, k = apply_rope(q, k, freqs_cos, freqs_sin)
-
-        k = k.transpose(0, 1)  # shape = (B, num_heads, seq_len, head_dim)
-        q = q.transpose(0, 1)
-        v = v.transpose(0, 1)
-
-        ret_mtx = torch.matmul(q, k.transpose(2, 3))
-        ret_mtx = ret_mtx / ret_mtx.detach().abs().sum(dim=-1, keepdim=True).clamp(min=1, max=5e4)
-        ret_mtx = ret_mtx + mask[:, :, :seq_len, :seq_len]
-
-        output = torch.matmul(ret_mtx, v)  # (batch, n_head, seq_len, head_dim)
+        if mode == "parallel":
+            output = parallel_retention(q, k, v, decay)
+        elif mode == "chunkwise":
+            output, state = chunkwise_retention(q, k, v, decay, chunk_size, state, offset)
+        elif mode == "recurrent":
+            output, state = recurrent_retention(q, k, v, decay, state, offset)
+        else:
+            raise ValueError(f"unknown retention mode {mode}")
 
         output = self.norm(output)
-
         output = output.transpose(1, 2).contiguous().view(batch, seq_len, d_model)
-
         output = output * g
-
         output = self.proj(output)
-        return output
+        return output, state
+
+
+Retation = Retention
 
 
 class Block(nn.Module):
     def __init__(self, model_args: Config):
         super().__init__()
 
-        self.attn = Retation(model_args)
+        self.attn = Retention(model_args)
         self.ff = SwiGLU(
             dim=model_args.d_model,
             multiple_of=model_args.multiple_of,
@@ -172,15 +184,17 @@ class Block(nn.Module):
         self.norm1 = nn.LayerNorm(model_args.d_model)
         self.norm2 = nn.LayerNorm(model_args.d_model)
 
-    def forward(self, x, freqs_cos, freqs_sin, mask):
-        x = x + self.attn(self.norm1(x), freqs_cos, freqs_sin, mask)
+    def forward(self, x, rel_pos, mode="parallel", state=None, chunk_size=64, offset=0):
+        h, state = self.attn(self.norm1(x), rel_pos, mode, state, chunk_size, offset)
+        x = x + h
         x = x + self.ff(self.norm2(x))
-        return x
+        return x, state
 
 
-class RoFormer(nn.Module):
+class RetNet(nn.Module):
     def __init__(self, model_args: Config, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
+        self.config = model_args
 
         self.word_emb = nn.Embedding(model_args.vocab_size, model_args.d_model)
         self.pos_emb = nn.Embedding(model_args.seq_len, model_args.d_model)
@@ -190,22 +204,100 @@ class RoFormer(nn.Module):
         self.norm = nn.LayerNorm(model_args.d_model)
         self.vocab_proj = nn.Linear(model_args.d_model, model_args.vocab_size, bias=False)
 
-        (cos, sin), mask = XPos(model_args.d_model, model_args.seq_len).forward(
-            slen=model_args.seq_len
-        )
-        self.register_buffer("mask", mask, persistent=False)
-        self.register_buffer("freqs_cos", cos, persistent=False)
-        self.register_buffer("freqs_sin", sin, persistent=False)
-
-    def forward(self, x):
+        self.xpos = XPos(model_args.d_model, model_args.num_heads)
+
+    def forward(
+        self,
+        x: Tensor,
+        states: list[Tensor | None] | None = None,
+        offset: int = 0,
+        mode: str | None = None,
+    ) -> Tensor:
+        """
+        mode:
+            "parallel"   O(T^2) training form, the default without states
+            "chunkwise"  linear memory in T, for long sequences and prefill
+            "recurrent"  one token at a time, O(1) per token, the default with states
+        states: one retention state per layer (None to start), updated in place,
+        so a chunkwise prefill can be continued with recurrent steps from `offset`
+        """
         B, T = x.shape
-        x = self.word_emb(x)
-        freqs_cos = self.freqs_cos[:T]
-        freqs_sin = self.freqs_sin[:T]
+        if mode is None:
+            mode = "parallel" if states is None else "recurrent"
+        if mode == "parallel":
+            assert offset == 0 and states is None, "parallel mode has no state, use chunkwise"
+            rel_pos = self.xpos(T)
+        elif mode == "chunkwise":
+            rel_pos = self.xpos(T, chunkwise=True, offset=offset)
+        else:
+            assert T == 1, "recurrent mode takes one token per step"
+            rel_pos = self.xpos(offset + 1, recurrent=True)
 
-        for layer in self.layers:
-            x = layer(x, freqs_cos, freqs_sin, self.mask)
+        x = self.word_emb(x)
+        for idx, layer in enumerate(self.layers):
+            state = states[idx] if states is not None else None
+            x, state = layer(x, rel_pos, mode, state, self.config.chunk_size, offset)
+            if states is not None:
+                states[idx] = state
 
         x = self.norm(x)
         x = self.vocab_proj(x)
         return x
+
+    def init_states(self) -> list[Tensor | None]:
+        return [None] * len(self.layers)
+
+
+RoFormer = RetNet
+
+
+if __name__ == "__main__":
+    import time
+
+    torch.manual_seed(0)
+    config = Config(vocab_size=128, d_model=64, num_heads=4, num_layers=2, dropout=0.0, chunk_size=16)
+    model = RetNet(config).eval()
+    tokens = torch.randint(0, config.vocab_size, (2, 50))  # not a multiple of chunk_size
+
+    with torch.no_grad():
+        parallel = model(tokens, mode="parallel")
+
+        # chunkwise over the whole sequence
+        chunkwise = model(tokens, states=model.init_states(), mode="chunkwise")
+        assert torch.allclose(parallel, chunkwise, atol=1e-4), (parallel - chunkwise).abs().max()
+
+        # chunkwise prefill + recurrent decode
+        states = model.init_states()
+        logits = [model(tokens[:, :20], states, mode="chunkwise")]
+        for t in range(20, tokens.size(1)):
+            logits.append(model(tokens[:, t : t + 1], states, offset=t))
+        recurrent = torch.cat(logits, dim=1)
+        assert torch.allclose(parallel, recurrent, atol=1e-4), (parallel - recurrent).abs().max()
+    print("parity ok")
+
+    # throughput, one layer so the long sequences fit on a laptop
+    config = Config(vocab_size=128, d_model=256, num_heads=4, num_layers=1, dropout=0.0, chunk_size=128)
+    model = RetNet(config).eval()
+
+    def tokens_per_second(fn, num_tokens: int) -> float:
+        fn()
+        start = time.perf_counter()
+        fn()
+        return num_tokens / (time.perf_counter() - start)
+
+    print(f"{'seq_len':>8s} {'parallel tok/s':>16s} {'chunkwise tok/s':>16s}")
+    with torch.inference_mode():
+        for seq_len in (2048, 8192, 32768):
+            x = torch.randint(0, config.vocab_size, (1, seq_len))
+            mask_gb = config.num_heads * seq_len**2 * 4 / 2**30
+            if mask_gb < 4:
+                parallel = f"{tokens_per_second(lambda: model(x, mode='parallel'), seq_len):16.0f}"
+            else:
+                parallel = f"{f'skip, {mask_gb:.0f}GB mask':>16s}"
+            chunkwise = tokens_per_second(lambda: model(x, model.init_states(), mode="chunkwise"), seq_len)
+            print(f"{seq_len:8d} {parallel} {chunkwise:16.0f}")
+
+        states = model.init_states()
+        model(torch.zeros(1, 1, dtype=torch.long), states)
+        step = tokens_per_second(lambda: model(torch.zeros(1, 1, dtype=torch.long), states, offset=1), 1)
+        print(f"recurrent decode: {step:.0f} tok/s, constant in sequence length")
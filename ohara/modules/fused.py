@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import torch
+import torch.nn as nn
+
+
+# Fused projections keep one nn.Linear whose output rows are the concatenation of
+# the separate linears, e.g. qkv = cat([query, key, value]) along dim 0.
+# One GEMM reads the activations once instead of once per projection.
+
+
+def fuse_weights(state_dict: dict, prefix: str, names: tuple[str, ...], fused_name: str) -> bool:
+    "`{prefix}{name}.weight/bias` for every name -> `{prefix}{fused_name}.weight/bias`, in place"
+    if not all(f"{prefix}{name}.weight" in state_dict for name in names):
+        return False
+    for suffix in ("weight", "bias"):
+        keys = [f"{prefix}{name}.{suffix}" for name in names]
+        if all(key in state_dict for key in keys):
+            state_dict[f"{prefix}{fused_name}.{suffix}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+    return True
+
+
+def split_weights(
+    state_dict: dict, prefix: str, fused_name: str, names: tuple[str, ...], sizes: tuple[int, ...]
+) -> bool:
+    "inverse of `fuse_weights`, sizes are the out_features of each projection"
+    if f"{prefix}{fused_name}.weight" not in state_dict:
+        return False
+    for suffix in ("weight", "bias"):
+        key = f"{prefix}{fused_name}.{suffix}"
+        if key in state_dict:
+            for name, part in zip(names, state_dict.pop(key).split(list(sizes), dim=0)):
+                state_dict[f"{prefix}{name}.{suffix}"] = part.contiguous()
+    return True
+
+
+def register_fused_layout(module: nn.Module, fused_name: str, names: tuple[str, ...], sizes: tuple[int, ...]):
+    """
+    make `module.load_state_dict` accept both layouts: a fused module loads
+    checkpoints with separate projections and an unfused one loads fused checkpoints
+    """
+
+    def hook(state_dict, prefix, *args):
+        if hasattr(module, fused_name):
+            fuse_weights(state_dict, prefix, names, fused_name)
+        else:
+            split_weights(state_dict, prefix, fused_name, names, sizes)
+
+    module._register_load_state_dict_pre_hook(hook)
+
+
+if __name__ == "__main__":
+    sd = {
+        "attn.query.weight": torch.randn(8, 4),
+        "attn.key.weight": torch.randn(4, 4),
+        "attn.value.weight": torch.randn(4, 4),
+    }
+    ref = {k: v.clone() for k, v in sd.items()}
+    fuse_weights(sd, "attn.", ("query", "key", "value"), "qkv")
+    assert list(sd) == ["attn.qkv.weight"] and sd["attn.qkv.weight"].shape == (16, 4)
+    split_weights(sd, "attn.", "qkv", ("query", "key", "value"), (8, 4, 4))
+    assert all(torch.equal(sd[k], ref[k]) for k in ref)
+    print("ok")
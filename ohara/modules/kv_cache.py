@@ -1,9 +1,9 @@
 import torch
+import torch.nn as nn
 
 from torch import Tensor
 
 
-
 def quantize_int8(tensor: torch.Tensor, dim: int = -1):
     min_val, max_val = tensor.amin(dim, keepdim=True), tensor.amax(dim, keepdim=True)
 
@@ -52,3 +52,37 @@ class KVCache:
         keys = self.key[:bsz, : start_pos + T]
         values = self.value[:bsz, : start_pos + T]
         return keys, values
+
+
+class StaticKVCache(nn.Module):
+    """
+    fixed (batch, max_seq_len, heads, head_dim) buffers written in place at a
+    position tensor. Shapes and addresses never change between decode steps, so the
+    step compiles once and can be captured in a cuda graph. Attention reads the full
+    buffers and masks the unwritten slots with `static_attention_mask`.
+    Same forward(keys, values, pos) as KVCache, pos is a (T,) LongTensor here.
+    """
+
+    def __init__(self, batch_size: int, max_seq_len: int, num_heads: int, head_dim: int, device=None, dtype=None):
+        super().__init__()
+        shape = (batch_size, max_seq_len, num_heads, head_dim)
+        self.max_seq_len = max_seq_len
+        self.register_buffer("key", torch.zeros(shape, device=device, dtype=dtype), persistent=False)
+        self.register_buffer("value", torch.zeros(shape, device=device, dtype=dtype), persistent=False)
+
+    def forward(self, keys: Tensor, values: Tensor, input_pos: Tensor) -> tuple[Tensor, Tensor]:
+        self.key.index_copy_(1, input_pos, keys.to(self.key.dtype))
+        self.value.index_copy_(1, input_pos, values.to(self.value.dtype))
+        return self.key, self.value
+
+    def reset(self):
+        self.key.zero_()
+        self.value.zero_()
+
+
+def static_attention_mask(input_pos: Tensor, max_seq_len: int, dtype=torch.float32) -> Tensor:
+    "additive (1, 1, T, max_seq_len) mask, query at input_pos[t] sees cache slots <= input_pos[t]"
+    slots = torch.arange(max_seq_len, device=input_pos.device)
+    allowed = slots[None, :] <= input_pos[:, None]
+    mask = torch.zeros(allowed.shape, device=input_pos.device, dtype=dtype)
+    return mask.masked_fill(~allowed, float("-inf"))[None, None]
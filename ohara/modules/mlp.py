@@ -1,9 +1,14 @@
 from __future__ import annotations
 
+import abc
+
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch import Tensor
 from collections.abc import Callable
 from ohara.modules.activations import ACT2FN
+from ohara.modules.fused import register_fused_layout
 
 class MLP(nn.Module):
     def __init__(
@@ -128,10 +133,14 @@ class SwiGLU(nn.Module):
         multiple_of: int = 4,
         dropout: float | None = None,
         bias: bool = False,
+        fused: bool = False,
     ):
         """
         GLU Variants Improve Transformer
         https://arxiv.org/abs/2002.05202v1
+
+        fused=True runs gate and up as one `gate_up` matmul,
+        checkpoints load in either layout
         """
         super().__init__()
         self.dim = dim
@@ -140,21 +149,32 @@ class SwiGLU(nn.Module):
             hidden_dim = int(2 * hidden_dim / 3)
             hidden_dim = multiple_of * ((hidden_dim + multiple_of - 1) // multiple_of)
         self.hidden_dim = hidden_dim
-
-        self.up = nn.Linear(dim, hidden_dim, bias=bias)
-        self.down = nn.Linear(hidden_dim, dim, bias=bias)
-        self.gate = nn.Linear(dim, hidden_dim, bias=bias)
+        self.fused = fused
+
+        if fused:
+            self.gate_up = nn.Linear(dim, 2 * hidden_dim, bias=bias)
+            self.down = nn.Linear(hidden_dim, dim, bias=bias)
+        else:
+            self.up = nn.Linear(dim, hidden_dim, bias=bias)
+            self.down = nn.Linear(hidden_dim, dim, bias=bias)
+            self.gate = nn.Linear(dim, hidden_dim, bias=bias)
         self.dropout = nn.Dropout(dropout) if dropout else lambda x: x
 
+        register_fused_layout(self, "gate_up", ("gate", "up"), (hidden_dim, hidden_dim))
+
     def forward(self, x):
-        return self.dropout(self.down(F.silu(self.gate(x)) * self.up(x)))
+        if self.fused:
+            gate, up = self.gate_up(x).chunk(2, dim=-1)
+        else:
+            gate, up = self.gate(x), self.up(x)
+        return self.dropout(self.down(F.silu(gate) * up))
 
     def reset_parameters(self, init_std=None, factor=1.0):
         in_init_std = init_std or (self.dim ** (-0.5))
         out_init_std = init_std or (self.hidden_dim ** (-0.5))
         out_init_std = out_init_std / factor
         
-        for w in [self.up, self.gate]:
+        for w in [self.gate_up] if self.fused else [self.up, self.gate]:
             nn.init.trunc_normal_(
                 w.weight,
                 mean=0.0,
@@ -277,3 +297,193 @@ MLP_MAP = {
     "reglu": ReGLU,
     "geglu": GEGLU,
 }
+
+
+class StackedExperts(nn.Module, abc.ABC):
+    """
+    `num_experts` copies of an MLP_MAP block with every projection stored as one
+    (num_experts, in, out) tensor, so all experts run in a single bmm per projection.
+    Input is (num_experts, tokens, dim), use `dispatch` for routed (uneven) tokens.
+
+    Checkpoints saved with an nn.ModuleList of the single expert blocks
+    (`experts.{i}.{proj}.weight`) load directly, `module_list_state_dict` goes back.
+    """
+
+    single: type[nn.Module]
+    in_projs: tuple[str, ...]
+    out_proj: str = "down"
+
+    def __init__(
+        self,
+        num_experts: int,
+        dim: int,
+        hidden_dim: int | None = None,
+        multiple_of: int = 4,
+        dropout: float | None = None,
+        bias: bool = False,
+    ):
+        super().__init__()
+        self.num_experts = num_experts
+        self.dim = dim
+        if hidden_dim is None:
+            hidden_dim = 4 * dim
+            hidden_dim = int(2 * hidden_dim / 3)
+            hidden_dim = multiple_of * ((hidden_dim + multiple_of - 1) // multiple_of)
+        self.hidden_dim = hidden_dim
+        self.bias = bias
+
+        for name in self.in_projs:
+            self._add_proj(name, dim, hidden_dim)
+        self._add_proj(self.out_proj, hidden_dim, dim)
+        self.dropout = nn.Dropout(dropout) if dropout else lambda x: x
+
+        self.reset_parameters()
+        self._register_load_state_dict_pre_hook(self._from_module_list)
+
+    def _add_proj(self, name: str, in_features: int, out_features: int):
+        self.register_parameter(f"{name}_weight", nn.Parameter(torch.empty(self.num_experts, in_features, out_features)))
+        bias = nn.Parameter(torch.zeros(self.num_experts, 1, out_features)) if self.bias else None
+        self.register_parameter(f"{name}_bias", bias)
+
+    def _project(self, x: Tensor, name: str) -> Tensor:
+        weight, bias = getattr(self, f"{name}_weight"), getattr(self, f"{name}_bias")
+        return torch.bmm(x, weight) if bias is None else torch.baddbmm(bias, x, weight)
+
+    @abc.abstractmethod
+    def activation(self, *projected: Tensor) -> Tensor:
+        "in_projs outputs, in order -> hidden"
+
+    def forward(self, x: Tensor) -> Tensor:
+        # (num_experts, tokens, dim) -> (num_experts, tokens, dim)
+        hidden = self.activation(*(self._project(x, name) for name in self.in_projs))
+        return self.dropout(self._project(hidden, self.out_proj))
+
+    def dispatch(self, x: Tensor, expert_indices: Tensor) -> Tensor:
+        """
+        x (N, dim), row i goes to expert_indices[i] -> (N, dim)
+        rows are grouped per expert and zero padded up to the busiest expert
+        """
+        sorted_indices, order = torch.sort(expert_indices)
+        counts = torch.bincount(sorted_indices, minlength=self.num_experts)
+        starts = torch.cumsum(counts, dim=0) - counts
+        slots = torch.arange(sorted_indices.shape[0], device=x.device) - starts[sorted_indices]
+
+        grouped = x.new_zeros(self.num_experts, int(counts.max()), x.shape[-1])
+        grouped = grouped.index_put((sorted_indices, slots), x[order])
+        out = self(grouped)[sorted_indices, slots]
+        return out.new_empty(out.shape).index_copy(0, order, out)
+
+    def reset_parameters(self, init_std=None, factor=1.0):
+        in_init_std = init_std or (self.dim ** (-0.5))
+        out_init_std = init_std or (self.hidden_dim ** (-0.5))
+        out_init_std = out_init_std / factor
+
+        for name in self.in_projs:
+            w = getattr(self, f"{name}_weight")
+            nn.init.trunc_normal_(w, mean=0.0, std=in_init_std, a=-3 * in_init_std, b=3 * in_init_std)
+        w = getattr(self, f"{self.out_proj}_weight")
+        nn.init.trunc_normal_(w, mean=0.0, std=out_init_std, a=-3 * out_init_std, b=3 * out_init_std)
+        for name in (*self.in_projs, self.out_proj):
+            if getattr(self, f"{name}_bias") is not None:
+                nn.init.zeros_(getattr(self, f"{name}_bias"))
+
+    # -- ModuleList layout -----------------------------------------------------------------------
+
+    def _from_module_list(self, state_dict, prefix, *args):
+        for name in (*self.in_projs, self.out_proj):
+            keys = [f"{prefix}{i}.{name}.weight" for i in range(self.num_experts)]
+            if all(key in state_dict for key in keys):
+                # nn.Linear keeps (out, in)
+                state_dict[f"{prefix}{name}_weight"] = torch.stack([state_dict.pop(k).t() for k in keys])
+            keys = [f"{prefix}{i}.{name}.bias" for i in range(self.num_experts)]
+            if all(key in state_dict for key in keys):
+                state_dict[f"{prefix}{name}_bias"] = torch.stack([state_dict.pop(k)[None] for k in keys])
+
+    def module_list_state_dict(self) -> dict[str, Tensor]:
+        "state dict of the equivalent nn.ModuleList of single expert blocks"
+        state_dict = {}
+        for name in (*self.in_projs, self.out_proj):
+            weight, bias = getattr(self, f"{name}_weight"), getattr(self, f"{name}_bias")
+            for i in range(self.num_experts):
+                state_dict[f"{i}.{name}.weight"] = weight[i].t().contiguous()
+                if bias is not None:
+                    state_dict[f"{i}.{name}.bias"] = bias[i, 0]
+        return state_dict
+
+    def to_module_list(self) -> nn.ModuleList:
+        weight = getattr(self, f"{self.out_proj}_weight")
+        experts = nn.ModuleList([self._single() for _ in range(self.num_experts)])
+        experts = experts.to(weight.device, weight.dtype)
+        experts.load_state_dict(self.module_list_state_dict())
+        return experts
+
+    def _single(self) -> nn.Module:
+        return self.single(self.dim, self.hidden_dim, bias=self.bias)
+
+
+class StackedSwiGLU(StackedExperts):
+    single = SwiGLU
+    in_projs = ("gate", "up")
+
+    def activation(self, gate, up):
+        return F.silu(gate) * up
+
+
+class StackedMLP(StackedExperts):
+    single = MLP
+    in_projs = ("up",)
+
+    def __init__(self, *args, activation_fn: str = "silu", bias: bool = True, **kwargs):
+        super().__init__(*args, bias=bias, **kwargs)
+        self.activation_fn_name = activation_fn
+        self.activation_fn = ACT2FN[activation_fn]
+
+    def activation(self, up):
+        return self.activation_fn(up)
+
+    def _single(self):
+        return MLP(self.dim, self.hidden_dim, activation_fn=self.activation_fn_name, bias=self.bias)
+
+
+class StackedGLU(StackedExperts):
+    single = GLU
+    in_projs = ("up", "gate")
+
+    def activation(self, up, gate):
+        return F.silu(gate) * up
+
+
+class StackedBiLinear(StackedExperts):
+    single = BiLinear
+    in_projs = ("w1", "w3")
+    out_proj = "w2"
+
+    def activation(self, w1, w3):
+        return w1 * w3
+
+
+class StackedReGLU(StackedExperts):
+    single = ReGLU
+    in_projs = ("w1", "w3")
+    out_proj = "w2"
+
+    def activation(self, w1, w3):
+        return F.relu(w1) * w3
+
+
+class StackedGEGLU(StackedExperts):
+    single = GEGLU
+    in_projs = ("gate", "up")
+
+    def activation(self, gate, up):
+        return F.gelu(gate) * up
+
+
+STACKED_MLP_MAP = {
+    "swiglu": StackedSwiGLU,
+    "mlp": StackedMLP,
+    "glu": StackedGLU,
+    "bilinear": StackedBiLinear,
+    "reglu": StackedReGLU,
+    "geglu": StackedGEGLU,
+}
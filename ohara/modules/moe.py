@@ -2,7 +2,7 @@ from re import DEBUG
 import torch
 import torch.nn as nn
 
-from ohara.modules.mlp import MLP_MAP, MLP
+from ohara.modules.mlp import MLP_MAP, STACKED_MLP_MAP, MLP, StackedExperts
 
 
 # This might not me most efficient implementation of MOE
@@ -19,6 +19,7 @@ class MoE(nn.Module):
         num_experts: int = 4,
         num_experts_per_tok: int = 2,
         mlp: str = "swiglu",
+        stacked: bool = False,
     ):
         super().__init__()
         self.dim = dim
@@ -26,9 +27,12 @@ class MoE(nn.Module):
         self.num_experts = num_experts
         self.num_experts_per_tok = num_experts_per_tok
 
-        mlp_block = MLP_MAP[mlp]  # SwiGLU is default
-
-        self.experts = nn.ModuleList([mlp_block(dim, hidden_dim) for i in range(num_experts)])
+        if stacked:
+            # one bmm per projection for all experts, loads ModuleList checkpoints too
+            self.experts = STACKED_MLP_MAP[mlp](num_experts, dim, hidden_dim)
+        else:
+            mlp_block = MLP_MAP[mlp]  # SwiGLU is default
+            self.experts = nn.ModuleList([mlp_block(dim, hidden_dim) for i in range(num_experts)])
         self.gate = nn.Linear(dim, num_experts, bias=False)
 
 
@@ -64,15 +68,17 @@ class MoE(nn.Module):
         # create copied of inputs for each expert
         x = x.repeat_interleave(self.num_experts_per_tok, dim=0)
 
-        # (total_tokens,dim)
-        output = torch.empty_like(x, dtype=x.dtype, device=x.device)
+        if isinstance(self.experts, StackedExperts):
+            output = self.experts.dispatch(x, flat_expert_indices)
+        else:
+            # (total_tokens,dim)
+            output = torch.empty_like(x, dtype=x.dtype, device=x.device)
 
-        for idx, expert in enumerate(self.experts):
-            # filtered_x - selected toks that to be sent to nth expert
-            filtered_x = x[flat_expert_indices == idx]
-            output[flat_expert_indices == idx] = expert(filtered_x)
+            for idx, expert in enumerate(self.experts):
+                # filtered_x - selected toks that to be sent to nth expert
+                filtered_x = x[flat_expert_indices == idx]
+                output[flat_expert_indices == idx] = expert(filtered_x)
 
-        print(f"{output.shape=}, {expert_weights.shape=}")
         # ->B,T,num_experts_per_tok,dim
         output = output.view(*expert_weights.shape, -1)
         expert_weights = expert_weights.unsqueeze(-1)
@@ -100,6 +106,9 @@ class MoE(nn.Module):
         self.experts:list[MLP]
         
         # Reset parameters for each expert
+        if isinstance(self.experts, StackedExperts):
+            self.experts.reset_parameters(init_std=init_std)
+            return
         for expert in self.experts:
             if hasattr(expert, 'reset_parameters'):
                 expert.reset_parameters(init_std=init_std)
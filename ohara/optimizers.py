@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import math
+from functools import partial
+
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from torch import Tensor
+from collections.abc import Callable, Iterable
+
+
+def create_dynamic_map(signed: bool = True, total_bits: int = 8) -> Tensor:
+    """
+    dynamic (tree) quantization map: https://arxiv.org/abs/1511.04561, as used by 8-bit adam
+    https://arxiv.org/abs/2110.02861. Each exponent 1e-6 .. 1 gets a linear grid of
+    fractions, so small moments keep relative precision that a linear int8 grid loses.
+    -> sorted (2**total_bits,) codes in [-1, 1] (signed) or [0, 1]
+    """
+    exponent_bits = total_bits - 1
+    data = [0.0, 1.0]
+    for i in range(exponent_bits):
+        # unsigned maps spend the sign bit on twice the fractions per exponent
+        num_fractions = 2 ** (i + int(not signed))
+        boundaries = torch.linspace(0.1, 1, num_fractions + 1)
+        means = (boundaries[:-1] + boundaries[1:]) / 2
+        scale = 10 ** (i - exponent_bits + 1)
+        data += (scale * means).tolist()
+        if signed:
+            data += (-scale * means).tolist()
+    assert len(data) == 2**total_bits
+    return torch.tensor(sorted(data))
+
+
+def quantize_blockwise(x: Tensor, code: Tensor, block_size: int) -> tuple[Tensor, Tensor]:
+    "-> (uint8 codes shaped like x, fp32 absmax per block of `block_size` elements)"
+    flat = x.reshape(-1).float()
+    blocks = F.pad(flat, (0, -flat.numel() % block_size)).view(-1, block_size)
+    absmax = blocks.abs().amax(dim=-1)
+    normed = blocks / absmax.clamp_min(1e-12).unsqueeze(-1)
+    # nearest code: bucketize against the midpoints between neighbouring codes
+    q = torch.bucketize(normed, (code[1:] + code[:-1]) / 2).to(torch.uint8)
+    return q.view(-1)[: flat.numel()].view_as(x), absmax
+
+
+def dequantize_blockwise(q: Tensor, absmax: Tensor, code: Tensor, block_size: int) -> Tensor:
+    flat = code[q.reshape(-1).long()]
+    blocks = F.pad(flat, (0, -flat.numel() % block_size)).view(-1, block_size)
+    return (blocks * absmax.unsqueeze(-1)).view(-1)[: flat.numel()].view(q.shape)
+
+
+class AdamW8bit(optim.Optimizer):
+    def __init__(
+        self,
+        params: Iterable[Tensor] | Iterable[dict],
+        lr: float = 1e-3,
+        betas: tuple[float, float] = (0.9, 0.999),
+        eps: float = 1e-8,
+        weight_decay: float = 1e-2,
+        state_bits: int = 8,
+        block_size: int = 2048,
+        min_8bit_size: int = 4096,
+        offload: bool = False,
+    ):
+        """
+        AdamW with blockwise 8-bit moments: https://arxiv.org/abs/2110.02861
+
+        exp_avg / exp_avg_sq are stored as uint8 codes of a dynamic map plus one fp32
+        absmax per `block_size` elements, ~2 bytes per parameter instead of 8. Every
+        step dequantizes one parameter's moments, does the usual fp32 AdamW update
+        and requantizes, so only one fp32 copy exists at a time. Tensors smaller than
+        `min_8bit_size` (norms, biases) keep fp32 moments.
+
+        offload keeps the states in pinned cpu memory and streams them through the
+        device one parameter at a time (non blocking copies, ordered on the current
+        stream). state_bits=32 with offload is plain AdamW with cpu states.
+        """
+        assert lr >= 0.0, f"Invalid learning rate: {lr} - should be >= 0.0"
+        assert 0.0 <= betas[0] < 1.0 and 0.0 <= betas[1] < 1.0, f"Invalid betas: {betas}"
+        assert state_bits in (8, 32), f"state_bits must be 8 or 32, got {state_bits}"
+        defaults = {"lr": lr, "betas": betas, "eps": eps, "weight_decay": weight_decay}
+        super().__init__(params, defaults)
+        self.state_bits = state_bits
+        self.block_size = block_size
+        self.min_8bit_size = min_8bit_size
+        self.offload = offload
+        self._codes: dict[torch.device, tuple[Tensor, Tensor]] = {}
+
+    def _code(self, device: torch.device) -> tuple[Tensor, Tensor]:
+        if device not in self._codes:
+            signed = create_dynamic_map(signed=True).to(device)
+            unsigned = create_dynamic_map(signed=False).to(device)
+            self._codes[device] = (signed, unsigned)
+        return self._codes[device]
+
+    def _quantized(self, p: Tensor) -> bool:
+        return self.state_bits == 8 and p.numel() >= self.min_8bit_size
+
+    def _storage(self, t: Tensor, p: Tensor) -> Tensor:
+        "where a state tensor lives between steps"
+        if not self.offload:
+            return t.to(p.device)
+        t = t.to("cpu")
+        return t.pin_memory() if p.is_cuda else t
+
+    def _init_state(self, p: Tensor, state: dict):
+        state["step"] = 0
+        if self._quantized(p):
+            num_blocks = math.ceil(p.numel() / self.block_size)
+            signed, unsigned = self._code(p.device)
+            # code index of 0.0, so fresh moments dequantize to exactly zero
+            zero_m, zero_v = int((signed == 0).nonzero()[0]), int((unsigned == 0).nonzero()[0])
+            state["exp_avg"] = self._storage(torch.full_like(p, zero_m, dtype=torch.uint8), p)
+            state["exp_avg_sq"] = self._storage(torch.full_like(p, zero_v, dtype=torch.uint8), p)
+            state["exp_avg_absmax"] = self._storage(torch.zeros(num_blocks, device=p.device), p)
+            state["exp_avg_sq_absmax"] = self._storage(torch.zeros(num_blocks, device=p.device), p)
+        else:
+            state["exp_avg"] = self._storage(torch.zeros_like(p, dtype=torch.float), p)
+            state["exp_avg_sq"] = self._storage(torch.zeros_like(p, dtype=torch.float), p)
+
+    def _load_moments(self, p: Tensor, state: dict) -> tuple[Tensor, Tensor]:
+        "-> fp32 exp_avg, exp_avg_sq on the parameter's device"
+        load = partial(Tensor.to, device=p.device, non_blocking=True)
+        if "exp_avg_absmax" not in state:
+            return load(state["exp_avg"]), load(state["exp_avg_sq"])
+        signed, unsigned = self._code(p.device)
+        exp_avg = dequantize_blockwise(load(state["exp_avg"]), load(state["exp_avg_absmax"]), signed, self.block_size)
+        exp_avg_sq = dequantize_blockwise(
+            load(state["exp_avg_sq"]), load(state["exp_avg_sq_absmax"]), unsigned, self.block_size
+        )
+        return exp_avg, exp_avg_sq
+
+    def _store_moments(self, p: Tensor, state: dict, exp_avg: Tensor, exp_avg_sq: Tensor):
+        if "exp_avg_absmax" not in state:
+            if self.offload:
+                state["exp_avg"].copy_(exp_avg, non_blocking=True)
+                state["exp_avg_sq"].copy_(exp_avg_sq, non_blocking=True)
+            return
+        signed, unsigned = self._code(p.device)
+        for name, value, code in (("exp_avg", exp_avg, signed), ("exp_avg_sq", exp_avg_sq, unsigned)):
+            q, absmax = quantize_blockwise(value, code, self.block_size)
+            state[name].copy_(q, non_blocking=True)
+            state[f"{name}_absmax"].copy_(absmax, non_blocking=True)
+
+    @torch.no_grad()
+    def step(self, closure: Callable | None = None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            lr, eps, weight_decay = group["lr"], group["eps"], group["weight_decay"]
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                assert not p.grad.is_sparse, "AdamW8bit does not support sparse gradients"
+                state = self.state[p]
+                if len(state) == 0:
+                    self._init_state(p, state)
+                state["step"] += 1
+
+                exp_avg, exp_avg_sq = self._load_moments(p, state)
+                grad = p.grad.float()
+                exp_avg.lerp_(grad, 1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2 = 1 - beta2 ** state["step"]
+                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
+
+                if weight_decay != 0.0:
+                    p.mul_(1 - lr * weight_decay)
+                p.add_(exp_avg / denom, alpha=-lr / bias_correction1)
+
+                self._store_moments(p, state, exp_avg, exp_avg_sq)
+
+        return loss
+
+    def state_dict(self) -> dict:
+        if self.offload and torch.cuda.is_available():
+            # offloaded states are written back with non blocking copies
+            torch.cuda.synchronize()
+        return super().state_dict()
+
+    def load_state_dict(self, state_dict: dict):
+        saved = state_dict["state"]
+        ids = [param_id for group in state_dict["param_groups"] for param_id in group["params"]]
+        params = [p for group in self.param_groups for p in group["params"]]
+        super().load_state_dict(state_dict)
+        # the base class casts float states to the parameter's dtype, for bf16 params that
+        # rounds the fp32 absmax and moments. Restore them from the saved tensors, in fp32
+        # and where this optimizer keeps them
+        for param_id, p in zip(ids, params):
+            for name, value in saved.get(param_id, {}).items():
+                if isinstance(value, Tensor) and name != "step":
+                    value = value.float() if value.is_floating_point() else value
+                    self.state[p][name] = self._storage(value.clone(), p)
+
+
+OPTIMIZERS: dict[str, Callable[..., optim.Optimizer]] = {
+    "adamw": optim.AdamW,
+    "adamw8bit": AdamW8bit,
+    "adamw8bit_offload": partial(AdamW8bit, offload=True),
+    "adamw_offload": partial(AdamW8bit, state_bits=32, offload=True),
+}
+
+
+def build_optimizer(name: str, params, lr: float, **kwargs) -> optim.Optimizer:
+    "build by name, pass the result to `fabric.setup_optimizers` as usual"
+    assert name in OPTIMIZERS, f"unknown optimizer {name}, choose from {list(OPTIMIZERS)}"
+    return OPTIMIZERS[name](params, lr=lr, **kwargs)
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+
+    # roundtrip error of the dynamic map is relative to each block's absmax
+    x = torch.randn(10_000) * torch.logspace(-4, 0, 10_000)
+    signed = create_dynamic_map(signed=True)
+    q, absmax = quantize_blockwise(x, signed, 2048)
+    err = (dequantize_blockwise(q, absmax, signed, 2048) - x).abs().max()
+    assert err < 0.02 * x.abs().max(), err
+
+    # convergence against torch AdamW on a small regression
+    def train(name: str) -> float:
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(64, 128), torch.nn.GELU(), torch.nn.Linear(128, 1))
+        opt = build_optimizer(name, model.parameters(), lr=1e-3, weight_decay=0.0)
+        data, target = torch.randn(512, 64), torch.randn(512, 1)
+        for _ in range(300):
+            loss = F.mse_loss(model(data), target)
+            loss.backward()
+            opt.step()
+            opt.zero_grad()
+        # states survive a save / load roundtrip
+        opt.load_state_dict(opt.state_dict())
+        return loss.item()
+
+    losses = {name: train(name) for name in OPTIMIZERS}
+    print(losses)
+    for name, loss in losses.items():
+        assert abs(loss - losses["adamw"]) < 0.05 * losses["adamw"], name
+    print("ok")
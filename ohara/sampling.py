@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+import torch
+
+from torch import Tensor
+
+
+# Everything here stays on device: no .item(), no multinomial, no data dependent
+# shapes. Per row settings are tensors, so a batch mixing greedy and sampled rows
+# (continuous batching) runs the same kernels every step and can be compiled /
+# captured in a cuda graph.
+
+
+def _exponential_argmax(probs: Tensor) -> Tensor:
+    # argmax(p / q) with q ~ Exp(1) draws from p (unnormalized is fine) without a host sync
+    q = torch.empty_like(probs).exponential_(1)
+    return (probs / q).argmax(dim=-1, keepdim=True)
+
+
+def sample(logits: Tensor, temperature: float = 0.0, top_k: int | None = None) -> Tensor:
+    """
+    (B, vocab) -> (B, 1) next token, same settings for every row
+    temperature 0 is greedy
+    """
+    if temperature <= 0.0:
+        return logits.argmax(dim=-1, keepdim=True)
+    logits = logits / temperature
+    if top_k is not None:
+        kth = torch.topk(logits, min(top_k, logits.size(-1)), dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    return _exponential_argmax(torch.softmax(logits.float(), dim=-1))
+
+
+def apply_repetition_penalty(logits: Tensor, seen: Tensor, penalty: Tensor) -> Tensor:
+    """
+    CTRL style penalty: https://arxiv.org/abs/1909.05858
+    seen (B, vocab) bool, penalty (B,), 1.0 is off
+    """
+    penalty = penalty.unsqueeze(-1).to(logits.dtype)
+    penalized = torch.where(logits > 0, logits / penalty, logits * penalty)
+    return torch.where(seen, penalized, logits)
+
+
+def sample_batched(
+    logits: Tensor,
+    temperature: Tensor,
+    top_k: Tensor,
+    top_p: Tensor,
+    min_p: Tensor,
+    max_top_k: int | None = 256,
+) -> Tensor:
+    """
+    (B, vocab) -> (B, 1), every setting is a (B,) tensor
+    temperature 0 -> greedy, top_k 0 -> off, top_p 1 -> off, min_p 0 -> off
+
+    Candidates are the `max_top_k` largest logits (a topk instead of a full vocab
+    sort); top-p and min-p are applied inside them. None sorts the full vocab,
+    which is exact for top-p when top_k is off.
+    """
+    vocab_size = logits.size(-1)
+    k = vocab_size if max_top_k is None else min(max_top_k, vocab_size)
+    if k < vocab_size:
+        values, indices = torch.topk(logits.float(), k, dim=-1)
+    else:
+        values, indices = torch.sort(logits.float(), dim=-1, descending=True)
+
+    temp = temperature.float().clamp_min(1e-5).unsqueeze(-1)
+    probs = torch.softmax(values / temp, dim=-1)
+
+    # candidates are sorted, so top-k is a rank cutoff
+    rank = torch.arange(k, device=logits.device)
+    row_k = torch.where(top_k > 0, top_k, k).clamp(max=k).unsqueeze(-1)
+    probs = probs.masked_fill(rank >= row_k, 0.0)
+    probs = probs / probs.sum(dim=-1, keepdim=True)
+
+    # top-p keeps the smallest prefix reaching top_p, min-p drops p < min_p * p_max.
+    # the first candidate always survives both
+    mask = (probs.cumsum(dim=-1) - probs) > top_p.unsqueeze(-1)
+    mask |= probs < min_p.unsqueeze(-1) * probs[:, :1]
+    probs = probs.masked_fill(mask, 0.0)
+
+    sampled = indices.gather(-1, _exponential_argmax(probs))
+    return torch.where(temperature.unsqueeze(-1) > 0, sampled, indices[:, :1])
+
+
+@dataclass
+class SamplingParams:
+    temperature: float = 0.0
+    top_k: int = 0
+    top_p: float = 1.0
+    min_p: float = 0.0
+    repetition_penalty: float = 1.0
+    max_new_tokens: int = 256
+
+
+class Sampler:
+    def __init__(
+        self,
+        batch_size: int,
+        vocab_size: int,
+        stop_ids: list[int] | None = None,
+        max_top_k: int | None = 256,
+        device: torch.device | str | None = None,
+    ):
+        """
+        batched sampler with per row settings and on device stop checks.
+
+        sampler.set_row(i, SamplingParams(...), prompt) when a sequence joins the
+        batch, then every step:
+            tokens = sampler(logits[:, -1])
+            finished = sampler.update(tokens)
+        `finished` is a device tensor, sync on it as rarely as you like.
+        """
+        self.max_top_k = max_top_k
+        kw = dict(device=device)
+        self.temperature = torch.zeros(batch_size, **kw)
+        self.top_k = torch.zeros(batch_size, dtype=torch.long, **kw)
+        self.top_p = torch.ones(batch_size, **kw)
+        self.min_p = torch.zeros(batch_size, **kw)
+        self.repetition_penalty = torch.ones(batch_size, **kw)
+        self.max_new_tokens = torch.zeros(batch_size, dtype=torch.long, **kw)
+        self.num_new_tokens = torch.zeros(batch_size, dtype=torch.long, **kw)
+        self.seen = torch.zeros(batch_size, vocab_size, dtype=torch.bool, **kw)
+        self.finished = torch.ones(batch_size, dtype=torch.bool, **kw)
+        self.stop_ids = torch.tensor(stop_ids or [], dtype=torch.long, **kw)
+
+    def set_row(self, row: int, params: SamplingParams, prompt: Tensor | None = None):
+        "(re)start a row, prompt (T,) token ids count as seen for the repetition penalty"
+        self.temperature[row] = params.temperature
+        self.top_k[row] = params.top_k
+        self.top_p[row] = params.top_p
+        self.min_p[row] = params.min_p
+        self.repetition_penalty[row] = params.repetition_penalty
+        self.max_new_tokens[row] = params.max_new_tokens
+        self.num_new_tokens[row] = 0
+        self.finished[row] = False
+        self.seen[row] = False
+        if prompt is not None:
+            self.seen[row, prompt.to(self.seen.device)] = True
+
+    def __call__(self, logits: Tensor) -> Tensor:
+        "(B, vocab) -> (B, 1)"
+        logits = apply_repetition_penalty(logits, self.seen, self.repetition_penalty)
+        return sample_batched(logits, self.temperature, self.top_k, self.top_p, self.min_p, self.max_top_k)
+
+    def update(self, tokens: Tensor) -> Tensor:
+        "record sampled (B, 1) tokens, -> (B,) bool finished mask"
+        tokens = tokens.view(-1)
+        self.seen.scatter_(1, tokens.unsqueeze(-1), True)
+        self.num_new_tokens += (~self.finished).long()
+        self.finished |= torch.isin(tokens, self.stop_ids) | (self.num_new_tokens >= self.max_new_tokens)
+        return self.finished
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    vocab_size = 1000
+    logits = torch.randn(4, vocab_size)
+
+    def rows(*values, dtype=torch.float):
+        return torch.tensor(values, dtype=dtype)
+
+    # temperature 0 and top_k 1 are both greedy, whatever the other settings
+    out = sample_batched(
+        logits, rows(0.0, 1.0, 0.0, 1.0), rows(0, 1, 5, 1, dtype=torch.long), rows(1.0, 1.0, 0.1, 0.5), rows(0.0, 0.0, 0.0, 0.5)
+    )
+    assert torch.equal(out, logits.argmax(-1, keepdim=True))
+
+    # top_k 5 only ever draws from the 5 largest logits
+    top5 = logits[:1].topk(5).indices
+    for _ in range(100):
+        out = sample_batched(logits[:1], rows(1.0), rows(5, dtype=torch.long), rows(1.0), rows(0.0))
+        assert out.item() in top5
+
+    # min_p 1 keeps only the mode
+    out = sample_batched(logits, rows(1.0, 1.0, 1.0, 1.0), torch.zeros(4, dtype=torch.long), torch.ones(4), torch.ones(4))
+    assert torch.equal(out, logits.argmax(-1, keepdim=True))
+
+    # repetition penalty pushes the seen argmax down, stop ids finish rows on device
+    sampler = Sampler(2, vocab_size, stop_ids=[7])
+    best = logits[:2].argmax(-1)
+    for row in range(2):
+        sampler.set_row(row, SamplingParams(repetition_penalty=1e3, max_new_tokens=8), prompt=best[row : row + 1])
+    assert not torch.equal(sampler(logits[:2]).view(-1), best)
+    assert sampler.update(torch.tensor([[7], [3]])).tolist() == [True, False]
+    print("ok")
@@ -11,10 +11,15 @@ import torch.optim as optim
 from torch import Tensor
 from typing import Any, Callable
 
-from ohara.models.llama import LLAMA, Config
+from ohara.models.llama import LLAMA, Block, Config
 from ohara.lr_scheduler import CosineScheduler
+from ohara.optimizers import build_optimizer
 from ohara.dataset import PreTokenizedDataset
 from ohara.utils import auto_accelerator, model_summary, BetterCycle
+from ohara.fsdp import fsdp_strategy, save_checkpoint, load_checkpoint
+from ohara.evaluator import Evaluator
+from ohara.utils.throughput import StepMonitor, flops_per_token
+from ohara.utils.profiler import Profiler
 
 from torch.utils.data import DataLoader
 from transformers import AutoTokenizer
@@ -46,6 +51,12 @@ class Trainer:
         ignore_index: int = -1,
         push_to_hub: bool = False,
         model_name: str = "",
+        eval_batches: int = 100,
+        eval_device: str | None = None,
+        ema_beta: float = 0.98,
+        log_step_metrics: bool = True,
+        profiler: Profiler | None = None,
+        step_callbacks: dict[int, Callable[["Trainer"], Any]] | None = None,
     ):
         self.fabric = fabric
         self.model = model
@@ -64,6 +75,37 @@ class Trainer:
         (data, target) = next(self.val_dataloader)
         self.tokens_per_iter = int(math.prod(data.shape) * micro_batch)
 
+        # held-out tokens are cached on device once, train loss is tracked as an ema
+        # of the step losses instead of re-running train batches at every eval
+        self.evaluator = Evaluator(
+            self.val_dataloader,
+            num_batches=eval_batches,
+            device=fabric.device,
+            ignore_index=ignore_index,
+            async_device=eval_device,
+        )
+        self.ema_beta = ema_beta
+        self.train_loss_ema: float | None = None
+        # async evals finish some steps later: they are logged at the current step under
+        # their own keys, with the train loss / lr / time of the iter they evaluated
+        self._eval_context: dict[int, tuple[float, float, float]] = {}
+        if self.evaluator.is_async:
+            for logger in fabric.loggers:
+                if isinstance(logger, WandbLogger):
+                    logger.experiment.define_metric("async_eval/*", step_metric="async_eval/iter")
+
+        # tokens/s, mfu and the data/fwd/bwd/optimizer split of every step
+        try:
+            model_flops = flops_per_token(model.config, seq_len=data.shape[1])
+        except AttributeError:
+            model_flops = 0  # unknown config layout, mfu is not reported
+        self.log_step_metrics = log_step_metrics
+        self.monitor = StepMonitor(fabric, model_flops, enabled=log_step_metrics)
+        self.profiler = profiler
+        # iter -> fn(trainer), run right after that iter's optimizer step, e.g. growing
+        # the model in place (tokenformer) without restarting the run
+        self.step_callbacks = step_callbacks or {}
+
     @torch.no_grad()
     def calculate_loss(self, dataloader: DataLoader, num_batches: int) -> torch.Tensor:
         self.model.eval()
@@ -81,11 +123,16 @@ class Trainer:
         return losses.mean()
 
     def log_function(self, idx: int, lr: float, elapsed_time: float) -> None:
-        train_loss = self.calculate_loss(self.train_dataloader, 100)
-        val_loss = self.calculate_loss(self.val_dataloader, 100)
-        
+        train_loss = self.train_loss_ema
+        if self.evaluator.is_async:
+            self._eval_context[idx] = (train_loss, lr, elapsed_time)
+            self.evaluator.submit(self.model, idx)
+            for eval_idx, val_loss in self.evaluator.poll():
+                self.log_async_eval(eval_idx, val_loss, step=idx)
+            return
+
+        val_loss = self.fabric.all_reduce(self.evaluator.evaluate(self.model)).item()
         print(f"iter: {idx} | train_loss: {train_loss:.4f} | val_loss: {val_loss:.4f} | lr: {lr:e} | time: {elapsed_time:.4f}s")
-        
         try:
             self.fabric.log_dict(
                 {
@@ -101,17 +148,45 @@ class Trainer:
         except Exception as e:
             print(f"Error logging: {e}")
 
+    def log_async_eval(self, eval_idx: int, val_loss: float, step: int) -> None:
+        "eval of the weights at eval_idx that finished at `step`, steps only move forward"
+        train_loss, lr, elapsed_time = self._eval_context.pop(eval_idx)
+        print(f"iter: {eval_idx} | train_loss: {train_loss:.4f} | val_loss: {val_loss:.4f} | lr: {lr:e} | time: {elapsed_time:.4f}s")
+        try:
+            self.fabric.log_dict(
+                {
+                    "async_eval/training_loss": train_loss,
+                    "async_eval/validation_loss": val_loss,
+                    "async_eval/iter": eval_idx,
+                    "async_eval/tokens": eval_idx * self.tokens_per_iter,
+                    "async_eval/lr": lr,
+                    "async_eval/time": elapsed_time,
+                },
+                step=step,
+            )
+        except Exception as e:
+            print(f"Error logging: {e}")
+
+    def load_checkpoint(self, path: str) -> int:
+        """restore model/optimizer in place (works for sharded fsdp checkpoints), returns iter"""
+        remainder = load_checkpoint(self.fabric, path, self.model, self.optimizer)
+        return remainder.get("idx", 0)
+
     def train(self, start_iter: int = 0):
-        self.fabric.launch()
+        # the caller launches fabric right after creating it, before any model is set up
         # sanity test
         self.calculate_loss(self.val_dataloader, 5)
 
+        if self.profiler is not None:
+            self.profiler.start()
+
         idx: int = start_iter
         while True:
             if idx >= self.max_iters:
                 break
             idx += 1
             start_time: float = time.perf_counter()
+            self.monitor.start_step()
 
             lr = self.get_lr(idx)
             for param_group in self.optimizer.param_groups:
@@ -119,26 +194,44 @@ class Trainer:
 
             micro_batch_loss = 0
             for _ in range(self.micro_batch):
-                (data, target) = next(self.train_dataloader)
+                with self.monitor.time("data"):
+                    (data, target) = next(self.train_dataloader)
                 with self.fabric.no_backward_sync(self.model, enabled=_ < self.micro_batch - 1):
-                    logits: torch.Tensor = self.model(data)
-                    loss = F.cross_entropy(
-                        logits.view(-1, logits.size(-1)),
-                        target.view(-1),
-                        ignore_index=self.ignore_index,
-                    )
-                    loss = loss / self.micro_batch
+                    with self.monitor.time("forward"):
+                        logits: torch.Tensor = self.model(data)
+                        loss = F.cross_entropy(
+                            logits.view(-1, logits.size(-1)),
+                            target.view(-1),
+                            ignore_index=self.ignore_index,
+                        )
+                        loss = loss / self.micro_batch
+                    with self.monitor.time("backward"):
+                        self.fabric.backward(loss)
                     micro_batch_loss += loss.item()
-                    self.fabric.backward(loss)
 
-            self.optimizer.step()
-            self.optimizer.zero_grad()
+            with self.monitor.time("optimizer"):
+                self.optimizer.step()
+                self.optimizer.zero_grad()
+
+            if idx in self.step_callbacks:
+                self.step_callbacks[idx](self)
 
+            if self.train_loss_ema is None:
+                self.train_loss_ema = micro_batch_loss
+            self.train_loss_ema = self.ema_beta * self.train_loss_ema + (1 - self.ema_beta) * micro_batch_loss
+
+            step_metrics = self.monitor.end_step(self.tokens_per_iter)
             curr_time: float = time.perf_counter()
             elapsed_time: float = curr_time - start_time
+            mfu = f" | mfu: {step_metrics['mfu']:.2%}" if "mfu" in step_metrics else ""
             print(
                 f"iter: {idx} | loss: {micro_batch_loss:.4f} | lr: {lr:e} | time: {elapsed_time:.4f}s"
+                f" | tok/s: {step_metrics['tokens_per_sec']:.0f}{mfu}"
             )
+            if self.log_step_metrics:
+                self.monitor.log(step_metrics | {"loss": micro_batch_loss}, step=idx)
+            if self.profiler is not None:
+                self.profiler.step()
 
             if idx % self.eval_iters == 0:
                 self.model.eval()
@@ -146,12 +239,18 @@ class Trainer:
                 self.model.train()
 
             if idx % self.save_ckpt_iters == 0:
-                state = {"model": self.model.state_dict(), "optimizer": self.optimizer.state_dict(), "idx": idx, "lr": lr}
-                self.fabric.save("./ckpt/model.pt", state)
+                save_checkpoint(self.fabric, "./ckpt/model.pt", self.model, self.optimizer, idx=idx, lr=lr)
                 self.model.config.ckpt_iter = idx
                 if self.push_to_hub:
                     self.model.push_to_hub(self.model_name, commit_message=f"checkpoint iter: {idx}")
 
+        if self.profiler is not None:
+            self.profiler.stop()
+
+        # flush evals still running on the spare device
+        for eval_idx, val_loss in self.evaluator.close():
+            self.log_async_eval(eval_idx, val_loss, step=idx)
+
 
 def main():
     # wandb
@@ -186,8 +285,25 @@ def main():
     device: torch.device = auto_accelerator()  # select accelerator eg cuda, mps
     dtype: torch.dtype = torch.float32  # We will use fancy dtypes in future
 
+    # distributed
+    strategy: str = "auto"  # "auto", "ddp", "fsdp"
+    precision: str = "bf16-mixed"  # "32-true", "16-mixed", "bf16-mixed", "bf16-true"
+    sharding_strategy: str = "FULL_SHARD"  # "FULL_SHARD" (zero3), "SHARD_GRAD_OP" (zero2)
+
+    # profile steps wait+warmup .. wait+warmup+active, traces go to ./profile
+    profile: bool = False
+
+    # "adamw", "adamw8bit" (blockwise 8-bit moments), "adamw8bit_offload" / "adamw_offload" (states on cpu)
+    optimizer_name: str = "adamw"
+
     logger: Any = wandb.init(project=project_name)
 
+    if strategy == "fsdp":
+        # one shard unit per transformer block
+        strategy = fsdp_strategy({Block}, precision=precision, sharding_strategy=sharding_strategy)
+    fabric = L.Fabric(accelerator="auto", devices="auto", strategy=strategy, precision=precision)
+    fabric.launch()
+
     tokenizer: AutoTokenizer = AutoTokenizer.from_pretrained(pretrained_model)
 
     config: Config = Config(
@@ -199,7 +315,7 @@ def main():
         multiple_of=multiple_of,
     )
 
-    model: nn.Module = LLAMA(config).to(device)
+    model: nn.Module = fabric.setup(LLAMA(config))
     if compile_model:
         model = torch.compile(model)
 
@@ -223,8 +339,11 @@ def main():
 
     train_dataloader: DataLoader = DataLoader(train_ds, batch_size=batch_size)
     val_dataloader: DataLoader = DataLoader(test_ds, batch_size=batch_size)
+    train_dataloader, val_dataloader = fabric.setup_dataloaders(train_dataloader, val_dataloader)
 
-    optimizer: optim.AdamW = optim.AdamW(model.parameters(), lr=learning_rate)
+    # with fsdp the optimizer has to be built on the sharded parameters
+    optimizer: optim.Optimizer = build_optimizer(optimizer_name, model.parameters(), lr=learning_rate)
+    optimizer = fabric.setup_optimizers(optimizer)
     scheduler: CosineScheduler = CosineScheduler(
         learning_rate=learning_rate,
         min_lr=min_lr,
@@ -233,7 +352,7 @@ def main():
     )
 
     trainer: Trainer = Trainer(
-        fabric=L.Fabric(accelerator="auto", devices="auto", precision="bf16-mixed"),
+        fabric=fabric,
         model=model,
         optimizer=optimizer,
         train_dataloader=train_dataloader,
@@ -246,6 +365,7 @@ def main():
         ignore_index=tokenizer.pad_token_id,
         push_to_hub=False,
         model_name="",
+        profiler=Profiler(model, wait=5, warmup=2, active=3) if profile else None,
     )
 
     trainer.train()
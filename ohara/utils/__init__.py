@@ -2,3 +2,4 @@ from .tools import BetterCycle, auto_accelerator  # noqa
 from .info import model_summary  # noqa
 from .svd import svd_approx  # noqa
 from .rand import random_name  # noqa
+from .throughput import StepMonitor, flops_per_token  # noqa
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import os
+from collections import defaultdict
+
+import torch
+import torch.nn as nn
+
+from torch.profiler import ProfilerActivity, record_function
+
+
+# first match wins, checked against the lowercased class name
+# moe is checked before mlp so a MoE range only keeps gating/dispatch self time,
+# the experts themselves show up as mlp
+MODULE_GROUPS = [
+    ("moe", ("moe",)),
+    ("attention", ("attention", "mha", "retation", "retention")),
+    ("mlp", ("mlp", "glu", "bilinear")),
+    ("rope", ("rope", "rotary", "rotatry", "xpos")),
+    ("norm", ("norm",)),
+]
+
+RANGE_PREFIX = "ohara::"
+
+
+def module_group(module: nn.Module) -> str | None:
+    name = type(module).__name__.lower()
+    for group, keys in MODULE_GROUPS:
+        if any(key in name for key in keys):
+            return group
+    return None
+
+
+def _self_device_time(event) -> float:
+    # renamed from cuda -> device in newer torch
+    return getattr(event, "self_device_time_total", getattr(event, "self_cuda_time_total", 0.0))
+
+
+class Profiler:
+    def __init__(
+        self,
+        model: nn.Module,
+        output_dir: str = "./profile",
+        wait: int = 5,
+        warmup: int = 2,
+        active: int = 3,
+        repeat: int = 1,
+        record_shapes: bool = False,
+        with_stack: bool = False,
+        profile_memory: bool = False,
+        row_limit: int = 20,
+    ):
+        """
+        torch.profiler over a window of training steps.
+
+        Call `step()` once per optimizer step. After `wait` skipped and `warmup`
+        discarded steps, `active` steps are recorded, a chrome trace is written to
+        `output_dir` and a summary of top ops by self time, grouped by ohara module
+        (attention, mlp, moe dispatch, rope, norm), is printed and saved.
+        """
+        self.model = model
+        self.output_dir = output_dir
+        self.row_limit = row_limit
+        self._handles: list = []
+        self._ranges: dict[int, list] = defaultdict(list)
+        self._trace_idx = 0
+        self.repeat = repeat
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self.sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+
+        self.profile = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=repeat),
+            on_trace_ready=self._on_trace_ready,
+            record_shapes=record_shapes,
+            with_stack=with_stack,
+            profile_memory=profile_memory,
+        )
+
+    # -- module ranges ---------------------------------------------------------------------------
+
+    def _attach(self):
+        for module in self.model.modules():
+            group = module_group(module)
+            if group is None:
+                continue
+            label = f"{RANGE_PREFIX}{group}"
+            self._handles.append(module.register_forward_pre_hook(self._enter(label)))
+            self._handles.append(module.register_forward_hook(self._exit))
+
+    def _enter(self, label: str):
+        def hook(module, args):
+            ctx = record_function(label)
+            ctx.__enter__()
+            self._ranges[id(module)].append(ctx)
+
+        return hook
+
+    def _exit(self, module, args, output):
+        stack = self._ranges[id(module)]
+        if stack:
+            stack.pop().__exit__(None, None, None)
+
+    def _detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._ranges.clear()
+
+    # -- lifecycle -------------------------------------------------------------------------------
+
+    def start(self) -> Profiler:
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._attach()
+        self.profile.start()
+        return self
+
+    def step(self):
+        self.profile.step()
+
+    def stop(self):
+        self.profile.stop()
+        self._detach()
+
+    def __enter__(self) -> Profiler:
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # -- reporting -------------------------------------------------------------------------------
+
+    def group_times(self, prof: torch.profiler.profile) -> dict[str, dict[str, float]]:
+        "self cpu/device time (us) of every op attributed to its innermost ohara module range"
+        groups: dict[str, dict[str, float]] = defaultdict(lambda: {"cpu": 0.0, "device": 0.0, "count": 0})
+        for event in prof.events():
+            if event.name.startswith(RANGE_PREFIX):
+                continue
+            group = "other"
+            parent = event.cpu_parent
+            while parent is not None:
+                if parent.name.startswith(RANGE_PREFIX):
+                    group = parent.name[len(RANGE_PREFIX) :]
+                    break
+                parent = parent.cpu_parent
+            groups[group]["cpu"] += event.self_cpu_time_total
+            groups[group]["device"] += _self_device_time(event)
+            groups[group]["count"] += 1
+        return dict(groups)
+
+    def summary(self, prof: torch.profiler.profile) -> str:
+        groups = self.group_times(prof)
+        total_cpu = sum(g["cpu"] for g in groups.values()) or 1.0
+        total_device = sum(g["device"] for g in groups.values()) or 1.0
+
+        lines = [f"{'module':<12}{'self cpu (ms)':>16}{'%':>8}{'self device (ms)':>20}{'%':>8}{'ops':>8}"]
+        for name, g in sorted(groups.items(), key=lambda kv: -(kv[1]["device"] or kv[1]["cpu"])):
+            lines.append(
+                f"{name:<12}{g['cpu'] / 1e3:>16.3f}{g['cpu'] / total_cpu:>8.1%}"
+                f"{g['device'] / 1e3:>20.3f}{g['device'] / total_device:>8.1%}{g['count']:>8}"
+            )
+        table = prof.key_averages().table(sort_by=self.sort_by, row_limit=self.row_limit)
+        return "\n".join(lines) + "\n\n" + table
+
+    def _on_trace_ready(self, prof: torch.profiler.profile):
+        name = os.path.join(self.output_dir, f"trace_{self._trace_idx}")
+        prof.export_chrome_trace(f"{name}.json")
+        summary = self.summary(prof)
+        with open(f"{name}_summary.txt", "w") as f:
+            f.write(summary)
+        print(summary)
+        print(f"chrome trace: {name}.json (open in chrome://tracing or ui.perfetto.dev)")
+        self._trace_idx += 1
+        if self.repeat and self._trace_idx >= self.repeat:
+            # last scheduled trace, no need to keep the range hooks on every module
+            self._detach()
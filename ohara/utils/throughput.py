@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+import lightning as L
+from lightning.fabric.utilities.throughput import get_available_flops, _plugin_to_compute_dtype
+
+
+def _get(config, name: str, default=None):
+    value = getattr(config, name, None)
+    return default if value is None else value
+
+
+def _is_mla(config) -> bool:
+    return _get(config, "attn_type") == "mla" or _get(config, "kv_lora_rank") is not None
+
+
+def attention_params(config) -> int:
+    "q,k,v,o projection weights of one layer (plain / GQA / MLA)"
+    d_model = config.d_model
+    num_heads = config.num_heads
+    if _is_mla(config):
+        q_rank, kv_rank = config.q_lora_rank, config.kv_lora_rank
+        rope, nope, v_dim = config.rope_head_dim, config.nope_head_dim, config.v_head_dim
+        return (
+            d_model * q_rank
+            + q_rank * num_heads * (nope + rope)
+            + d_model * kv_rank
+            + kv_rank * num_heads * (nope + v_dim)
+            + d_model * rope
+            + num_heads * v_dim * d_model
+        )
+    head_dim = _get(config, "head_dim", d_model // num_heads)
+    num_kv_heads = _get(config, "num_kv_heads", 0) or num_heads
+    return 2 * d_model * num_heads * head_dim + 2 * d_model * num_kv_heads * head_dim
+
+
+def attention_score_flops(config, seq_len: int) -> int:
+    "forward flops per token of QK^T and AV, full context (PaLM convention, no causal discount)"
+    if _is_mla(config):
+        qk_dim = config.nope_head_dim + config.rope_head_dim
+        v_dim = config.v_head_dim
+    else:
+        qk_dim = v_dim = _get(config, "head_dim", config.d_model // config.num_heads)
+    return 2 * config.num_heads * (qk_dim + v_dim) * seq_len
+
+
+def ffn_params(config, layer_idx: int = 0) -> int:
+    "weights one token actually touches in the ffn of layer `layer_idx` (active params for moe)"
+    d_model = config.d_model
+    hidden_dim = _get(config, "hidden_dim", 4 * d_model)
+    mlp = str(_get(config, "mlp", _get(config, "ffn", "swiglu"))).lower()
+    dense = (2 if mlp == "mlp" else 3) * d_model * hidden_dim
+
+    ffn_type = _get(config, "ffn_type", "dense")
+    is_moe = _get(config, "mixture_of_expert", False) or ffn_type in ("dsmoe", "sparse_moe")
+    if not is_moe or layer_idx < _get(config, "dense_layers", 0):
+        return dense
+
+    num_experts = _get(config, "num_experts", _get(config, "moe_num_experts", 4))
+    per_tok = _get(config, "num_experts_per_tok", _get(config, "moe_num_experts_per_tok", 2))
+    shared = _get(config, "num_shared_experts", 0) if ffn_type == "dsmoe" else 0
+    return (per_tok + shared) * dense + d_model * num_experts  # + router
+
+
+def flops_per_token(config, seq_len: int | None = None, training: bool = True) -> int:
+    """
+    Model flops per token from an ohara config (2 flops per multiply-add).
+    Works with llama/template style configs, GQA (num_kv_heads), MoE
+    (num_experts_per_tok + shared experts) and MLA (q/kv lora ranks).
+    Training counts forward + backward as 3x forward.
+    """
+    seq_len = seq_len or config.seq_len
+    total = 2 * config.d_model * config.vocab_size  # lm head
+    for layer_idx in range(config.num_layers):
+        total += 2 * (attention_params(config) + ffn_params(config, layer_idx))
+        total += attention_score_flops(config, seq_len)
+    return 3 * total if training else total
+
+
+class StepMonitor:
+    def __init__(self, fabric: L.Fabric, flops_per_token: int = 0, sync: bool = False, enabled: bool = True):
+        """
+        Per step throughput/MFU + time split (data, forward, backward, optimizer).
+        `sync` synchronizes cuda around each timed region, so the split is real
+        device time instead of kernel launch time, at the cost of a few syncs per
+        micro batch. enabled=False skips the split and peak memory, steps only get
+        step_time / tokens_per_sec / mfu.
+        """
+        self.fabric = fabric
+        self.flops_per_token = flops_per_token
+        self.is_cuda = fabric.device.type == "cuda"
+        self.enabled = enabled
+        self.sync = sync and enabled and self.is_cuda
+
+        dtype = _plugin_to_compute_dtype(fabric.strategy.precision)
+        self.available_flops = get_available_flops(fabric.device, dtype)
+
+        self.timings: dict[str, float] = defaultdict(float)
+        self._step_start = 0.0
+
+    def _synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize(self.fabric.device)
+
+    @contextmanager
+    def time(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        self._synchronize()
+        start = time.perf_counter()
+        yield
+        self._synchronize()
+        self.timings[name] += time.perf_counter() - start
+
+    def start_step(self):
+        self.timings = defaultdict(float)
+        if self.enabled and self.is_cuda:
+            torch.cuda.reset_peak_memory_stats(self.fabric.device)
+        self._synchronize()
+        self._step_start = time.perf_counter()
+
+    def end_step(self, tokens: int) -> dict[str, float]:
+        "tokens: tokens processed by this device in the step"
+        self._synchronize()
+        step_time = time.perf_counter() - self._step_start
+        metrics = {
+            "step_time": step_time,
+            "tokens_per_sec": tokens * self.fabric.world_size / step_time,
+        }
+        if self.flops_per_token and self.available_flops:
+            metrics["mfu"] = self.flops_per_token * tokens / step_time / self.available_flops
+        if not self.enabled:
+            return metrics
+        for name in ("data", "forward", "backward", "optimizer"):
+            metrics[f"{name}_time"] = self.timings[name]
+        if self.is_cuda:
+            metrics["peak_memory_gb"] = torch.cuda.max_memory_allocated(self.fabric.device) / 1e9
+        return metrics
+
+    def log(self, metrics: dict[str, float], step: int):
+        try:
+            self.fabric.log_dict(metrics, step=step)
+        except Exception as e:
+            print(f"Error logging: {e}")